@@ -9,32 +9,337 @@ Noms et numéros étudiants:
 import argparse
 import getpass
 import json
+import os
 import socket
 import sys
+from typing import Iterable, Iterator, Optional
 
 import glosocket
 import gloutils
 
+# Nombre de courriels transmis d'un seul envoi par `send_emails` avant
+# d'en lire les réponses.
+BATCH_WINDOW = 64
+# Variable d'environnement lue par le mode lot pour le mot de passe.
+PASSWORD_ENV = "GLO_PASSWORD"  # nosec:B105
+
+
+class ClientError(Exception):
+    """
+    Erreur levée par les méthodes publiques du client lorsque le serveur
+    refuse une requête. Le message est celui transmis par le serveur.
+    """
 
-class Client:
-    """Client pour le serveur mail @glo2000.ca."""
 
-    def __init__(self, destination: str) -> None:
+class Client:
+    """
+    Client pour le serveur mail @glo2000.ca.
+
+    Les méthodes publiques (`register`, `login`, `send_email`,
+    `list_emails`, `get_email`, `stats`...) n'interagissent pas avec
+    l'utilisateur: elles retournent les payloads du serveur et lèvent
+    ClientError en cas de refus. Le menu interactif de `run` les enrobe.
+    """
+
+    def __init__(self, destination: str,
+                 codec: str = gloutils.CODEC_JSON,
+                 compress: bool = False) -> None:
         """
         Prépare et connecte le socket du client `_socket`.
 
         Prépare un attribut `_username` pour stocker le nom d'utilisateur
         courant. Laissé vide quand l'utilisateur n'est pas connecté.
+        L'attribut `_token` garde le jeton de session remis par le serveur,
+        qui permet de reprendre la session si la connexion est perdue.
+
+        Si `codec` n'est pas JSON ou si `compress` est vrai, les réglages
+        sont négociés avec le serveur à l'aide de l'entête `HELLO`; le
+        client garde les réglages par défaut si le serveur les refuse.
         """
 
         self._username = None
+        self._token = None
+        self._destination = destination
+        self._requested_codec = codec
+        self._requested_compress = compress
 
-        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         try:
-            self._socket.connect((destination, gloutils.APP_PORT))
-        except socket.error:
+            self._connect()
+        except (socket.error, glosocket.GLOSocketError):
             sys.exit(1)
 
+    def _connect(self) -> None:
+        """
+        Connecte le socket du client au serveur et négocie les réglages
+        demandés avec l'entête `HELLO`.
+        """
+        self._codec = gloutils.CODEC_JSON
+        self._compress = False
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.connect((self._destination, gloutils.APP_PORT))
+
+        if self._requested_codec != gloutils.CODEC_JSON \
+                or self._requested_compress:
+            compression = ([gloutils.COMPRESSION_ZLIB]
+                           if self._requested_compress else [])
+            self._send(gloutils.GloMessage(
+                header=gloutils.Headers.HELLO,
+                payload=gloutils.HelloPayload(
+                    codecs=[self._requested_codec], compression=compression)
+            ))
+            response = self._recv()
+            if response["header"] == gloutils.Headers.OK:
+                self._codec = response["payload"]["codecs"][0]
+                self._compress = bool(
+                    response["payload"].get("compression"))
+
+    def _reconnect(self) -> bool:
+        """
+        Rétablit la connexion perdue avec le serveur puis reprend la
+        session avec l'entête `AUTH_RESUME` et le jeton `_token`, sans
+        redemander le mot de passe.
+
+        Retourne faux si le serveur est injoignable. Si la session ne peut
+        être reprise, l'utilisateur revient au menu de connexion.
+        """
+        self._socket.close()
+        try:
+            self._connect()
+            if self._token is None:
+                self._username = None
+                return True
+            self._send(gloutils.GloMessage(
+                header=gloutils.Headers.AUTH_RESUME,
+                payload=gloutils.SessionPayload(token=self._token)
+            ))
+            response = self._recv()
+        except (socket.error, glosocket.GLOSocketError):
+            return False
+        if response["header"] == gloutils.Headers.OK:
+            self._token = response["payload"]["token"]
+        else:
+            print(response["payload"]["error_message"])
+            self._username = None
+            self._token = None
+        return True
+
+    def _send(self, message: gloutils.GloMessage) -> None:
+        """Encode le message avec le codec courant et le transmet."""
+        glosocket.send_mesg_bytes(
+            self._socket, gloutils.encode_message(message, self._codec),
+            self._compress)
+
+    def _recv(self) -> gloutils.GloMessage:
+        """Reçoit et décode la prochaine réponse du serveur."""
+        return gloutils.decode_message(
+            glosocket.recv_mesg_bytes(self._socket, self._compress),
+            self._codec)
+
+    @staticmethod
+    def _check(response: gloutils.GloMessage):
+        """
+        Retourne le payload d'une réponse `OK`, ou lève ClientError avec le
+        message d'erreur du serveur.
+        """
+        if response["header"] == gloutils.Headers.OK:
+            return response.get("payload")
+        if response["header"] == gloutils.Headers.ERROR:
+            raise ClientError(response["payload"]["error_message"])
+        raise ClientError("Invalid server response")
+
+    def _request(self, message: gloutils.GloMessage):
+        """Transmet une requête et retourne le payload de la réponse."""
+        self._send(message)
+        return self._check(self._recv())
+
+    @property
+    def username(self) -> Optional[str]:
+        """Nom de l'utilisateur connecté, ou None."""
+        return self._username
+
+    def _authenticate(self, header: gloutils.Headers, username: str,
+                      password: str) -> None:
+        """Transmet des identifiants et retient la session ouverte."""
+        session = self._request(gloutils.GloMessage(
+            header=header,
+            payload=gloutils.AuthPayload(username=username,
+                                         password=password)
+        ))
+        self._username = username
+        self._token = session["token"]
+
+    def register(self, username: str, password: str) -> None:
+        """Crée un compte avec l'entête `AUTH_REGISTER` et s'y connecte."""
+        self._authenticate(gloutils.Headers.AUTH_REGISTER, username,
+                           password)
+
+    def login(self, username: str, password: str) -> None:
+        """Se connecte à un compte existant avec l'entête `AUTH_LOGIN`."""
+        self._authenticate(gloutils.Headers.AUTH_LOGIN, username, password)
+
+    def logout(self) -> None:
+        """Ferme la session avec l'entête `AUTH_LOGOUT`."""
+        self._send(gloutils.GloMessage(header=gloutils.Headers.AUTH_LOGOUT))
+        self._username = None
+        self._token = None
+
+    def close(self) -> None:
+        """
+        Préviens le serveur de la déconnexion avec l'entête `BYE` et ferme le
+        socket du client.
+        """
+        self._send(gloutils.GloMessage(header=gloutils.Headers.BYE))
+        self._socket.close()
+
+    def _make_email(self, destination: str, subject: str,
+                    body: str) -> gloutils.EmailContentPayload:
+        """Construit un courriel de l'utilisateur connecté."""
+        if not self._username:
+            raise ClientError("Aucun utilisateur n'est connecté")
+        return gloutils.EmailContentPayload(
+            sender=self._username + "@" + gloutils.SERVER_DOMAIN,
+            destination=destination,
+            subject=subject,
+            date=gloutils.get_current_utc_time(),
+            content=body
+        )
+
+    def _email_requests(self, email: gloutils.EmailContentPayload
+                        ) -> list[gloutils.GloMessage]:
+        """
+        Retourne les requêtes qui transmettent le courriel: `EMAIL_SENDING`,
+        ou, si le corps atteint STREAM_THRESHOLD caractères, son en-tête
+        avec l'entête `EMAIL_STREAM_START`, son contenu en messages
+        `EMAIL_STREAM_CHUNK` puis `EMAIL_STREAM_END`. Le serveur ne répond
+        qu'à la dernière.
+        """
+        content = email["content"]
+        if len(content) < gloutils.STREAM_THRESHOLD:
+            return [gloutils.GloMessage(
+                header=gloutils.Headers.EMAIL_SENDING,
+                payload=email
+            )]
+        requests = [gloutils.GloMessage(
+            header=gloutils.Headers.EMAIL_STREAM_START,
+            payload=gloutils.EmailStreamStartPayload(
+                sender=email["sender"],
+                destination=email["destination"],
+                subject=email["subject"],
+                date=email["date"]
+            )
+        )]
+        for start in range(0, len(content), gloutils.STREAM_CHUNK_SIZE):
+            requests.append(gloutils.GloMessage(
+                header=gloutils.Headers.EMAIL_STREAM_CHUNK,
+                payload=gloutils.EmailChunkPayload(
+                    data=content[start:start + gloutils.STREAM_CHUNK_SIZE])
+            ))
+        requests.append(gloutils.GloMessage(
+            header=gloutils.Headers.EMAIL_STREAM_END))
+        return requests
+
+    def send_email(self, destination: str, subject: str, body: str
+                   ) -> list[gloutils.RecipientResult]:
+        """
+        Envoie un courriel de l'utilisateur connecté, par morceaux si le
+        corps atteint STREAM_THRESHOLD caractères. `destination` peut
+        contenir plusieurs adresses séparées par RECIPIENT_SEPARATOR.
+
+        Retourne le résultat de l'envoi à chaque destinataire; si aucun
+        d'eux n'a reçu le courriel, lève plutôt ClientError.
+        """
+        for request in self._email_requests(
+                self._make_email(destination, subject, body)):
+            self._send(request)
+        report = self._check(self._recv())
+        return report["results"] if report else []
+
+    def send_emails(self, emails: Iterable[tuple[str, str, str]]
+                    ) -> Iterator[Optional[str]]:
+        """
+        Envoie des courriels `(destinataire, sujet, corps)` sur la
+        connexion courante, BATCH_WINDOW à la fois: les requêtes d'une
+        fenêtre sont transmises d'un seul envoi avant d'en lire les
+        réponses.
+
+        Produit, dans l'ordre des courriels, None pour chaque courriel remis
+        à tous ses destinataires, sinon le message d'erreur du serveur.
+        """
+        connection = glosocket.GLOConnection(self._socket, self._compress)
+        pending = 0
+        for destination, subject, body in emails:
+            requests = self._email_requests(
+                self._make_email(destination, subject, body))
+            for request in requests[:-1]:
+                connection.queue(
+                    gloutils.encode_message(request, self._codec),
+                    expect_response=False)
+            connection.queue(gloutils.encode_message(requests[-1],
+                                                     self._codec))
+            pending += 1
+            if pending == BATCH_WINDOW:
+                yield from self._batch_results(connection)
+                pending = 0
+        yield from self._batch_results(connection)
+
+    def _batch_results(self, connection: glosocket.GLOConnection
+                       ) -> Iterator[Optional[str]]:
+        """
+        Transmet la fenêtre en file et produit le résultat de chaque
+        courriel.
+        """
+        connection.flush()
+        while connection.pending_responses:
+            response = gloutils.decode_message(connection.recv_bytes(),
+                                               self._codec)
+            try:
+                report = self._check(response)
+            except ClientError as ex:
+                yield str(ex)
+            else:
+                yield report.get("error_message") if report else None
+
+    def list_emails(self, offset: int = 0,
+                    limit: int = gloutils.INBOX_PAGE_SIZE
+                    ) -> gloutils.EmailPagePayload:
+        """
+        Retourne une page de la liste des courriels avec l'entête
+        `INBOX_PAGE_REQUEST`.
+        """
+        return self._request(gloutils.GloMessage(
+            header=gloutils.Headers.INBOX_PAGE_REQUEST,
+            payload=gloutils.EmailPageRequestPayload(offset=offset,
+                                                     limit=limit)
+        ))
+
+    def search(self, query: str, offset: int = 0,
+               limit: int = gloutils.INBOX_PAGE_SIZE
+               ) -> gloutils.EmailPagePayload:
+        """
+        Retourne une page des courriels contenant tous les mots de `query`
+        avec l'entête `SEARCH_REQUEST`.
+        """
+        return self._request(gloutils.GloMessage(
+            header=gloutils.Headers.SEARCH_REQUEST,
+            payload=gloutils.SearchRequestPayload(query=query, offset=offset,
+                                                  limit=limit)
+        ))
+
+    def get_email(self, number: int) -> gloutils.EmailContentPayload:
+        """
+        Retourne le courriel de numéro donné avec l'entête
+        `INBOX_READING_CHOICE`.
+        """
+        return self._request(gloutils.GloMessage(
+            header=gloutils.Headers.INBOX_READING_CHOICE,
+            payload=gloutils.EmailChoicePayload(choice=number)
+        ))
+
+    def stats(self) -> gloutils.StatsPayload:
+        """Retourne les statistiques de la boîte avec `STATS_REQUEST`."""
+        return self._request(gloutils.GloMessage(
+            header=gloutils.Headers.STATS_REQUEST))
+
     def _register(self) -> None:
         """
         Demande un nom d'utilisateur et un mot de passe et les transmet au
@@ -46,26 +351,10 @@ class Client:
         register_username = input("Entrez votre nom d'utilisateur: ")
         register_password = getpass.getpass("Entrez votre mot de passe: ")
 
-        register_payload = gloutils.AuthPayload(
-            username=register_username,
-            password=register_password
-        )
-
-        message = json.dumps(gloutils.GloMessage(
-            header=gloutils.Headers.AUTH_REGISTER,
-            payload=register_payload
-        ))
-        glosocket.send_mesg(self._socket, message)
-
-        reponse = glosocket.recv_mesg(self._socket)
-        json_reponse = json.loads(reponse)
-
-        if json_reponse['header'] == gloutils.Headers.OK:
-            self._username = register_username
-        elif json_reponse['header'] == gloutils.Headers.ERROR:
-            print(json_reponse['payload']["error_message"])
-        else:
-            print("Invalid server response")
+        try:
+            self.register(register_username, register_password)
+        except ClientError as ex:
+            print(ex)
 
 
     def _login(self) -> None:
@@ -80,28 +369,10 @@ class Client:
         login_username = input("Entrez votre nom d'utilisateur: ")
         login_password = getpass.getpass("Entrez votre mot de passe: ")
 
-        credentials = gloutils.AuthPayload(
-            username=login_username,
-            password=login_password
-        )
-
-        message = json.dumps(
-            gloutils.GloMessage(
-                header=gloutils.Headers.AUTH_LOGIN,
-                payload=credentials
-            )
-        )
-
-        glosocket.send_mesg(self._socket, message)
-
-        response = glosocket.recv_mesg(self._socket)
-        json_response = json.loads(response)
-        if json_response["header"] == gloutils.Headers.OK:
-            self._username = login_username
-        elif json_response["header"] == gloutils.Headers.ERROR:
-            print(json_response["payload"]["error_message"])
-        else:
-            print("Invalid server response")
+        try:
+            self.login(login_username, login_password)
+        except ClientError as ex:
+            print(ex)
     
 
     def _quit(self) -> None:
@@ -109,89 +380,149 @@ class Client:
         Préviens le serveur de la déconnexion avec l'entête `BYE` et ferme le
         socket du client.
         """
-        message = json.dumps(gloutils.GloMessage(
-                            header=gloutils.Headers.BYE
-                        ))
-        glosocket.send_mesg(self._socket, message)
-        self._socket.close()
+        self.close()
 
-    def _read_email(self) -> None:
+    def _choose_email(self, query: Optional[str] = None) -> Optional[int]:
         """
-        Demande au serveur la liste de ses courriels avec l'entête
-        `INBOX_READING_REQUEST`.
+        Affiche la liste des courriels page par page à l'aide de l'entête
+        `INBOX_PAGE_REQUEST`, ou ceux qui contiennent les mots de `query`
+        avec l'entête `SEARCH_REQUEST`, la page suivante n'étant demandée au
+        serveur que si l'utilisateur la réclame.
+
+        Retourne le numéro du courriel choisi, ou None s'il n'y a aucun
+        courriel à lire ou en cas d'erreur.
+        """
+        offset = 0
+        while True:
+            try:
+                page = (self.list_emails(offset) if query is None
+                        else self.search(query, offset))
+            except ClientError as ex:
+                print(ex)
+                return None
+
+            total = page["total"]
+            if total == 0:
+                print("Aucun courriel a lire" if query is None
+                      else "Aucun courriel trouve")
+                return None
+            for email in page["email_list"]:
+                print(email)
+
+            next_offset = offset + len(page["email_list"])
+            # Les résultats d'une recherche gardent leur numéro dans la
+            # liste complète, que le serveur vérifie.
+            prompt = (f"Entrez votre choix [1-{total}]" if query is None
+                      else "Entrez le numero du courriel")
+            if next_offset < total:
+                prompt += " ou 's' pour la page suivante"
+            while True:
+                mail_choice = input(prompt + ": ")
+                if mail_choice == "s" and next_offset < total:
+                    offset = next_offset
+                    break
+                if (mail_choice.isdigit() and 1 <= int(mail_choice)
+                        and (query is not None or int(mail_choice) <= total)):
+                    return int(mail_choice)
+
+    def _read_email(self, query: Optional[str] = None) -> None:
+        """
+        Demande au serveur la liste de ses courriels, une page à la fois,
+        avec l'entête `INBOX_PAGE_REQUEST`, ou les seuls courriels qui
+        contiennent les mots de `query` (voir `_choose_email`).
 
         Affiche la liste des courriels puis transmet le choix de l'utilisateur
         avec l'entête `INBOX_READING_CHOICE`.
 
-        Affiche le courriel à l'aide du gabarit `EMAIL_DISPLAY`.
+        Affiche le courriel à l'aide du gabarit `EMAIL_DISPLAY`. Le
+        courriel est demandé par morceaux, affichés dès leur réception.
 
         S'il n'y a pas de courriel à lire, l'utilisateur est averti avant de
         retourner au menu principal.
         """
+        mail_choice = self._choose_email(query)
+        if mail_choice is None:
+            return
 
-        request = gloutils.GloMessage(
-            header=gloutils.Headers.INBOX_READING_REQUEST
+        choice_payload = gloutils.EmailChoicePayload(
+            choice=mail_choice,
+            stream=True
         )
-        glosocket.send_mesg(self._socket, json.dumps(request))
 
-        response = json.loads(glosocket.recv_mesg(self._socket))
-        if response["header"] == gloutils.Headers.OK:
-            email_list = response["payload"]["email_list"]
-            if len(email_list) > 0:
-                for email in email_list:
-                    print(email)
-
-                mail_choice = input(f"Entrez votre choix [1-{len(email_list)}]")
-                while int(mail_choice) > len(email_list):
-                    mail_choice = input(f"Entrez votre choix [1-{len(email_list)}]")
-
-                choice_payload = gloutils.EmailChoicePayload(
-                    choice = int(mail_choice)
-                )
-
-                choice_request = gloutils.GloMessage(
-                    header=gloutils.Headers.INBOX_READING_CHOICE,
-                    payload=choice_payload
-                )
-
-                glosocket.send_mesg(self._socket, json.dumps(choice_request))
-
-                content_response = json.loads(glosocket.recv_mesg(self._socket))
-
-                if content_response["header"] == gloutils.Headers.OK:
-                    mail_content = content_response["payload"]
-                    sender = mail_content["sender"]
-                    destination = mail_content["destination"]
-                    subject = mail_content["subject"]
-                    date = mail_content["date"]
-                    content = mail_content["content"]
-
-                    print(gloutils.EMAIL_DISPLAY.format(
-                        sender=sender,
-                        to=destination,
-                        subject=subject,
-                        date=date,
-                        body=content
-                    ))
-        elif response["header"] == gloutils.Headers.ERROR:
-            print(response["payload"]["error_message"])
+        choice_request = gloutils.GloMessage(
+            header=gloutils.Headers.INBOX_READING_CHOICE,
+            payload=choice_payload
+        )
+
+        self._send(choice_request)
+
+        content_response = self._recv()
+
+        if content_response["header"] == gloutils.Headers.EMAIL_STREAM_START:
+            self._print_stream(content_response["payload"])
+        elif content_response["header"] == gloutils.Headers.OK:
+            mail_content = content_response["payload"]
+            sender = mail_content["sender"]
+            destination = mail_content["destination"]
+            subject = mail_content["subject"]
+            date = mail_content["date"]
+            content = mail_content["content"]
+
+            print(gloutils.EMAIL_DISPLAY.format(
+                sender=sender,
+                to=destination,
+                subject=subject,
+                date=date,
+                body=content
+            ))
+        elif content_response["header"] == gloutils.Headers.ERROR:
+            print(content_response["payload"]["error_message"])
         else:
             print("Invalid server response")
 
+    def _search_emails(self) -> None:
+        """
+        Demande les mots à chercher puis affiche les courriels trouvés et
+        le courriel choisi comme `_read_email`.
+        """
+        query = input("Entrez les mots a chercher: ")
+        self._read_email(query)
+
+    def _print_stream(self, header: gloutils.EmailStreamStartPayload
+                      ) -> None:
+        """
+        Affiche un courriel reçu par morceaux, jusqu'à l'entête
+        `EMAIL_STREAM_END`, sans le garder en mémoire.
+        """
+        before, after = gloutils.EMAIL_DISPLAY.split("{body}")
+        print(before.format(
+            sender=header["sender"],
+            to=header["destination"],
+            subject=header["subject"],
+            date=header["date"]
+        ), end="")
+        while True:
+            response = self._recv()
+            if response["header"] != gloutils.Headers.EMAIL_STREAM_CHUNK:
+                break
+            print(response["payload"]["data"], end="")
+        print(after)
+
     def _send_email(self) -> None:
         """
         Demande à l'utilisateur respectivement:
-        - l'adresse email du destinataire,
+        - l'adresse email du destinataire, ou celles des destinataires,
         - le sujet du message,
         - le corps du message.
 
         La saisie du corps se termine par un point seul sur une ligne.
 
-        Transmet ces informations avec l'entête `EMAIL_SENDING`.
+        Transmet ces informations avec l'entête `EMAIL_SENDING`, ou par
+        morceaux si le corps atteint STREAM_THRESHOLD caractères.
         """
 
-        sender = self._username
-        destination = input("Entrez l'addresse du destinataire :")
+        destination = input("Entrez l'addresse du destinataire "
+                            "(plusieurs adresses séparées par des virgules) :")
         subject = input("Entrez le sujet: ")
         print("""Entrez le contenu du courriel,
               terminez la saisie avec un '.' seul sur une ligne: """)
@@ -200,28 +531,19 @@ class Client:
         while (buffer != ".\n"):
             body += buffer
             buffer = input() + '\n'
-        date = gloutils.get_current_utc_time()
 
-        email = gloutils.EmailContentPayload(
-            sender=sender + "@" + gloutils.SERVER_DOMAIN,
-            destination=destination,
-            subject=subject,
-            date=date,
-            content=body
-        )
-
-        message = gloutils.GloMessage(
-            header=gloutils.Headers.EMAIL_SENDING,
-            payload=email
-        )
-
-        glosocket.send_mesg(self._socket, json.dumps(message))
-
-        response = json.loads(glosocket.recv_mesg(self._socket))
-        if response["header"] == gloutils.Headers.OK:
+        try:
+            results = self.send_email(destination, subject, body)
+        except ClientError as ex:
+            print(ex)
+            return
+        failures = [result for result in results if "error_message" in result]
+        for result in failures:
+            print(f"{result['destination']}: {result['error_message']}")
+        if not failures:
             print("Email envoye avec succes")
         else:
-            print(response["payload"]["error_message"])
+            print("Email envoye aux autres destinataires")
 
 
     def _check_stats(self) -> None:
@@ -231,36 +553,35 @@ class Client:
         Affiche les statistiques à l'aide du gabarit `STATS_DISPLAY`.
         """
 
-        request = gloutils.GloMessage(header=gloutils.Headers.STATS_REQUEST)
-
-        glosocket.send_mesg(self._socket, json.dumps(request))
-
-        response = json.loads(glosocket.recv_mesg(self._socket))
-
-        if response["header"] == gloutils.Headers.OK:
-            count = response["payload"]["count"]
-            size = response["payload"]["size"]
-
-            print(gloutils.STATS_DISPLAY.format(
-                count=count,
-                size=size
-            ))
+        try:
+            stats = self.stats()
+        except ClientError as ex:
+            print(ex)
+            return
+
+        print(gloutils.STATS_DISPLAY.format(
+            count=stats["count"],
+            size=stats["size"],
+            physical_size=stats.get("physical_size", stats["size"])
+        ))
 
     def _logout(self) -> None:
         """
         Préviens le serveur avec l'entête `AUTH_LOGOUT`.
 
-        Met à jour l'attribut `_username`.
+        Met à jour les attributs `_username` et `_token`.
         """
 
-        logout_request = gloutils.GloMessage(header=gloutils.Headers.AUTH_LOGOUT)
-
-        glosocket.send_mesg(self._socket, json.dumps(logout_request))
-        self._username = None
+        self.logout()
 
 
     def run(self) -> None:
-        """Point d'entrée du client."""
+        """
+        Point d'entrée du client.
+
+        Si la connexion est perdue pendant une action, le client se
+        reconnecte et reprend sa session avant de réafficher le menu.
+        """
         should_quit = False
 
         while not should_quit:
@@ -282,19 +603,27 @@ class Client:
             else:
                 # Main menu
                 print(gloutils.CLIENT_USE_CHOICE + "\n")
-                choice = input("Entrez votre choix [1-4]: ")
-
-                match choice:
-                    case "1":
-                        self._read_email()
-                    case "2":
-                        self._send_email()
-                    case "3":
-                        self._check_stats()
-                    case "4":
-                        self._logout()
-                    case _:
-                        continue
+                choice = input("Entrez votre choix [1-5]: ")
+
+                try:
+                    match choice:
+                        case "1":
+                            self._read_email()
+                        case "2":
+                            self._send_email()
+                        case "3":
+                            self._check_stats()
+                        case "4":
+                            self._logout()
+                        case "5":
+                            self._search_emails()
+                        case _:
+                            continue
+                except glosocket.GLOSocketError:
+                    print("Connexion au serveur perdue, reconnexion...")
+                    if not self._reconnect():
+                        print("Le serveur est injoignable")
+                        should_quit = True
 
     def _validate_domain(p_destination: str) -> bool:
         good_domain = False
@@ -306,13 +635,85 @@ class Client:
         return good_domain
 
 
+def _read_batch(source: Iterable[str]
+                ) -> Iterator[tuple[str, str, str]]:
+    """
+    Lit les courriels d'un lot, un objet JSON par ligne avec les clés
+    `destination`, `subject` et `content`. Les lignes vides sont ignorées.
+    """
+    for line in source:
+        if not line.strip():
+            continue
+        email = json.loads(line)
+        yield email["destination"], email["subject"], email["content"]
+
+
+def _run_batch(client: Client, username: str, batch: str) -> int:
+    """
+    Se connecte au compte puis envoie tous les courriels du fichier de lot
+    (`-` pour l'entrée standard) sur la même connexion. Affiche le
+    résultat de chaque envoi et retourne 1 si l'un d'eux a échoué.
+    """
+    password = os.environ.get(PASSWORD_ENV)
+    if password is None:
+        password = getpass.getpass("Entrez votre mot de passe: ")
+    try:
+        client.login(username, password)
+    except ClientError as ex:
+        print(ex)
+        return 1
+    failures = 0
+    try:
+        source = (sys.stdin if batch == "-"
+                  else open(batch, encoding="utf-8"))
+    except OSError as ex:
+        print(ex)
+        client.close()
+        return 1
+    with source:
+        try:
+            for number, error in enumerate(
+                    client.send_emails(_read_batch(source)), 1):
+                if error is None:
+                    print(f"{number}: Email envoye avec succes")
+                else:
+                    failures += 1
+                    print(f"{number}: {error}")
+        except (ValueError, KeyError) as ex:
+            print(f"Lot invalide: {ex!r}")
+            failures += 1
+    client.close()
+    return 1 if failures else 0
+
+
 def _main() -> int:
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--destination", action="store",
                         dest="dest", required=True,
                         help="Adresse IP/URL du serveur.")
+    parser.add_argument("-c", "--codec", action="store",
+                        choices=gloutils.CODECS, dest="codec",
+                        default=gloutils.CODEC_JSON,
+                        help="Codec des messages à négocier avec le serveur.")
+    parser.add_argument("-z", "--compress", action="store_true",
+                        dest="compress",
+                        help="Compresser les gros messages si le serveur "
+                             "le permet.")
+    parser.add_argument("-b", "--batch", action="store", dest="batch",
+                        default=None, metavar="FICHIER",
+                        help="Envoie les courriels du fichier (un objet "
+                             "JSON par ligne, '-' pour l'entrée standard) "
+                             "puis quitte, sans menu.")
+    parser.add_argument("-u", "--username", action="store", dest="username",
+                        default=None,
+                        help="Compte utilisé en mode lot; le mot de passe "
+                             f"est lu dans {PASSWORD_ENV} ou demandé.")
     args = parser.parse_args(sys.argv[1:])
-    client = Client(args.dest)
+    if args.batch is not None and args.username is None:
+        parser.error("le mode lot demande un nom d'utilisateur (-u)")
+    client = Client(args.dest, args.codec, args.compress)
+    if args.batch is not None:
+        return _run_batch(client, args.username, args.batch)
     client.run()
     return 0
 
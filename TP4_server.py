@@ -5,114 +5,390 @@ Noms et numéros étudiants:
 -
 -
 """
-import pathlib
+import argparse
+import asyncio
+import collections
+import collections.abc
+import concurrent.futures
+import functools
 import re
 import hashlib
 import hmac
 import json
 import os
-import select
+import queue
+import selectors
+import signal
 import socket
 import sys
+import time
+import traceback
+from typing import Callable, Iterable, Iterator, Optional, Union
 
+import glometrics
 import glosocket
+import glostorage
 import gloutils
 
+# Taille du tampon de réception partagé du moteur selectors.
+_RECV_BUFFER_SIZE = 1 << 16
+# Nombre maximal de requêtes traitées par client à chaque réveil, pour
+# qu'un client envoyant beaucoup de requêtes n'affame pas les autres.
+_FRAMES_PER_WAKEUP = 16
+# Au-delà de ce volume de réponses en attente, on cesse de lire le client
+# tant qu'il n'a pas consommé ses réponses.
+_MAX_PENDING_OUTPUT = 1 << 22
+# Volume de réponses en attente sous lequel le prochain morceau d'un
+# courriel transmis par morceaux est produit.
+_STREAM_WINDOW = 1 << 18
+# Durée de validité, en secondes, d'un jeton de session.
+_SESSION_LIFETIME = 24 * 60 * 60
+# Entêtes dont le traitement accède au stockage ou calcule un hachage, et
+# qui sont confiés au bassin de fils d'exécution lorsqu'il est activé.
+_POOLED_HEADERS = frozenset({
+    gloutils.Headers.AUTH_LOGIN,
+    gloutils.Headers.AUTH_REGISTER,
+    gloutils.Headers.AUTH_RESUME,
+    gloutils.Headers.AUTH_LOGOUT,
+    gloutils.Headers.INBOX_READING_REQUEST,
+    gloutils.Headers.INBOX_PAGE_REQUEST,
+    gloutils.Headers.INBOX_READING_CHOICE,
+    gloutils.Headers.EMAIL_SENDING,
+    gloutils.Headers.STATS_REQUEST,
+    gloutils.Headers.EMAIL_STREAM_START,
+    gloutils.Headers.EMAIL_STREAM_CHUNK,
+    gloutils.Headers.EMAIL_STREAM_END,
+    gloutils.Headers.SEARCH_REQUEST,
+})
+
+# Entêtes qui portent sur la boîte de l'utilisateur connecté: elles sont
+# refusées tant que le client ne s'est pas authentifié.
+_SESSION_HEADERS = frozenset({
+    gloutils.Headers.INBOX_READING_REQUEST,
+    gloutils.Headers.INBOX_PAGE_REQUEST,
+    gloutils.Headers.INBOX_READING_CHOICE,
+    gloutils.Headers.STATS_REQUEST,
+    gloutils.Headers.SEARCH_REQUEST,
+})
+
+# Réponse d'un traitement: un message à sérialiser, un message déjà encodé
+# (par exemple un courriel projeté en mémoire) à transmettre tel quel, une
+# suite de messages produits au fur et à mesure de leur transmission, ou un
+# Future qui donnera plus tard l'une des réponses précédentes (par exemple
+# une remise en attente de synchronisation).
+_Response = Union[gloutils.GloMessage, bytes, memoryview,
+                  Iterator[gloutils.GloMessage], concurrent.futures.Future]
+
+
+class _Connection:
+    """
+    État d'un client du moteur selectors: décodeur des requêtes
+    reçues partiellement et file des réponses à transmettre.
+
+    `busy` indique qu'une requête du client est en cours dans le bassin de
+    fils d'exécution: ses requêtes suivantes attendent, pour que les
+    réponses restent dans l'ordre des requêtes. De même, les requêtes
+    attendent tant que `stream`, une réponse transmise par morceaux, n'est
+    pas terminée. `codec` et `compress` sont le codec et la compression
+    négociés avec l'entête HELLO. `header` est l'entête de la dernière
+    requête traitée, à laquelle les métriques attribuent les réponses.
+    """
+
+    def __init__(self, client_soc: socket.socket) -> None:
+        self.socket = client_soc
+        self.decoder = glosocket.FrameDecoder()
+        self.outgoing: "collections.deque[memoryview]" = collections.deque()
+        self.events = selectors.EVENT_READ
+        self.closing = False
+        self.busy = False
+        self.stream: Optional[Iterator[gloutils.GloMessage]] = None
+        self.codec = gloutils.CODEC_JSON
+        self.compress = False
+        self.header: Optional[gloutils.Headers] = None
+
+    def pending_output(self) -> int:
+        """Nombre d'octets de réponse qui restent à transmettre."""
+        return sum(len(view) for view in self.outgoing)
+
+
+def _default_data_dir() -> str:
+    """Retourne le dossier SERVER_DATA_DIR, à côté de ce fichier."""
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(current_dir, gloutils.SERVER_DATA_DIR)
+
 
 class Server:
     """Serveur mail @glo2000.ca."""
 
-    def __init__(self) -> None:
+    def __init__(self,
+                 storage: Optional[glostorage.MailStorage] = None,
+                 workers: int = 0,
+                 queue_limits: Optional[dict[gloutils.Headers, int]] = None,
+                 reuse_port: bool = False,
+                 session_secret: Optional[bytes] = None,
+                 metrics_file: Optional[str] = None,
+                 metrics_interval: float = 10.0,
+                 profiler: Optional[glometrics.Profiler] = None,
+                 admins: frozenset[str] = frozenset(),
+                 durability: str = glostorage.DURABILITY_BATCH) -> None:
         """
         Prépare le socket du serveur `_server_socket`
         et le met en mode écoute.
 
+        `storage` est le moteur de stockage des comptes et des courriels;
+        par défaut, le stockage sur le système de fichiers dans le dossier
+        SERVER_DATA_DIR.
+
+        Si `workers` est positif, les traitements qui accèdent au disque ou
+        calculent un hachage sont exécutés par autant de fils d'exécution
+        plutôt que dans la boucle principale. `queue_limits` borne, pour
+        certaines entêtes, le nombre de traitements simultanés: les
+        requêtes excédentaires attendent leur tour dans une file.
+
+        Avec `reuse_port`, le socket d'écoute utilise SO_REUSEPORT pour que
+        plusieurs processus serveurs se partagent le port (voir
+        `_serve_processes`).
+
+        `session_secret` est la clé qui signe les jetons de session remis
+        à la connexion; des processus qui partagent la même clé acceptent
+        les jetons les uns des autres. Par défaut, une clé aléatoire.
+
+        Les métriques du serveur sont transmises en réponse à l'entête
+        METRICS_REQUEST d'un utilisateur de `admins` et, si `metrics_file`
+        est donné, y sont écrites toutes les `metrics_interval` secondes.
+
+        Avec `profiler`, les traitements peuvent être profilés pendant une
+        fenêtre, ouverte par `start_profile` (par exemple sur SIGUSR1) ou
+        par l'entête PROFILE_REQUEST d'un utilisateur de `admins`.
+
+        `durability` est le niveau de durabilité des remises (voir
+        glostorage.GroupCommit): par défaut, un courriel reçu n'est confirmé
+        qu'une fois synchronisé sur disque, avec les autres remises du même
+        lot.
+
         Prépare les attributs suivants:
-        - `_client_socs` une liste des sockets clients.
+        - `_connections` un dictionnaire associant chaque socket client
+            à son état de connexion.
+        - `_selector` le sélecteur (epoll sous Linux) du moteur principal.
+        - `_backlog` les connexions ayant encore des requêtes complètes
+            à traiter.
         - `_logged_users` un dictionnaire associant chaque
             socket client à un nom d'utilisateur.
-
-        S'assure que les dossiers de données du serveur existent.
+        - `_uploads` un dictionnaire associant chaque socket client au
+            courriel qu'il transmet par morceaux et à la réponse à lui
+            faire à la fin.
+        - `_storage` le moteur de stockage, dont les opérations sont
+            chronométrées.
+        - `_metrics` les compteurs et histogrammes du serveur.
+        - `_commits` la confirmation des remises selon `durability`.
+        - `_executor` le bassin de fils d'exécution des traitements.
+        - `_jobs_running` et `_jobs_waiting` le nombre de traitements en
+            cours et la file des traitements en attente, par entête.
+        - `_completed` les traitements terminés, signalés à la boucle
+            principale par la paire de sockets `_wakeup_*`.
+        - `_closed` vrai une fois le serveur arrêté par `cleanup`.
         """
         try :
              self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
              self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+             if reuse_port:
+                 self._server_socket.setsockopt(socket.SOL_SOCKET,
+                                                socket.SO_REUSEPORT, 1)
              self._server_socket.bind(("127.0.0.1", gloutils.APP_PORT))
              self._server_socket.listen()
         except socket.error:
             sys.exit(1)
 
-        self._client_socs = []
+        self._connections: dict[socket.socket, _Connection] = {}
+        self._selector = selectors.DefaultSelector()
+        self._backlog: set[_Connection] = set()
+        self._recv_buffer = bytearray(_RECV_BUFFER_SIZE)
         self._logged_users = {}
+        self._uploads: dict[socket.socket,
+                            tuple[Optional[glostorage.MessageWriter],
+                                  gloutils.GloMessage]] = {}
+        self._metrics = glometrics.Metrics()
+        self._commits = glostorage.GroupCommit(durability,
+                                               self._metrics.record_commit)
+        self._metrics_file = metrics_file
+        self._metrics_interval = metrics_interval
+        self._next_dump = time.monotonic() + metrics_interval
+        self._storage = glometrics.TimedStorage(
+            storage or glostorage.FileSystemStorage(_default_data_dir()),
+            self._metrics)
+        self._profiler = profiler
+        self._admins = frozenset(admin.lower() for admin in admins)
+        self._session_secret = session_secret or os.urandom(32)
+        self._executor: Optional[concurrent.futures.Executor] = None
+        if workers > 0:
+            self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self._queue_limits = dict(queue_limits or {})
+        self._jobs_running: collections.Counter = collections.Counter()
+        self._jobs_waiting: dict[gloutils.Headers, collections.deque] = \
+            collections.defaultdict(collections.deque)
+        self._completed: queue.SimpleQueue = queue.SimpleQueue()
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._closed = False
 
+    def cleanup(self) -> None:
+        """
+        Ferme toutes les connexions résiduelles, attend les traitements en
+        cours, puis synchronise les remises en attente avant de fermer le
+        stockage. Peut être appelée plusieurs fois.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for client_soc in self._connections:
+            client_soc.close()
+        self._connections.clear()
+        self._selector.close()
+        self._server_socket.close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        for client_soc in list(self._uploads):
+            self._abort_upload(client_soc)
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+        self._commits.close()
+        self._storage.close()
+        self._next_dump = 0
+        self._dump_metrics()
+        if self._profiler is not None and self._profiler.active:
+            self._profiler.stop()
+            self._poll_profile()
 
-        current_dir =os.path.dirname(os.path.abspath(__file__))
-        SERVER_DATA_DIR = os.path.join(current_dir, gloutils.SERVER_DATA_DIR)
-        SERVER_LOST_DIR = gloutils.SERVER_LOST_DIR
+    def _dump_metrics(self) -> Optional[float]:
+        """
+        Écrit les métriques dans `_metrics_file` lorsque l'intervalle est
+        écoulé. Retourne le délai avant la prochaine écriture, ou None si
+        les métriques ne sont pas écrites.
+        """
+        if self._metrics_file is None:
+            return None
+        now = time.monotonic()
+        if now >= self._next_dump:
+            try:
+                self._metrics.dump(self._metrics_file)
+            except OSError:
+                pass
+            self._next_dump = now + self._metrics_interval
+        return self._next_dump - now
 
-        if not os.path.exists(SERVER_DATA_DIR):
-            os.makedirs(SERVER_DATA_DIR)
-        
-        lost_dir_path = os.path.join(SERVER_DATA_DIR, SERVER_LOST_DIR)
-        if not os.path.exists(lost_dir_path):
-            os.makedirs(lost_dir_path)
+    def _poll_profile(self) -> Optional[float]:
+        """
+        Termine la fenêtre de profilage si elle est écoulée. Retourne le
+        délai avant la fin de la fenêtre en cours, ou None.
+        """
+        if self._profiler is None:
+            return None
+        try:
+            return self._profiler.poll()
+        except OSError:
+            return None
 
-        self._SERVER_LOST_DIR = SERVER_DATA_DIR
+    def _periodic(self) -> Optional[float]:
+        """
+        Effectue les tâches périodiques de la boucle principale et
+        retourne le délai avant la prochaine, ou None s'il n'y en a pas.
+        """
+        delays = [delay for delay in (self._dump_metrics(),
+                                      self._poll_profile())
+                  if delay is not None]
+        return min(delays, default=None)
 
-    def cleanup(self) -> None:
-        """Ferme toutes les connexions résiduelles."""
-        for client_soc in self._client_socs:
-            client_soc.close()
-        self._server_socket.close()
+    def start_profile(self) -> bool:
+        """
+        Ouvre une fenêtre de profilage des traitements et réveille la
+        boucle principale pour qu'elle en surveille la fin. Peut être
+        appelée par un gestionnaire de signal.
 
-    def _accept_client(self) -> None:
-        """Accepte un nouveau client."""
-        client_socket, _  = self._server_socket.accept()
-        self._client_socs.append(client_socket)
+        Retourne faux si le profilage n'est pas activé ou si une fenêtre
+        est déjà en cours.
+        """
+        if self._profiler is None or not self._profiler.start():
+            return False
+        try:
+            self._wakeup_send.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+        return True
 
-        
+    def _accept_client(self) -> None:
+        """Accepte les nouveaux clients en attente."""
+        while True:
+            try:
+                client_socket, _ = self._server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            client_socket.setblocking(False)
+            connection = _Connection(client_socket)
+            self._connections[client_socket] = connection
+            self._metrics.opened()
+            self._selector.register(client_socket, connection.events,
+                                    connection)
 
     def _remove_client(self, client_soc: socket.socket) -> None:
         """Retire le client des structures de données et ferme sa connexion."""
-        if client_soc in self._client_socs:
-            self._client_socs.remove(client_soc)
+        connection = self._connections.pop(client_soc, None)
+        if connection is not None:
+            self._backlog.discard(connection)
+            self._selector.unregister(client_soc)
+            self._metrics.closed()
+        self._logout(client_soc)
+        if connection is None or not connection.busy:
+            # Sinon, un fil du bassin peut encore écrire le courriel en
+            # cours de réception: `_finish_jobs` l'abandonne à la fin du
+            # traitement.
+            self._abort_upload(client_soc)
         client_soc.close()
 
     def _create_account(self, client_soc: socket.socket,
                         payload: gloutils.AuthPayload
-                        ) -> gloutils.GloMessage:
+                        ) -> _Response:
         """
         Crée un compte à partir des données du payload.
 
         Si les identifiants sont valides, créee le dossier de l'utilisateur,
-        associe le socket au nouvel l'utilisateur et retourne un succès,
-        sinon retourne un message d'erreur.
+        y remet les courriels perdus qui lui étaient adressés, associe le
+        socket au nouvel l'utilisateur et retourne un succès, sinon retourne
+        un message d'erreur.
         """
         received_username = payload["username"]
         received_pwd = payload["password"]
 
         if self._is_valid_username(received_username):
-            lowerCaseUsername = received_username.lower()
-            user_dir = os.path.join(self._SERVER_LOST_DIR, lowerCaseUsername)
 
-            if not os.path.exists(user_dir):
+            if not self._storage.user_exists(received_username):
 
                 if re.search(r"(?=[^a-z]*[a-z])(?=[^A-Z]*[A-Z])(?=[^\d]*\d).{10,}",
                               received_pwd):
                     
                     hasher = hashlib.sha3_512()
                     hasher.update(received_pwd.encode('utf-8'))
-  
-                    os.makedirs(user_dir)
-                    with open(os.path.join(user_dir, gloutils.PASSWORD_FILENAME),
-                               "a") as f:
-                        f.write(hasher.hexdigest())
+
+                    # Un autre client peut avoir créé le même compte depuis
+                    # user_exists: seul celui dont la création réussit est
+                    # connecté.
+                    if not self._storage.create_user(received_username,
+                                                     hasher.hexdigest()):
+                        return gloutils.GloMessage(
+                            header=gloutils.Headers.ERROR,
+                            payload=gloutils.ErrorPayload(
+                                error_message="le nom d'utilisateur est deja"
+                                              " utilise")
+                        )
+                    with glostorage.track_writes() as written:
+                        self._storage.redeliver_lost(received_username)
 
                     self._logged_users[client_soc] = received_username
 
-                    return gloutils.GloMessage(
+                    return self._commits.commit(written, gloutils.GloMessage(
                         header=gloutils.Headers.OK,
-                    )
+                        payload=self._issue_session(received_username)
+                    ))
                    
                 else:
                    error_payload = gloutils.ErrorPayload(
@@ -158,16 +434,12 @@ class Server:
         hasher = hashlib.sha3_512()
         hasher.update(recv_pwd.encode('utf-8'))
 
-        user_dir = os.path.join(self._SERVER_LOST_DIR, recv_username.lower())
-
-        if os.path.exists(user_dir):
-            with open(os.path.join(user_dir, gloutils.PASSWORD_FILENAME), "r") as f:
-                stored_pwd =  f.readline()
-                if hmac.compare_digest(hasher.hexdigest(), stored_pwd):
-                    self._logged_users[client_soc] = recv_username
-                    return gloutils.GloMessage(
-                        header=gloutils.Headers.OK
-                    )
+        if self._storage.verify_password(recv_username, hasher.hexdigest()):
+            self._logged_users[client_soc] = recv_username
+            return gloutils.GloMessage(
+                header=gloutils.Headers.OK,
+                payload=self._issue_session(recv_username)
+            )
 
         error_payload = gloutils.ErrorPayload(
             error_message="Les indentifiants ne sont pas valides"
@@ -177,10 +449,65 @@ class Server:
             payload=error_payload
         )
 
-    def _logout(self, client_soc: socket.socket) -> None:
-        """Déconnecte un utilisateur."""
-        self._logged_users.pop(client_soc, None)
+    def _sign_session(self, username: str, expiry: int, epoch: int) -> str:
+        """Calcule la signature d'un jeton de session."""
+        return hmac.new(self._session_secret,
+                        f"{username}:{expiry}:{epoch}".encode("utf-8"),
+                        hashlib.sha256).hexdigest()
+
+    def _issue_session(self, username: str) -> gloutils.SessionPayload:
+        """
+        Crée un jeton de session pour l'utilisateur.
+
+        Le jeton `utilisateur:expiration:signature` reste valide jusqu'à son
+        expiration, à moins que l'utilisateur ne se déconnecte: la
+        signature couvre aussi l'époque des sessions du compte (voir
+        glostorage.MailStorage.session_epoch), que la déconnexion avance.
+        """
+        expiry = int(time.time()) + _SESSION_LIFETIME
+        signature = self._sign_session(
+            username, expiry, self._storage.session_epoch(username) or 0)
+        return gloutils.SessionPayload(
+            token=f"{username}:{expiry}:{signature}")
+
+    def _resume(self, client_soc: socket.socket,
+                payload: gloutils.SessionPayload) -> gloutils.GloMessage:
+        """
+        Reprend une session à partir du jeton remis lors d'une connexion
+        précédente, sans recalculer le hachage du mot de passe.
+
+        Si le jeton est authentique, n'a pas expiré et n'a pas été révoqué,
+        et que le compte existe toujours, associe le socket à l'utilisateur
+        et retourne un succès avec un nouveau jeton, sinon retourne un
+        message d'erreur.
+        """
+        username, _, rest = str(payload.get("token", "")).partition(":")
+        expiry, _, signature = rest.partition(":")
+        if expiry.isdigit() and int(expiry) > time.time():
+            epoch = self._storage.session_epoch(username)
+            if epoch is not None and hmac.compare_digest(
+                    signature,
+                    self._sign_session(username, int(expiry), epoch)):
+                self._logged_users[client_soc] = username
+                return gloutils.GloMessage(
+                    header=gloutils.Headers.OK,
+                    payload=self._issue_session(username)
+                )
+        return gloutils.GloMessage(
+            header=gloutils.Headers.ERROR,
+            payload=gloutils.ErrorPayload(
+                error_message="La session est invalide ou expirée")
+        )
 
+    def _logout(self, client_soc: socket.socket,
+                revoke: bool = False) -> None:
+        """
+        Déconnecte un utilisateur. Avec `revoke`, à sa demande, ses jetons
+        de session ne sont plus acceptés.
+        """
+        username = self._logged_users.pop(client_soc, None)
+        if revoke and username is not None:
+            self._storage.revoke_sessions(username)
 
     def _get_email_list(self, client_soc: socket.socket
                         ) -> gloutils.GloMessage:
@@ -191,21 +518,10 @@ class Server:
 
         Une absence de courriel n'est pas une erreur, mais une liste vide.
         """
-
-        mail_list = []
-
         username = self._logged_users[client_soc]
 
-        path = os.path.join(self._SERVER_LOST_DIR, username.lower())
-        user_path = pathlib.Path(path)
-        counter = 1
-        for file in user_path.iterdir():
-            if os.path.basename(file) != gloutils.PASSWORD_FILENAME:
-                with open (file, "r") as f:
-                    info = json.load(f)
-                    formattedText = gloutils.SUBJECT_DISPLAY.format(number=counter, sender=info["sender"], subject=info["subject"], date=info["date"])
-                    mail_list.append(formattedText)
-                    counter += 1
+        headers, _ = self._storage.list_headers(username)
+        mail_list = self._format_entries(headers, 1)
 
         payload = gloutils.EmailListPayload(
             email_list=mail_list
@@ -216,6 +532,100 @@ class Server:
             payload=payload
         )
 
+    def _get_email_page(self, client_soc: socket.socket,
+                        payload: gloutils.EmailPageRequestPayload
+                        ) -> gloutils.GloMessage:
+        """
+        Récupère une page de la liste des courriels de l'utilisateur associé
+        au socket, au format de `_get_email_list`.
+
+        Seules les entrées de la page demandée sont lues et sérialisées. Les
+        numéros affichés restent ceux de la liste complète, pour être
+        utilisés tels quels avec `INBOX_READING_CHOICE`.
+        """
+        offset = payload["offset"]
+        limit = min(payload["limit"], gloutils.INBOX_PAGE_MAX)
+        if offset < 0 or limit < 1:
+            error_payload = gloutils.ErrorPayload(
+                error_message="La page demandee n'est pas valide"
+            )
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=error_payload
+            )
+
+        username = self._logged_users[client_soc]
+        headers, total = self._storage.list_headers(username, offset, limit)
+
+        payload = gloutils.EmailPagePayload(
+            email_list=self._format_entries(headers, offset + 1),
+            offset=offset,
+            total=total
+        )
+        return gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=payload
+        )
+
+    def _search_emails(self, client_soc: socket.socket,
+                       payload: gloutils.SearchRequestPayload
+                       ) -> gloutils.GloMessage:
+        """
+        Cherche les courriels de l'utilisateur associé au socket dont
+        l'expéditeur, le sujet et le contenu réunis contiennent tous les mots
+        de la requête, sans tenir compte de la casse ni des accents.
+
+        Les résultats, du plus récent au plus ancien, sont transmis au format
+        de `_get_email_page`, avec leur numéro dans la liste complète pour
+        être utilisés tels quels avec `INBOX_READING_CHOICE`.
+        """
+        terms = glostorage.search_terms(payload["query"])
+        offset = payload.get("offset", 0)
+        limit = min(payload.get("limit", gloutils.INBOX_PAGE_SIZE),
+                    gloutils.INBOX_PAGE_MAX)
+        if (not terms or len(terms) > glostorage.SEARCH_MAX_TERMS
+                or offset < 0 or limit < 1):
+            error_payload = gloutils.ErrorPayload(
+                error_message="La recherche demandee n'est pas valide"
+            )
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=error_payload
+            )
+
+        username = self._logged_users[client_soc]
+        results, total = self._storage.search(username, terms, offset, limit)
+
+        payload = gloutils.EmailPagePayload(
+            email_list=self._format_numbered(results),
+            offset=offset,
+            total=total
+        )
+        return gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=payload
+        )
+
+    def _format_entries(self, headers: list[glostorage.MessageHeader],
+                        first_number: int) -> list[str]:
+        """Met en forme des en-têtes avec le gabarit SUBJECT_DISPLAY."""
+        return self._format_numbered(enumerate(headers, start=first_number))
+
+    def _format_numbered(self, numbered: Iterable[
+                             tuple[int, glostorage.MessageHeader]]
+                         ) -> list[str]:
+        """
+        Met en forme des en-têtes, chacun précédé de son numéro, avec le
+        gabarit SUBJECT_DISPLAY.
+        """
+        return [
+            gloutils.SUBJECT_DISPLAY.format(number=number,
+                                            sender=header["sender"],
+                                            subject=header["subject"],
+                                            date=header["date"])
+            for number, header in numbered
+        ]
+
     def _get_email(self, client_soc: socket.socket,
                    payload: gloutils.EmailChoicePayload
                    ) -> gloutils.GloMessage:
@@ -227,16 +637,16 @@ class Server:
         choice = payload["choice"]
         username = self._logged_users[client_soc]
 
-        path = os.path.join(self._SERVER_LOST_DIR, username.lower())
-        user_path = pathlib.Path(path)
-        counter = 1
-        for file in user_path.iterdir():
-            if os.path.basename(file) != gloutils.PASSWORD_FILENAME:
-                if choice == counter:
-                    with open (file, "r") as f:
-                        mailcontent =  json.load(f)
-                    break
-                counter += 1
+        mailcontent = self._storage.fetch_message(username, choice)
+        if mailcontent is None:
+            error_payload = gloutils.ErrorPayload(
+                error_message="Le choix de courriel n'est pas valide"
+            )
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=error_payload
+            )
+
         payload = gloutils.EmailContentPayload(
             content=mailcontent["content"],
             date=mailcontent["date"],
@@ -250,25 +660,33 @@ class Server:
             payload=payload
         )
 
+    def _get_email_wire(self, client_soc: socket.socket,
+                        payload: gloutils.EmailChoicePayload) -> _Response:
+        """
+        Variante de `_get_email` qui retourne le courriel au format de
+        transmission, tel qu'il est stocké: le fichier est projeté en
+        mémoire et transmis sans être analysé ni sérialisé de nouveau.
+        """
+        username = self._logged_users[client_soc]
+        wire = self._storage.fetch_message_wire(username, payload["choice"])
+        if wire is None:
+            return self._get_email(client_soc, payload)
+        return wire
+
     def _get_stats(self, client_soc: socket.socket) -> gloutils.GloMessage:
         """
         Récupère le nombre de courriels et la taille du dossier et des fichiers
-        de l'utilisateur associé au socket.
+        de l'utilisateur associé au socket, ainsi que l'espace qu'ils occupent
+        réellement une fois les contenus partagés comptés au prorata.
         """
         username = self._logged_users[client_soc]
 
-        path = os.path.join(self._SERVER_LOST_DIR, username.lower())
-        user_path = pathlib.Path(path)
-        counter = 0
-        size = 0
-        for file in user_path.iterdir():
-            if os.path.basename(file) != gloutils.PASSWORD_FILENAME:
-                counter += 1
-                size += os.path.getsize(file)
+        counter, size = self._storage.stats(username)
 
         payload = gloutils.StatsPayload(
             count=counter,
-            size=size
+            size=size,
+            physical_size=self._storage.physical_size(username)
         )
         return gloutils.GloMessage(
             header=gloutils.Headers.OK,
@@ -278,17 +696,108 @@ class Server:
     def _send_email(self, payload: gloutils.EmailContentPayload
                     ) -> gloutils.GloMessage:
         """
-        Détermine si l'envoi est interne ou externe et:
-        - Si l'envoi est interne, écris le message tel quel dans le dossier
-        du destinataire.
-        - Si le destinataire n'existe pas, place le message dans le dossier
-        SERVER_LOST_DIR et considère l'envoi comme un échec.
+        Détermine, pour chaque destinataire, si l'envoi est interne ou
+        externe et:
+        - Si l'envoi est interne, écris le message dans le dossier
+        du destinataire. Le contenu n'est stocké qu'une fois pour tous.
+        - Si le destinataire n'existe pas, conserve le message parmi les
+        courriels perdus, qui lui seront remis à la création de son compte,
+        et considère l'envoi comme un échec.
         - Si le destinataire est externe, considère l'envoi comme un échec.
 
-        Retourne un messange indiquant le succès ou l'échec de l'opération.
+        Retourne un messange indiquant le succès ou l'échec de l'opération
+        pour chaque destinataire, une fois la remise durable (voir
+        glostorage.GroupCommit).
+        """
+
+        recipients = self._resolve_recipients(payload["destination"])
+        if not isinstance(recipients, tuple):
+            return recipients
+        usernames, lost, results = recipients
+        response = self._delivery_report(results)
+        if not usernames and not lost:
+            return response
+        with glostorage.track_writes() as written:
+            self._storage.deliver(usernames, payload, lost)
+        return self._commits.commit(written, response)
+
+    def _resolve_recipients(self, destination: str
+                            ) -> Union[tuple[list[str], list[str],
+                                             list[gloutils.RecipientResult]],
+                                       gloutils.GloMessage]:
         """
+        Analyse les adresses, séparées par RECIPIENT_SEPARATOR, du champ
+        `destination`.
+
+        Retourne les noms des destinataires existants, ceux des
+        destinataires internes introuvables (le courriel est alors conservé
+        parmi les courriels perdus) et le résultat prévu pour chaque
+        adresse, ou un message d'erreur s'il y a trop d'adresses.
+        """
+        addresses = list(dict.fromkeys(
+            address.strip()
+            for address in destination.split(gloutils.RECIPIENT_SEPARATOR)
+            if address.strip()))
+        if len(addresses) > gloutils.MAX_RECIPIENTS:
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                    error_message="Trop de destinataires")
+            )
+        usernames: dict[str, None] = {}
+        lost: dict[str, None] = {}
+        results = []
+        for address in addresses or [destination]:
+            username = self._check_destination(address)
+            if not isinstance(username, str):
+                results.append(gloutils.RecipientResult(
+                    destination=address,
+                    error_message=username["payload"]["error_message"]))
+            elif self._storage.user_exists(username):
+                usernames[username.lower()] = None
+                results.append(gloutils.RecipientResult(destination=address))
+            else:
+                lost[username.lower()] = None
+                results.append(gloutils.RecipientResult(
+                    destination=address,
+                    error_message=self._lost_response()[
+                        "payload"]["error_message"]))
+        return list(usernames), list(lost), results
+
+    def _delivery_report(self, results: list[gloutils.RecipientResult]
+                         ) -> gloutils.GloMessage:
+        """
+        Réponse à un envoi, avec le résultat pour chaque destinataire: un
+        succès si au moins l'un d'eux a reçu le courriel, sinon une erreur.
+        Si l'un d'eux ne l'a pas reçu, le message d'erreur est celui de
+        l'unique destinataire ou résume les échecs.
+        """
+        failures = [result for result in results if "error_message" in result]
+        if not failures:
+            return gloutils.GloMessage(
+                header=gloutils.Headers.OK,
+                payload=gloutils.DeliveryReportPayload(results=results)
+            )
+        if len(results) == 1:
+            error_message = failures[0]["error_message"]
+        else:
+            error_message = "Courriel non remis à " + ", ".join(
+                f"{result['destination']} ({result['error_message']})"
+                for result in failures)
+        delivered = len(failures) < len(results)
+        return gloutils.GloMessage(
+            header=(gloutils.Headers.OK if delivered
+                    else gloutils.Headers.ERROR),
+            payload=gloutils.DeliveryReportPayload(
+                results=results, error_message=error_message)
+        )
 
-        dest = payload["destination"]
+    def _check_destination(self, dest: str
+                           ) -> Union[str, gloutils.GloMessage]:
+        """
+        Retourne le nom d'utilisateur du destinataire, ou le message
+        d'erreur à transmettre si l'adresse n'est pas valide ou externe.
+        """
         try:
             username = dest[:dest.index('@')]
             domain = dest[dest.index('@') + 1:]
@@ -302,7 +811,6 @@ class Server:
             )
         
 
-        dest_path = os.path.join(self._SERVER_LOST_DIR, username.lower())
         if domain != gloutils.SERVER_DOMAIN:
             error_payload = gloutils.ErrorPayload(
                error_message= "Destinateur externe non pas pris en compte"
@@ -311,94 +819,861 @@ class Server:
                 header=gloutils.Headers.ERROR,
                 payload=error_payload
             )
-        
-        if os.path.exists(dest_path):
-            filename = f"{gloutils.get_current_utc_time()}.json"
-            file_path = os.path.join(dest_path, filename)
-            with open(file_path, "w") as json_file:
-                json.dump(payload, json_file)
+        return username
 
+    def _lost_response(self) -> gloutils.GloMessage:
+        """Réponse à l'envoi d'un courriel au destinataire introuvable."""
+        error_payload = gloutils.ErrorPayload(
+            error_message="Destinataire introuvable"
+        )
+        return gloutils.GloMessage(
+            header=gloutils.Headers.ERROR,
+            payload=error_payload
+        )
+
+    def _start_upload(self, client_soc: socket.socket,
+                      payload: gloutils.EmailStreamStartPayload) -> None:
+        """
+        Commence la réception d'un courriel transmis par morceaux. Le
+        contenu est écrit dans le stockage au fur et à mesure; la réponse,
+        la même que pour `_send_email`, n'est transmise qu'à la fin.
+        """
+        self._abort_upload(client_soc)
+        recipients = self._resolve_recipients(payload["destination"])
+        if not isinstance(recipients, tuple):
+            self._uploads[client_soc] = (None, recipients)
+            return
+        usernames, lost, results = recipients
+        writer = None
+        if usernames or lost:
+            writer = self._storage.open_delivery(usernames, payload, lost)
+        self._uploads[client_soc] = (writer, self._delivery_report(results))
+
+    def _upload_chunk(self, client_soc: socket.socket,
+                      payload: gloutils.EmailChunkPayload) -> None:
+        """Ajoute un morceau au courriel en cours de réception."""
+        writer, _ = self._uploads.get(client_soc, (None, None))
+        if writer is not None:
+            writer.write(payload["data"])
+
+    def _finish_upload(self, client_soc: socket.socket
+                       ) -> _Response:
+        """
+        Termine la réception du courriel et retourne la réponse, une fois
+        la remise durable.
+        """
+        writer, response = self._uploads.pop(client_soc, (None, None))
+        if response is None:
+            error_payload = gloutils.ErrorPayload(
+                error_message="Aucun courriel en cours de transmission"
+            )
             return gloutils.GloMessage(
-                header=gloutils.Headers.OK,
+                header=gloutils.Headers.ERROR,
+                payload=error_payload
             )
-        
-        elif not os.path.exists(dest_path):
-            
-            lost_file = os.path.join(self._SERVER_LOST_DIR, gloutils.SERVER_LOST_DIR)
-            filename = f"{gloutils.get_current_utc_time()}.json"
-            file_path = os.path.join(lost_file, filename)
-            with open(file_path, "w") as json_file:
-                json.dump(payload, json_file)
+        if writer is None:
+            return response
+        with glostorage.track_writes() as written:
+            writer.commit()
+        return self._commits.commit(written, response)
+
+    def _abort_upload(self, client_soc: socket.socket) -> None:
+        """Abandonne le courriel en cours de réception, s'il y en a un."""
+        writer, _ = self._uploads.pop(client_soc, (None, None))
+        if writer is not None:
+            writer.abort()
+
+    def _stream_email(self, client_soc: socket.socket,
+                      payload: gloutils.EmailChoicePayload) -> _Response:
+        """
+        Variante de `_get_email` qui transmet le courriel par morceaux:
+        son en-tête avec EMAIL_STREAM_START, son contenu en messages
+        EMAIL_STREAM_CHUNK d'au plus STREAM_CHUNK_SIZE caractères, puis
+        EMAIL_STREAM_END. Les morceaux sont lus au fur et à mesure de
+        leur transmission.
+        """
+        username = self._logged_users[client_soc]
+        stream = self._storage.stream_message(username, payload["choice"],
+                                              gloutils.STREAM_CHUNK_SIZE)
+        if stream is None:
+            return self._get_email(client_soc, payload)
+        header, chunks = stream
+
+        def _messages() -> Iterator[gloutils.GloMessage]:
+            yield gloutils.GloMessage(
+                header=gloutils.Headers.EMAIL_STREAM_START,
+                payload=header
+            )
+            for chunk in chunks:
+                yield gloutils.GloMessage(
+                    header=gloutils.Headers.EMAIL_STREAM_CHUNK,
+                    payload=gloutils.EmailChunkPayload(data=chunk)
+                )
+            yield gloutils.GloMessage(header=gloutils.Headers.EMAIL_STREAM_END)
+
+        return _messages()
+
+    def _hello(self, payload: gloutils.HelloPayload, codec: str,
+               compress: bool) -> tuple[gloutils.GloMessage, str, bool]:
+        """
+        Retient le premier codec et la première compression proposés par le
+        client que le serveur connaît.
+
+        Retourne la réponse, à transmettre avec les réglages courants
+        `codec` et `compress`, puis les réglages à utiliser pour les
+        messages suivants. Ils restent inchangés si aucun codec n'est commun.
+        """
+        codecs = [name for name in payload.get("codecs", [])
+                  if name in gloutils.CODECS]
+        if not codecs:
             error_payload = gloutils.ErrorPayload(
-                error_message="Destinataire introuvable"
+                error_message="Aucun codec commun"
             )
             return gloutils.GloMessage(
                 header=gloutils.Headers.ERROR,
                 payload=error_payload
+            ), codec, compress
+        compression = [name for name in payload.get("compression", [])
+                       if name in gloutils.COMPRESSIONS][:1]
+        return gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.HelloPayload(codecs=codecs[:1],
+                                          compression=compression)
+        ), codecs[0], bool(compression)
+
+    def _is_admin(self, client_soc: socket.socket) -> bool:
+        """Indique si l'utilisateur associé au socket est administrateur."""
+        username = self._logged_users.get(client_soc)
+        return username is not None and username.lower() in self._admins
+
+    def _get_metrics(self, client_soc: socket.socket
+                     ) -> gloutils.GloMessage:
+        """
+        Retourne les métriques du processus serveur à un administrateur.
+        """
+        if not self._is_admin(client_soc):
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                    error_message="Seul un administrateur peut consulter"
+                                  " les métriques")
             )
+        return gloutils.GloMessage(
+            header=gloutils.Headers.OK,
+            payload=gloutils.MetricsPayload(
+                metrics=self._metrics.snapshot())
+        )
 
-    def run(self):
+    def _request_profile(self, client_soc: socket.socket
+                         ) -> gloutils.GloMessage:
+        """
+        Ouvre une fenêtre de profilage à la demande d'un administrateur.
+        """
+        if not self._is_admin(client_soc):
+            error_message = "Seul un administrateur peut profiler le serveur"
+        elif self._profiler is None:
+            error_message = "Le profilage n'est pas activé"
+        elif not self.start_profile():
+            error_message = "Un profilage est déjà en cours"
+        else:
+            return gloutils.GloMessage(header=gloutils.Headers.OK)
+        return gloutils.GloMessage(
+            header=gloutils.Headers.ERROR,
+            payload=gloutils.ErrorPayload(error_message=error_message)
+        )
+
+    def _handle(self, client_soc: socket.socket,
+                message: gloutils.GloMessage) -> Optional[_Response]:
+        """
+        Exécute `_dispatch`, profilé si une fenêtre de profilage est
+        ouverte, et enregistre la durée du traitement.
+        """
+        start = time.perf_counter()
+        try:
+            if self._profiler is not None:
+                return self._profiler.run(self._dispatch, client_soc,
+                                          message)
+            return self._dispatch(client_soc, message)
+        finally:
+            self._metrics.record(message.get("header"),
+                                 glometrics.STAGE_HANDLER,
+                                 time.perf_counter() - start)
+
+    def _dispatch(self, client_soc: socket.socket,
+                  message: gloutils.GloMessage
+                  ) -> Optional[_Response]:
+        """
+        Exécute le traitement associé à l'entête de la requête.
+
+        Retourne la réponse à transmettre au client, ou None si
+        l'entête n'appelle pas de réponse.
+        """
+        header = message.get("header")
+        payload = message.get("payload")
+        if header in _SESSION_HEADERS and client_soc not in self._logged_users:
+            return gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                    error_message="Aucun utilisateur n'est connecte")
+            )
+        match header:
+            case gloutils.Headers.AUTH_LOGIN:
+                return self._login(client_soc, payload)
+            case gloutils.Headers.AUTH_REGISTER:
+                return self._create_account(client_soc, payload)
+            case gloutils.Headers.AUTH_RESUME:
+                return self._resume(client_soc, payload)
+            case gloutils.Headers.AUTH_LOGOUT:
+                self._logout(client_soc, revoke=True)
+            case gloutils.Headers.INBOX_READING_REQUEST:
+                return self._get_email_list(client_soc)
+            case gloutils.Headers.INBOX_PAGE_REQUEST:
+                return self._get_email_page(client_soc, payload)
+            case gloutils.Headers.INBOX_READING_CHOICE:
+                if payload.get("stream"):
+                    return self._stream_email(client_soc, payload)
+                return self._get_email_wire(client_soc, payload)
+            case gloutils.Headers.EMAIL_SENDING:
+                return self._send_email(payload)
+            case gloutils.Headers.STATS_REQUEST:
+                return self._get_stats(client_soc)
+            case gloutils.Headers.EMAIL_STREAM_START:
+                self._start_upload(client_soc, payload)
+            case gloutils.Headers.EMAIL_STREAM_CHUNK:
+                self._upload_chunk(client_soc, payload)
+            case gloutils.Headers.EMAIL_STREAM_END:
+                return self._finish_upload(client_soc)
+            case gloutils.Headers.METRICS_REQUEST:
+                return self._get_metrics(client_soc)
+            case gloutils.Headers.PROFILE_REQUEST:
+                return self._request_profile(client_soc)
+            case gloutils.Headers.SEARCH_REQUEST:
+                return self._search_emails(client_soc, payload)
+        return None
+
+    def _schedule(self, connection: _Connection) -> None:
+        """
+        Ajuste les événements surveillés pour le client: écriture tant que
+        des réponses sont en attente, lecture et traitement des requêtes
+        déjà reçues tant que la file de réponses n'est pas trop longue.
+        """
+        pending = connection.pending_output()
+        accepting = not connection.closing and pending < _MAX_PENDING_OUTPUT
+        if (accepting and not connection.busy and connection.stream is None
+                and connection.decoder.has_frames):
+            self._backlog.add(connection)
+        else:
+            self._backlog.discard(connection)
+
+        events = selectors.EVENT_WRITE if pending else 0
+        if accepting or not events:
+            events |= selectors.EVENT_READ
+        if events != connection.events:
+            connection.events = events
+            self._selector.modify(connection.socket, events, connection)
+
+    def _pump(self, connection: _Connection) -> None:
+        """
+        Produit les messages suivants de la réponse transmise par morceaux,
+        tant que les réponses en attente restent sous _STREAM_WINDOW.
+        """
+        while (connection.stream is not None
+               and connection.pending_output() < _STREAM_WINDOW):
+            try:
+                message = next(connection.stream, None)
+            except (OSError, ValueError):
+                # Courriel illisible: la réponse ne peut être terminée.
+                connection.stream = None
+                connection.closing = True
+                return
+            if message is None:
+                connection.stream = None
+            else:
+                self._queue_response(connection, message)
+
+    def _flush(self, connection: _Connection) -> None:
+        """
+        Transmet les réponses en attente sans bloquer, en produisant au
+        besoin les morceaux suivants d'une réponse transmise par morceaux.
+        """
+        try:
+            while True:
+                self._pump(connection)
+                start = time.perf_counter()
+                glosocket.send_available(connection.socket,
+                                         connection.outgoing)
+                self._metrics.send.record(time.perf_counter() - start)
+                if connection.outgoing or connection.stream is None:
+                    break
+        except glosocket.GLOSocketError:
+            self._remove_client(connection.socket)
+            return
+        if connection.closing and not connection.outgoing:
+            self._remove_client(connection.socket)
+            return
+        self._schedule(connection)
+
+    def _encode_response(self, response: _Response, codec: str
+                         ) -> Union[bytes, memoryview]:
+        """
+        Sérialise la réponse avec le codec du client. Une réponse déjà
+        encodée est au format de transmission JSON: elle n'est transmise
+        telle quelle qu'aux clients qui utilisent ce codec.
+
+        Une réponse qui dépasse MAX_FRAME_SIZE, que le client refuserait,
+        est remplacée par une erreur: seul un très gros courriel lu sans
+        transmission par morceaux peut atteindre cette taille.
+        """
+        if isinstance(response, dict):
+            data = gloutils.encode_message(response, codec)
+        elif codec != gloutils.CODEC_JSON:
+            data = gloutils.encode_message(json.loads(bytes(response)), codec)
+        else:
+            data = response
+        if len(data) > glosocket.MAX_FRAME_SIZE:
+            return gloutils.encode_message(gloutils.GloMessage(
+                header=gloutils.Headers.ERROR,
+                payload=gloutils.ErrorPayload(
+                    error_message="Le courriel est trop volumineux pour etre"
+                                  " transmis en un seul message")
+            ), codec)
+        return data
+
+    def _queue_response(self, connection: _Connection,
+                        response: _Response) -> None:
+        """
+        Ajoute une réponse à la file d'envoi du client. Une réponse
+        transmise par morceaux est produite par `_pump`.
+        """
+        if isinstance(response, collections.abc.Iterator):
+            connection.stream = response
+            return
+        start = time.perf_counter()
+        frames = glosocket.frame_bytes(
+            self._encode_response(response, connection.codec),
+            connection.compress)
+        self._metrics.record(connection.header, glometrics.STAGE_SERIALIZE,
+                             time.perf_counter() - start)
+        for frame in frames:
+            self._metrics.bytes_out += len(frame)
+        if (isinstance(response, dict)
+                and response.get("header") == gloutils.Headers.ERROR):
+            self._metrics.record_error(connection.header)
+        connection.outgoing.extend(frames)
+
+    def _process_frames(self, connection: _Connection) -> None:
+        """
+        Traite un nombre borné de requêtes complètes du client, puis tente
+        de transmettre les réponses produites.
+        """
+        for _ in range(_FRAMES_PER_WAKEUP):
+            if (connection.busy or connection.stream is not None
+                    or connection.pending_output() >= _MAX_PENDING_OUTPUT):
+                break
+            start = time.perf_counter()
+            try:
+                frame = connection.decoder.next_frame(connection.compress)
+                if frame is None:
+                    break
+                message = gloutils.decode_message(frame, connection.codec)
+            except (glosocket.GLOSocketError, ValueError):
+                connection.closing = True
+                break
+            connection.header = message.get("header")
+            self._metrics.record(connection.header, glometrics.STAGE_PARSE,
+                                 time.perf_counter() - start)
+            if message.get("header") == gloutils.Headers.BYE:
+                connection.closing = True
+                break
+            if message.get("header") == gloutils.Headers.HELLO:
+                response, codec, compress = self._hello(
+                    message.get("payload", {}), connection.codec,
+                    connection.compress)
+                self._queue_response(connection, response)
+                connection.codec, connection.compress = codec, compress
+                continue
+            if (self._executor is not None
+                    and message.get("header") in _POOLED_HEADERS):
+                self._submit_job(connection, message)
+                continue
+            try:
+                response = self._handle(connection.socket, message)
+            except Exception:
+                # Comme pour les traitements du bassin (`_finish_jobs`),
+                # seul le client fautif est déconnecté.
+                self._remove_client(connection.socket)
+                return
+            if isinstance(response, concurrent.futures.Future):
+                self._defer(connection, response)
+                break
+            if response is not None:
+                self._queue_response(connection, response)
+        self._flush(connection)
+
+    def _submit_job(self, connection: _Connection,
+                    message: gloutils.GloMessage) -> None:
+        """
+        Confie la requête au bassin de fils d'exécution, ou la met en file
+        si la limite de traitements simultanés de son entête est atteinte.
+        """
+        connection.busy = True
+        header = message["header"]
+        limit = self._queue_limits.get(header)
+        if limit is not None and self._jobs_running[header] >= limit:
+            self._jobs_waiting[header].append((connection, message))
+        else:
+            self._start_job(connection, message)
+
+    def _start_job(self, connection: _Connection,
+                   message: gloutils.GloMessage) -> None:
+        """Soumet le traitement de la requête au bassin."""
+        header = message["header"]
+        self._jobs_running[header] += 1
+        future = self._executor.submit(self._handle, connection.socket,
+                                       message)
+        future.add_done_callback(
+            functools.partial(self._job_done, connection, header))
+
+    def _defer(self, connection: _Connection,
+               response: concurrent.futures.Future) -> None:
+        """
+        Attend une réponse différée: comme pendant un traitement du bassin,
+        les requêtes suivantes du client attendent qu'elle soit transmise.
+        """
+        connection.busy = True
+        response.add_done_callback(
+            functools.partial(self._job_done, connection, None))
+
+    def _job_done(self, connection: _Connection,
+                  header: Optional[gloutils.Headers],
+                  future: concurrent.futures.Future) -> None:
+        """
+        Appelée par le fil d'exécution qui a terminé le traitement, ou
+        produit la réponse différée (`header` None): le signale à la
+        boucle principale, seule à manipuler les connexions.
+        """
+        self._completed.put((connection, header, future))
+        try:
+            self._wakeup_send.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def _finish_jobs(self) -> None:
+        """Transmet les réponses des traitements terminés."""
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
         while True:
             try:
-            # Use select to wait for readable sockets
-                readable, _, _ = select.select([self._server_socket] +
-                                                self._client_socs, [], [])
+                connection, header, future = self._completed.get_nowait()
+            except queue.Empty:
+                return
+            if header is not None:
+                self._jobs_running[header] -= 1
+                waiting = self._jobs_waiting[header]
+                while waiting:
+                    next_connection, next_message = waiting.popleft()
+                    if next_connection.socket in self._connections:
+                        self._start_job(next_connection, next_message)
+                        break
+                    self._abort_upload(next_connection.socket)
+
+            connection.busy = False
+            if connection.socket not in self._connections:
+                self._logout(connection.socket)
+                self._abort_upload(connection.socket)
+                continue
+            try:
+                response = future.result()
+            except Exception:
+                self._remove_client(connection.socket)
+                continue
+            if isinstance(response, concurrent.futures.Future):
+                self._defer(connection, response)
+                continue
+            if response is not None:
+                self._queue_response(connection, response)
+            self._flush(connection)
+
+    def _read_ready(self, connection: _Connection) -> None:
+        """Lit les octets disponibles du client et traite ses requêtes."""
+        start = time.perf_counter()
+        try:
+            received = connection.socket.recv_into(self._recv_buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._remove_client(connection.socket)
+            return
+        if not received:
+            self._remove_client(connection.socket)
+            return
+        self._metrics.recv.record(time.perf_counter() - start)
+        self._metrics.bytes_in += received
+        try:
+            connection.decoder.feed(memoryview(self._recv_buffer)[:received])
+        except glosocket.GLOSocketError:
+            self._remove_client(connection.socket)
+            return
+        self._process_frames(connection)
+
+    def run(self):
+        """
+        Boucle principale du serveur, basée sur le module selectors.
+
+        Les sockets clients sont non bloquants: une requête reçue
+        partiellement reste dans le décodeur de sa connexion et une réponse
+        volumineuse est transmise par morceaux, sans jamais bloquer les
+        autres clients. Chaque réveil ne coûte que le nombre de sockets
+        actifs.
 
-                for sock in readable:
-                    if sock == self._server_socket:
+        Lorsque le bassin de fils d'exécution est activé, les traitements
+        coûteux y sont exécutés et leurs réponses sont transmises dès
+        qu'ils se terminent.
+        """
+        self._server_socket.setblocking(False)
+        self._selector.register(self._server_socket, selectors.EVENT_READ)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ)
+        while True:
+            try:
+                timeout = self._periodic()
+                if self._backlog:
+                    timeout = 0
+                for key, events in self._selector.select(timeout):
+                    if key.fileobj is self._server_socket:
                         self._accept_client()
-                    else:
-                        try:
-                            message = glosocket.recv_mesg(sock)
-                            header = json.loads(message)["header"]
-                        except glosocket.GLOSocketError:
-                            header = None
-                            self._remove_client(sock)
-                            self._logout(sock)
-                            sock.close()
-
-
-                        if header == gloutils.Headers.AUTH_LOGIN:
-                            payload = json.loads(message)["payload"]
-                            message = self._login(sock, payload)
-                            glosocket.send_mesg(sock, json.dumps(message))
-                        elif header == gloutils.Headers.AUTH_REGISTER:
-                             payload = json.loads(message)["payload"]
-                             message = self._create_account(sock, payload)
-                             glosocket.send_mesg(sock, json.dumps(message))
-                        elif header == gloutils.Headers.BYE:
-                            self._remove_client(sock)
-                        elif header == gloutils.Headers.INBOX_READING_REQUEST:
-                            message = self._get_email_list(sock)
-                            glosocket.send_mesg(sock, json.dumps(message))
-                        elif header == gloutils.Headers.INBOX_READING_CHOICE:
-                            payload = json.loads(message)["payload"]
-                            message = self._get_email(sock, payload)
-                            glosocket.send_mesg(sock, json.dumps(message))
-                        elif header == gloutils.Headers.EMAIL_SENDING:
-                            payload = json.loads(message)["payload"]
-                            message = self._send_email(payload)
-                            glosocket.send_mesg(sock, json.dumps(message))
-                        elif header == gloutils.Headers.AUTH_LOGOUT:
-                            self._logout(sock)
-                        elif header == gloutils.Headers.STATS_REQUEST:
-                            message= self._get_stats(sock)
-                            glosocket.send_mesg(sock, json.dumps(message))
-                                
+                        continue
+                    if key.fileobj is self._wakeup_recv:
+                        self._finish_jobs()
+                        continue
+                    connection = key.data
+                    if events & selectors.EVENT_WRITE:
+                        self._flush(connection)
+                    if (events & selectors.EVENT_READ
+                            and connection.socket in self._connections):
+                        self._read_ready(connection)
+
+                for connection in list(self._backlog):
+                    if connection.socket in self._connections:
+                        self._process_frames(connection)
 
             except KeyboardInterrupt:
                 # Handle keyboard interrupt to gracefully exit the server
                 self.cleanup()
                 break
 
+    async def _handle_stream(self, reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter) -> None:
+        """
+        Sert un client du moteur asyncio jusqu'à sa déconnexion.
 
+        Le StreamWriter tient lieu de socket client dans `_logged_users`.
+        Les traitements, qui accèdent au disque ou calculent des hachages,
+        sont exécutés dans `_executor` pour ne pas bloquer la boucle.
+        """
+        loop = asyncio.get_running_loop()
+        codec = gloutils.CODEC_JSON
+        compress = False
+        self._metrics.opened()
 
-def _main() -> int:
-    server = Server()
+        async def _respond(header, response: _Response) -> None:
+            start = time.perf_counter()
+            data = self._encode_response(response, codec)
+            self._metrics.record(header, glometrics.STAGE_SERIALIZE,
+                                 time.perf_counter() - start)
+            self._metrics.bytes_out += len(data) + 4
+            if (isinstance(response, dict)
+                    and response.get("header") == gloutils.Headers.ERROR):
+                self._metrics.record_error(header)
+            await glosocket.send_mesg_bytes_async(writer, data, compress)
+
+        try:
+            while True:
+                data = await glosocket.recv_mesg_bytes_async(reader,
+                                                             compress)
+                self._metrics.bytes_in += len(data) + 4
+                start = time.perf_counter()
+                message = gloutils.decode_message(data, codec)
+                header = message.get("header")
+                self._metrics.record(header, glometrics.STAGE_PARSE,
+                                     time.perf_counter() - start)
+                if header == gloutils.Headers.BYE:
+                    break
+                if header == gloutils.Headers.HELLO:
+                    response, next_codec, next_compress = self._hello(
+                        message.get("payload", {}), codec, compress)
+                    await _respond(header, response)
+                    codec, compress = next_codec, next_compress
+                    continue
+                response = await loop.run_in_executor(
+                    self._executor, self._handle, writer, message)
+                if isinstance(response, concurrent.futures.Future):
+                    response = await asyncio.wrap_future(response)
+                if isinstance(response, collections.abc.Iterator):
+                    while (part := await loop.run_in_executor(
+                            self._executor, next, response, None)):
+                        await _respond(header, part)
+                elif response is not None:
+                    await _respond(header, response)
+        except Exception:
+            # Erreur de communication, requête invalide ou traitement en
+            # échec: comme avec le moteur selectors, seul ce client est
+            # déconnecté.
+            pass
+        finally:
+            self._metrics.closed()
+            self._logout(writer)
+            self._abort_upload(writer)
+            writer.close()
+
+    async def _periodic_async(self) -> None:
+        """
+        Effectue les tâches périodiques pour le moteur asyncio. Une fenêtre
+        de profilage pouvant être ouverte par un signal, son ouverture est
+        vérifiée chaque seconde.
+        """
+        while True:
+            delay = self._periodic()
+            if self._profiler is not None:
+                delay = 1.0 if delay is None else min(delay, 1.0)
+            elif delay is None:
+                return
+            await asyncio.sleep(delay)
+
+    async def _serve_async(self) -> None:
+        """Sert les clients avec asyncio sur le socket d'écoute existant."""
+        self._server_socket.setblocking(False)
+        server = await asyncio.start_server(self._handle_stream,
+                                            sock=self._server_socket)
+        periodic_task = asyncio.create_task(self._periodic_async())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            periodic_task.cancel()
+
+    def run_async(self) -> None:
+        """
+        Point d'entrée du moteur asyncio, alternative à `run`.
+
+        Chaque client est servi par une coroutine: les connexions inactives
+        ne coûtent rien à la boucle et ne sont pas limitées par FD_SETSIZE.
+        """
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor()
+        try:
+            asyncio.run(self._serve_async())
+        finally:
+            self.cleanup()
+
+
+def _serve_processes(processes: int, serve: Callable[[], None]) -> bool:
+    """
+    Lance `processes` processus exécutant `serve`, chacun avec sa propre
+    boucle et son propre socket d'écoute SO_REUSEPORT: le noyau répartit
+    les nouvelles connexions entre eux. Le stockage est créé dans chaque
+    processus, après le fork.
+
+    Chaque client reste servi par le processus qui l'a accepté, de sorte
+    que `_logged_users` n'a pas à être partagé. Les index des boîtes sont
+    relus lorsqu'un autre processus les modifie (voir
+    glostorage.MailboxIndex).
+
+    Un arrêt du lanceur (SIGINT ou SIGTERM) arrête tous les processus, et
+    SIGUSR1 leur est relayé (voir `--profile`).
+
+    Retourne vrai si tous les processus se sont terminés normalement.
+    """
+    children = []
+    for _ in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            # Le processus enfant ne doit jamais revenir dans l'appelant,
+            # même si `serve` échoue.
+            status = 1
+            try:
+                signal.signal(signal.SIGTERM, signal.default_int_handler)
+                signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+                serve()
+                status = 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+        children.append(pid)
+
+    def _stop(signum, frame) -> None:
+        raise KeyboardInterrupt
+
+    def _forward(signum, frame) -> None:
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGUSR1, _forward)
+    statuses = {}
+    try:
+        for pid in children:
+            statuses[pid] = os.waitpid(pid, 0)[1]
+    except KeyboardInterrupt:
+        for pid in children:
+            if pid in statuses:
+                continue
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            if pid not in statuses:
+                statuses[pid] = os.waitpid(pid, 0)[1]
+    return not any(statuses.values())
+
+
+def _make_storage(kind: str, data_dir: str) -> glostorage.MailStorage:
+    """Crée le moteur de stockage demandé sur la ligne de commande."""
+    if kind == "sqlite":
+        return glostorage.SQLiteStorage(
+            os.path.join(data_dir, gloutils.SQLITE_FILENAME))
+    if kind == "segment":
+        return glostorage.SegmentLogStorage(data_dir)
+    return glostorage.FileSystemStorage(data_dir)
+
+
+def _serve(engine: str, storage: glostorage.MailStorage, workers: int,
+           queue_limits: dict[gloutils.Headers, int],
+           reuse_port: bool = False,
+           session_secret: Optional[bytes] = None,
+           metrics_file: Optional[str] = None,
+           metrics_interval: float = 10.0,
+           profiler: Optional[glometrics.Profiler] = None,
+           admins: frozenset[str] = frozenset(),
+           durability: str = glostorage.DURABILITY_BATCH) -> None:
+    """
+    Crée le serveur et le fait tourner avec le moteur demandé. Avec
+    `profiler`, SIGUSR1 ouvre une fenêtre de profilage.
+    """
+    server = Server(storage, workers, queue_limits, reuse_port,
+                    session_secret, metrics_file, metrics_interval,
+                    profiler, admins, durability)
+    if profiler is not None:
+        signal.signal(signal.SIGUSR1,
+                      lambda signum, frame: server.start_profile())
     try:
-        server.run()
+        if engine == "asyncio":
+            server.run_async()
+        else:
+            server.run()
     except KeyboardInterrupt:
         server.cleanup()
+
+
+def _parse_queue_limit(value: str) -> tuple[gloutils.Headers, int]:
+    """Analyse une limite de traitements simultanés `ENTETE=N`."""
+    name, _, limit = value.partition("=")
+    try:
+        return gloutils.Headers[name.strip().upper()], int(limit)
+    except (KeyError, ValueError) as ex:
+        raise argparse.ArgumentTypeError(
+            f"limite invalide: {value}") from ex
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-e", "--engine", action="store", dest="engine",
+                        choices=["select", "asyncio"], default="select",
+                        help="Moteur de gestion des connexions.")
+    parser.add_argument("-s", "--storage", action="store", dest="storage",
+                        choices=["fs", "segment", "sqlite"], default="fs",
+                        help="Moteur de stockage des comptes et courriels.")
+    parser.add_argument("--compact", action="store_true", dest="compact",
+                        help="Compacte les segments des boîtes puis quitte.")
+    parser.add_argument("-w", "--workers", action="store", type=int,
+                        dest="workers", default=0,
+                        help="Nombre de fils d'exécution pour les "
+                             "traitements coûteux (0: dans la boucle).")
+    parser.add_argument("-q", "--queue-limit", action="append",
+                        type=_parse_queue_limit, dest="queue_limits",
+                        default=[], metavar="ENTETE=N",
+                        help="Nombre maximal de traitements simultanés "
+                             "pour une entête, par exemple EMAIL_SENDING=2.")
+    parser.add_argument("-p", "--processes", action="store", type=int,
+                        dest="processes", default=1,
+                        help="Nombre de processus serveurs partageant le "
+                             "port avec SO_REUSEPORT.")
+    parser.add_argument("--metrics-file", action="store",
+                        dest="metrics_file", default=None,
+                        help="Fichier où écrire périodiquement les métriques "
+                             "en JSON (suffixé du pid de chaque processus "
+                             "avec -p).")
+    parser.add_argument("--metrics-interval", action="store", type=float,
+                        dest="metrics_interval", default=10.0,
+                        help="Intervalle d'écriture des métriques, en "
+                             "secondes.")
+    parser.add_argument("--profile", action="store", dest="profile",
+                        default=None, metavar="DOSSIER",
+                        help="Permet de profiler les traitements sans "
+                             "redémarrer: SIGUSR1 ou l'entête "
+                             "PROFILE_REQUEST ouvre une fenêtre dont les "
+                             "statistiques sont écrites dans le dossier.")
+    parser.add_argument("--profile-window", action="store", type=float,
+                        dest="profile_window", default=10.0,
+                        help="Durée d'une fenêtre de profilage, en "
+                             "secondes.")
+    parser.add_argument("--admin", action="append", dest="admins",
+                        default=[], metavar="UTILISATEUR",
+                        help="Utilisateur autorisé à envoyer "
+                             "METRICS_REQUEST et PROFILE_REQUEST.")
+    parser.add_argument("--durability", action="store", dest="durability",
+                        choices=glostorage.DURABILITIES,
+                        default=glostorage.DURABILITY_BATCH,
+                        help="Confirmation des courriels reçus: sans "
+                             "synchronisation sur disque (none), après une "
+                             "synchronisation groupée avec les autres "
+                             "remises (batch) ou après leur propre "
+                             "synchronisation (sync).")
+    args = parser.parse_args(sys.argv[1:])
+
+    data_dir = _default_data_dir()
+    os.makedirs(data_dir, exist_ok=True)
+    if args.compact:
+        glostorage.SegmentLogStorage(data_dir).compact_all()
+        return 0
+
+    def _profiler() -> Optional[glometrics.Profiler]:
+        if args.profile is None:
+            return None
+        return glometrics.Profiler(args.profile, args.profile_window)
+
+    if args.processes > 1:
+        if not hasattr(socket, "SO_REUSEPORT") or not hasattr(os, "fork"):
+            print("Le mode multiprocessus n'est pas supporté sur ce système.")
+            return 1
+        # La clé des jetons est tirée avant la création des processus pour
+        # qu'un client puisse reprendre sa session auprès de n'importe
+        # lequel d'entre eux.
+        session_secret = os.urandom(32)
+        served = _serve_processes(args.processes, lambda: _serve(
+            args.engine, _make_storage(args.storage, data_dir),
+            args.workers, dict(args.queue_limits), reuse_port=True,
+            session_secret=session_secret,
+            metrics_file=(args.metrics_file and
+                          f"{args.metrics_file}.{os.getpid()}"),
+            metrics_interval=args.metrics_interval,
+            profiler=_profiler(), admins=frozenset(args.admins),
+            durability=args.durability))
+        return 0 if served else 1
+
+    _serve(args.engine, _make_storage(args.storage, data_dir),
+           args.workers, dict(args.queue_limits),
+           metrics_file=args.metrics_file,
+           metrics_interval=args.metrics_interval,
+           profiler=_profiler(), admins=frozenset(args.admins),
+           durability=args.durability)
     return 0
 
 
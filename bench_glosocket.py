@@ -0,0 +1,90 @@
+"""\
+Micro-banc d'essai de la réception de messages de glosocket.
+
+Compare l'ancienne réception (concaténation de morceaux de 4096 octets)
+à la réception par `recv_into` dans un tampon préalloué, pour plusieurs
+tailles de message, sur une paire de sockets locale.
+"""
+import argparse
+import socket
+import struct
+import sys
+import threading
+import time
+from typing import Callable
+
+import glosocket
+
+DEFAULT_SIZES = [1 << 10, 1 << 14, 1 << 18, 1 << 20, 1 << 22, 1 << 24]
+
+
+def _legacy_recvall(source: socket.socket, size: int) -> bytes:
+    """Réception originale, par morceaux de 4096 octets concaténés."""
+    msg = b""
+    while size > 0:
+        buffer = source.recv(min(size, 4096))
+        if not buffer:
+            raise glosocket.GLOSocketError("The other socket is closed.")
+        msg += buffer
+        size -= len(buffer)
+    return msg
+
+
+def _legacy_recv_mesg(source_soc: socket.socket) -> str:
+    """Ancien chemin de réception complet (taille, données, décodage)."""
+    length, = struct.unpack("!I", _legacy_recvall(source_soc, 4))
+    return _legacy_recvall(source_soc, length).decode('utf-8')
+
+
+def _measure(receiver: Callable[[socket.socket], object],
+             size: int, rounds: int) -> float:
+    """
+    Envoie `rounds` messages de `size` octets depuis un fil d'exécution
+    et retourne le temps moyen de réception en secondes.
+    """
+    sender, source = socket.socketpair()
+    message = "x" * size
+
+    def _send_all() -> None:
+        for _ in range(rounds):
+            glosocket.send_mesg(sender, message)
+
+    thread = threading.Thread(target=_send_all, daemon=True)
+    thread.start()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        receiver(source)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    sender.close()
+    source.close()
+    return elapsed / rounds
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-r", "--rounds", action="store", type=int,
+                        dest="rounds", default=20,
+                        help="Nombre de messages par mesure.")
+    parser.add_argument("-s", "--sizes", action="store", type=int,
+                        nargs="+", dest="sizes", default=DEFAULT_SIZES,
+                        help="Tailles de message à mesurer, en octets.")
+    args = parser.parse_args(sys.argv[1:])
+
+    receivers = [
+        ("legacy", _legacy_recv_mesg),
+        ("recv_mesg", glosocket.recv_mesg),
+        ("recv_mesg_bytes", glosocket.recv_mesg_bytes),
+    ]
+    print(f"{'taille':>10} " + " ".join(f"{name:>16}"
+                                        for name, _ in receivers))
+    for size in args.sizes:
+        timings = [_measure(receiver, size, args.rounds)
+                   for _, receiver in receivers]
+        print(f"{size:>10} " + " ".join(f"{timing * 1e3:>13.3f} ms"
+                                        for timing in timings))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
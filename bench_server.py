@@ -0,0 +1,290 @@
+"""\
+Générateur de charge et banc d'essai du serveur mail.
+
+Ouvre plusieurs connexions simultanées vers un serveur local, crée ou
+connecte un utilisateur synthétique par connexion, puis envoie pendant une
+durée donnée un mélange pondéré de requêtes `EMAIL_SENDING`,
+`INBOX_READING_REQUEST`, `INBOX_READING_CHOICE` et `STATS_REQUEST`.
+Affiche le débit et les latences p50/p99 de chaque entête.
+
+Exemple, contre un serveur lancé avec `python TP4_server.py -s sqlite`:
+
+    python bench_server.py -c 16 -t 10 -m EMAIL_SENDING=1 STATS_REQUEST=4
+"""
+import argparse
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+import glosocket
+import gloutils
+
+# Pondération par défaut des entêtes envoyées.
+DEFAULT_MIX = {
+    gloutils.Headers.EMAIL_SENDING: 2,
+    gloutils.Headers.INBOX_READING_REQUEST: 1,
+    gloutils.Headers.INBOX_READING_CHOICE: 4,
+    gloutils.Headers.STATS_REQUEST: 2,
+    # Absente par défaut, pour que les mesures restent comparables;
+    # `-m SEARCH_REQUEST=N` l'ajoute au mélange.
+    gloutils.Headers.SEARCH_REQUEST: 0,
+}
+# Mot de passe des utilisateurs synthétiques, conforme aux règles du
+# serveur.
+_PASSWORD = "Benchmark2000"  # nosec:B105
+
+
+class _Session:
+    """
+    Connexion d'un utilisateur synthétique: transmet les requêtes du
+    mélange et mesure la latence de chacune.
+
+    `latencies` associe chaque entête aux latences mesurées en secondes, et
+    `errors` au nombre de réponses d'erreur reçues.
+    """
+
+    def __init__(self, destination: str, username: str, peers: list[str],
+                 codec: str, body: str, seed: int) -> None:
+        self._socket = socket.create_connection(
+            (destination, gloutils.APP_PORT))
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._codec = gloutils.CODEC_JSON
+        self._username = username
+        self._peers = peers
+        self._body = body
+        self._random = random.Random(seed)
+        # Nombre de courriels connus de la boîte, pour choisir un courriel
+        # existant avec INBOX_READING_CHOICE.
+        self._inbox_count = 0
+        self.latencies: dict[gloutils.Headers, list[float]] = {
+            header: [] for header in DEFAULT_MIX}
+        self.errors: dict[gloutils.Headers, int] = {
+            header: 0 for header in DEFAULT_MIX}
+        if codec != gloutils.CODEC_JSON:
+            response = self._request(gloutils.GloMessage(
+                header=gloutils.Headers.HELLO,
+                payload=gloutils.HelloPayload(codecs=[codec])))
+            if response["header"] == gloutils.Headers.OK:
+                self._codec = response["payload"]["codecs"][0]
+
+    def _request(self, message: gloutils.GloMessage) -> gloutils.GloMessage:
+        """Transmet une requête et retourne la réponse du serveur."""
+        glosocket.send_mesg_bytes(
+            self._socket, gloutils.encode_message(message, self._codec))
+        return gloutils.decode_message(
+            glosocket.recv_mesg_bytes(self._socket), self._codec)
+
+    def authenticate(self) -> None:
+        """
+        Crée le compte de l'utilisateur, ou s'y connecte s'il existe déjà,
+        puis s'envoie un premier courriel pour que sa boîte ne soit pas
+        vide.
+        """
+        credentials = gloutils.AuthPayload(username=self._username,
+                                           password=_PASSWORD)
+        response = self._request(gloutils.GloMessage(
+            header=gloutils.Headers.AUTH_REGISTER, payload=credentials))
+        if response["header"] != gloutils.Headers.OK:
+            response = self._request(gloutils.GloMessage(
+                header=gloutils.Headers.AUTH_LOGIN, payload=credentials))
+        if response["header"] != gloutils.Headers.OK:
+            raise RuntimeError(response["payload"]["error_message"])
+        self._request(self._email(self._username))
+        response = self._request(gloutils.GloMessage(
+            header=gloutils.Headers.STATS_REQUEST))
+        self._inbox_count = response["payload"]["count"]
+
+    def _email(self, recipient: str) -> gloutils.GloMessage:
+        """Construit un courriel synthétique pour le destinataire."""
+        return gloutils.GloMessage(
+            header=gloutils.Headers.EMAIL_SENDING,
+            payload=gloutils.EmailContentPayload(
+                sender=f"{self._username}@{gloutils.SERVER_DOMAIN}",
+                destination=f"{recipient}@{gloutils.SERVER_DOMAIN}",
+                subject=f"Banc d'essai {self._random.randrange(1 << 16)}",
+                date=gloutils.get_current_utc_time(),
+                content=self._body))
+
+    def _build(self, header: gloutils.Headers) -> gloutils.GloMessage:
+        """Construit une requête synthétique pour l'entête."""
+        match header:
+            case gloutils.Headers.EMAIL_SENDING:
+                return self._email(self._random.choice(self._peers))
+            case gloutils.Headers.INBOX_READING_CHOICE:
+                return gloutils.GloMessage(
+                    header=header,
+                    payload=gloutils.EmailChoicePayload(
+                        choice=self._random.randint(1, self._inbox_count)))
+            case gloutils.Headers.SEARCH_REQUEST:
+                # Un numéro de sujet tiré au hasard, comme ceux des
+                # courriels synthétiques.
+                return gloutils.GloMessage(
+                    header=header,
+                    payload=gloutils.SearchRequestPayload(
+                        query=f"essai {self._random.randrange(1 << 16)}"))
+        return gloutils.GloMessage(header=header)
+
+    def run(self, headers: list[gloutils.Headers], weights: list[int],
+            start: threading.Barrier, deadline: list[float]) -> None:
+        """
+        Attend les autres connexions puis envoie des requêtes tirées selon
+        les poids donnés jusqu'à l'échéance `deadline[0]`.
+        """
+        start.wait()
+        while True:
+            header, = self._random.choices(headers, weights)
+            request = self._build(header)
+            sent = time.perf_counter()
+            if sent >= deadline[0]:
+                break
+            response = self._request(request)
+            self.latencies[header].append(time.perf_counter() - sent)
+            if response["header"] == gloutils.Headers.ERROR:
+                self.errors[header] += 1
+            elif header == gloutils.Headers.STATS_REQUEST:
+                self._inbox_count = response["payload"]["count"]
+            elif header == gloutils.Headers.INBOX_READING_REQUEST:
+                self._inbox_count = len(response["payload"]["email_list"])
+
+    def close(self) -> None:
+        """Prévient le serveur avec l'entête `BYE` et ferme le socket."""
+        try:
+            glosocket.send_mesg_bytes(self._socket, gloutils.encode_message(
+                gloutils.GloMessage(header=gloutils.Headers.BYE),
+                self._codec))
+        except glosocket.GLOSocketError:
+            pass
+        self._socket.close()
+
+
+def _percentile(samples: list[float], fraction: float) -> float:
+    """Retourne le centile des échantillons triés (plus proche rang)."""
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+
+def _parse_weight(value: str) -> tuple[gloutils.Headers, int]:
+    """Analyse une pondération `ENTETE=N` du mélange de requêtes."""
+    name, _, weight = value.partition("=")
+    try:
+        header = gloutils.Headers[name.strip().upper()]
+        if header not in DEFAULT_MIX or int(weight) < 0:
+            raise ValueError(header)
+        return header, int(weight)
+    except (KeyError, ValueError) as ex:
+        raise argparse.ArgumentTypeError(
+            f"pondération invalide: {value}") from ex
+
+
+def _report(sessions: list[_Session], elapsed: float) -> None:
+    """Affiche le débit et les latences de chaque entête."""
+    print(f"{'entête':<22} {'requêtes':>9} {'erreurs':>8} {'req/s':>9} "
+          f"{'p50':>10} {'p99':>10}")
+    total = 0
+    for header in DEFAULT_MIX:
+        samples = sorted(latency for session in sessions
+                         for latency in session.latencies[header])
+        errors = sum(session.errors[header] for session in sessions)
+        total += len(samples)
+        print(f"{header.name:<22} {len(samples):>9} {errors:>8} "
+              f"{len(samples) / elapsed:>9.1f} "
+              f"{_percentile(samples, 0.5) * 1e3:>7.3f} ms "
+              f"{_percentile(samples, 0.99) * 1e3:>7.3f} ms")
+    print(f"{'total':<22} {total:>9} {'':>8} {total / elapsed:>9.1f}")
+
+
+def _main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--destination", action="store",
+                        dest="dest", default="127.0.0.1",
+                        help="Adresse IP/URL du serveur.")
+    parser.add_argument("-c", "--connections", action="store", type=int,
+                        dest="connections", default=8,
+                        help="Nombre de connexions simultanées.")
+    parser.add_argument("-t", "--duration", action="store", type=float,
+                        dest="duration", default=10.0,
+                        help="Durée de la mesure, en secondes.")
+    parser.add_argument("-m", "--mix", action="store", nargs="+",
+                        type=_parse_weight, dest="mix", default=None,
+                        metavar="ENTETE=N",
+                        help="Pondération des entêtes envoyées, par exemple "
+                             "EMAIL_SENDING=1 STATS_REQUEST=4.")
+    parser.add_argument("-b", "--body-size", action="store", type=int,
+                        dest="body_size", default=1024,
+                        help="Taille du contenu des courriels, en "
+                             "caractères.")
+    parser.add_argument("--codec", action="store", choices=gloutils.CODECS,
+                        dest="codec", default=gloutils.CODEC_JSON,
+                        help="Codec des messages à négocier avec le "
+                             "serveur.")
+    parser.add_argument("--prefix", action="store", dest="prefix",
+                        default=None,
+                        help="Préfixe des utilisateurs synthétiques; "
+                             "réutiliser un préfixe réutilise leurs boîtes.")
+    parser.add_argument("--seed", action="store", type=int, dest="seed",
+                        default=0,
+                        help="Graine du tirage des requêtes.")
+    args = parser.parse_args(sys.argv[1:])
+
+    mix = dict(args.mix) if args.mix else dict(DEFAULT_MIX)
+    headers = [header for header, weight in mix.items() if weight > 0]
+    if not headers:
+        print("Le mélange de requêtes est vide.")
+        return 1
+    weights = [mix[header] for header in headers]
+    prefix = args.prefix or f"bench{os.getpid()}"
+    usernames = [f"{prefix}-{index}" for index in range(args.connections)]
+    body = ("x" * 63 + "\n") * (args.body_size // 64) \
+        + "x" * (args.body_size % 64)
+
+    sessions: list[_Session] = []
+    try:
+        for index, username in enumerate(usernames):
+            session = _Session(args.dest, username, usernames, args.codec,
+                               body, args.seed + index)
+            sessions.append(session)
+            session.authenticate()
+    except (OSError, glosocket.GLOSocketError, RuntimeError) as ex:
+        print(f"Impossible de préparer les connexions: {ex}")
+        for session in sessions:
+            session.close()
+        return 1
+
+    start = threading.Barrier(len(sessions) + 1)
+    deadline = [float("inf")]
+    failures: list[Exception] = []
+
+    def _drive(session: _Session) -> None:
+        try:
+            session.run(headers, weights, start, deadline)
+        except (glosocket.GLOSocketError, ValueError, KeyError) as ex:
+            failures.append(ex)
+
+    threads = [threading.Thread(target=_drive, args=(session,), daemon=True)
+               for session in sessions]
+    for thread in threads:
+        thread.start()
+    began = time.perf_counter()
+    deadline[0] = began + args.duration
+    start.wait()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+    for session in sessions:
+        session.close()
+
+    print(f"{len(sessions)} connexions, {elapsed:.1f} s, codec "
+          f"{args.codec}, courriels de {args.body_size} caractères")
+    _report(sessions, elapsed)
+    if failures:
+        print(f"{len(failures)} connexions interrompues: {failures[0]!r}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -0,0 +1,305 @@
+"""\
+Métriques du serveur mail: compteurs et histogrammes de latence.
+
+Les histogrammes ont des seaux préalloués aux bornes fixes (puissances de
+deux à partir d'une microseconde): enregistrer une mesure ne fait qu'une
+recherche dichotomique et quelques additions, sans allocation, si bien que
+les métriques peuvent rester actives en production. Les centiles en sont
+déduits, à un facteur deux près.
+
+Le module fournit aussi Profiler, qui profile les traitements du serveur
+avec cProfile pendant une fenêtre bornée, à la demande.
+"""
+import bisect
+import cProfile
+import json
+import os
+import pstats
+import tempfile
+import threading
+import time
+from typing import Callable, Optional
+
+import glostorage
+import gloutils
+
+# Bornes supérieures, en secondes, des seaux des histogrammes: de 1 µs à
+# environ 16 s. Un dernier seau reçoit les mesures plus longues.
+LATENCY_BOUNDS = tuple(1e-6 * (1 << exponent) for exponent in range(25))
+
+# Étapes mesurées pour chaque requête: décodage de la trame, traitement,
+# puis sérialisation de la réponse.
+STAGE_PARSE = 0
+STAGE_HANDLER = 1
+STAGE_SERIALIZE = 2
+_STAGE_NAMES = ("parse", "handler", "serialize")
+
+# Opérations du stockage dont la durée est mesurée.
+STORAGE_OPERATIONS = tuple(
+    name for name, value in vars(glostorage.MailStorage).items()
+    if not name.startswith("_") and callable(value) and name != "close")
+
+
+class Histogram:
+    """
+    Histogramme de durées à seaux fixes, partagé par les fils d'exécution.
+    """
+
+    __slots__ = ("_counts", "count", "total", "_lock")
+
+    def __init__(self) -> None:
+        self._counts = [0] * (len(LATENCY_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        """Ajoute une durée, en secondes."""
+        index = bisect.bisect_left(LATENCY_BOUNDS, seconds)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.total += seconds
+
+    def percentile(self, fraction: float) -> float:
+        """
+        Retourne la borne supérieure du seau qui contient le centile
+        demandé, ou 0 si l'histogramme est vide.
+        """
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if count and seen >= rank:
+                return LATENCY_BOUNDS[min(index, len(LATENCY_BOUNDS) - 1)]
+        return 0.0
+
+    def snapshot(self) -> dict:
+        """Résumé de l'histogramme, en millisecondes."""
+        with self._lock:
+            count = self.count
+            total = self.total
+        return {
+            "count": count,
+            "mean_ms": total / count * 1e3 if count else 0.0,
+            "p50_ms": self.percentile(0.5) * 1e3,
+            "p99_ms": self.percentile(0.99) * 1e3,
+        }
+
+
+class Metrics:
+    """
+    Métriques d'un processus serveur.
+
+    Les histogrammes de chaque entête et de chaque opération du stockage
+    sont créés à l'avance. Les compteurs simples (octets, connexions,
+    erreurs) ne sont modifiés que par la boucle principale. `commit` mesure
+    les synchronisations des remises (voir glostorage.GroupCommit), et
+    `commit_deliveries` compte les remises qu'elles ont confirmées.
+    """
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections_active = 0
+        self.connections_total = 0
+        self.recv = Histogram()
+        self.send = Histogram()
+        self._stages = {header: tuple(Histogram() for _ in _STAGE_NAMES)
+                        for header in gloutils.Headers}
+        self._errors = dict.fromkeys(gloutils.Headers, 0)
+        self.storage = {name: Histogram() for name in STORAGE_OPERATIONS}
+        self.commit = Histogram()
+        self.commit_deliveries = 0
+        self._commit_lock = threading.Lock()
+
+    def record(self, header, stage: int, seconds: float) -> None:
+        """
+        Ajoute la durée d'une étape du traitement d'une requête. Les
+        entêtes inconnues sont ignorées.
+        """
+        histograms = self._stages.get(header)
+        if histograms is not None:
+            histograms[stage].record(seconds)
+
+    def record_error(self, header) -> None:
+        """Compte une réponse d'erreur à une requête de l'entête."""
+        if header in self._errors:
+            self._errors[header] += 1
+
+    def record_commit(self, deliveries: int, seconds: float) -> None:
+        """Ajoute une synchronisation qui a confirmé `deliveries` remises."""
+        self.commit.record(seconds)
+        with self._commit_lock:
+            self.commit_deliveries += deliveries
+
+    def opened(self) -> None:
+        """Compte une nouvelle connexion."""
+        self.connections_active += 1
+        self.connections_total += 1
+
+    def closed(self) -> None:
+        """Compte une connexion fermée."""
+        self.connections_active -= 1
+
+    def snapshot(self) -> dict:
+        """
+        Retourne les métriques sous forme sérialisable en JSON. Seules les
+        entêtes et les opérations du stockage déjà utilisées y figurent.
+        """
+        requests = {}
+        for header, histograms in self._stages.items():
+            if not any(histogram.count for histogram in histograms):
+                continue
+            requests[header.name] = {
+                "count": histograms[STAGE_PARSE].count,
+                "errors": self._errors[header],
+            }
+            for name, histogram in zip(_STAGE_NAMES, histograms):
+                requests[header.name][name] = histogram.snapshot()
+        return {
+            "pid": os.getpid(),
+            "uptime": time.time() - self.started,
+            "connections": {"active": self.connections_active,
+                            "total": self.connections_total},
+            "bytes": {"in": self.bytes_in, "out": self.bytes_out},
+            "recv": self.recv.snapshot(),
+            "send": self.send.snapshot(),
+            "requests": requests,
+            "storage": {name: histogram.snapshot()
+                        for name, histogram in self.storage.items()
+                        if histogram.count},
+            "commit": dict(self.commit.snapshot(),
+                           deliveries=self.commit_deliveries),
+        }
+
+    def dump(self, path: str) -> None:
+        """
+        Écrit les métriques en JSON dans le fichier, remplacé d'un bloc pour
+        qu'un lecteur ne voie jamais un fichier partiel.
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                json.dump(self.snapshot(), file, indent=2)
+            os.replace(temp_path, path)
+        except OSError:
+            os.unlink(temp_path)
+            raise
+
+
+def _timed(operation: Callable, histogram: Histogram) -> Callable:
+    """Enrobe une opération pour enregistrer sa durée dans l'histogramme."""
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return operation(*args, **kwargs)
+        finally:
+            histogram.record(time.perf_counter() - start)
+    return timed
+
+
+class TimedStorage:
+    """
+    Moteur de stockage qui mesure la durée des opérations d'un autre.
+
+    Les enveloppes sont créées une seule fois, à la construction. Pour les
+    opérations qui retournent un itérateur ou un MessageWriter, seule la
+    préparation est mesurée.
+    """
+
+    def __init__(self, storage: glostorage.MailStorage,
+                 metrics: Metrics) -> None:
+        self._storage = storage
+        for name, histogram in metrics.storage.items():
+            setattr(self, name, _timed(getattr(storage, name), histogram))
+
+    def __getattr__(self, name: str):
+        return getattr(self._storage, name)
+
+
+class Profiler:
+    """
+    Profilage des traitements pendant une fenêtre de `window` secondes.
+
+    Hors fenêtre, `run` appelle simplement la fonction. Pendant la
+    fenêtre, chaque appel est profilé avec cProfile dans le fil
+    d'exécution qui l'exécute; à la fin de la fenêtre, `poll` fusionne les
+    profils et les écrit dans `directory`, dans un fichier lisible avec
+    le module pstats.
+    """
+
+    def __init__(self, directory: str, window: float) -> None:
+        self._directory = directory
+        self._window = window
+        self._deadline: Optional[float] = None
+        self._profiles: list[cProfile.Profile] = []
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> bool:
+        """Indique si une fenêtre de profilage est en cours."""
+        return self._deadline is not None
+
+    def start(self) -> bool:
+        """
+        Ouvre une fenêtre de profilage. Retourne faux si une fenêtre est
+        déjà en cours.
+        """
+        with self._lock:
+            if self._deadline is not None:
+                return False
+            self._profiles = []
+            self._deadline = time.monotonic() + self._window
+            return True
+
+    def run(self, function: Callable, *args):
+        """Appelle la fonction, en la profilant pendant une fenêtre."""
+        if self._deadline is None:
+            return function(*args)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Un autre profileur est déjà actif dans ce fil d'exécution.
+            return function(*args)
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+            with self._lock:
+                self._profiles.append(profile)
+
+    def stop(self) -> None:
+        """Avance la fin de la fenêtre en cours; `poll` écrira les profils."""
+        with self._lock:
+            if self._deadline is not None:
+                self._deadline = time.monotonic()
+
+    def poll(self) -> Optional[float]:
+        """
+        Termine la fenêtre si elle est écoulée et écrit les profils.
+        Retourne le délai avant la fin de la fenêtre en cours, ou None.
+        """
+        with self._lock:
+            if self._deadline is None:
+                return None
+            remaining = self._deadline - time.monotonic()
+            if remaining > 0:
+                return remaining
+            profiles, self._profiles = self._profiles, []
+            self._deadline = None
+        if profiles:
+            self._write(profiles)
+        return None
+
+    def _write(self, profiles: list[cProfile.Profile]) -> str:
+        """Fusionne les profils et les écrit; retourne le fichier créé."""
+        os.makedirs(self._directory, exist_ok=True)
+        path = os.path.join(
+            self._directory,
+            f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.prof")
+        pstats.Stats(*profiles).dump_stats(path)
+        return path
@@ -2,8 +2,31 @@
 Module fournissant les fonctions d'envoi et de réception
 de messages de taille arbitraire pour les sockets Python.
 """
+import asyncio
+import collections
+import os
 import socket
 import struct
+import zlib
+from typing import Iterable, Optional, Sequence, Union
+
+# Nombre maximal de tampons par appel à sendmsg (limite IOV_MAX du système).
+try:
+    _IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = 16
+
+# Bit de poids fort du préfixe de taille: indique un message compressé
+# avec zlib. Les 31 bits restants donnent la taille transmise.
+_COMPRESSED_FLAG = 1 << 31
+# Taille minimale d'un message pour qu'il soit compressé: les petits
+# messages de contrôle n'y gagneraient rien.
+COMPRESSION_THRESHOLD = 1024
+# Taille maximale d'un message, avant comme après décompression. Le préfixe
+# de taille provient de l'autre socket: un message annoncé plus gros est
+# refusé plutôt que d'allouer son tampon. Les gros courriels sont transmis
+# par morceaux bien en deçà de cette limite.
+MAX_FRAME_SIZE = 1 << 26
 
 
 class GLOSocketError(Exception):
@@ -13,55 +36,435 @@ class GLOSocketError(Exception):
     """
 
 
-def _recvall(source: socket.socket, size: int) -> bytes:
+def _recvall_into(source: socket.socket, view: memoryview) -> None:
     """
-    Fonction utilitaire pour recv_mesg.
+    Fonction utilitaire pour recv_mesg_bytes.
 
-    Applique socket.recv en boucle pour jusqu'à la
-    réception d'un message de la taille voulue.
+    Applique socket.recv_into en boucle jusqu'à ce que la vue
+    `view` soit entièrement remplie, sans copie intermédiaire.
     """
-    msg = b""
-    while size > 0:
-        chunk_size = min(size, 4096)
+    while view:
         try:
-            buffer = source.recv(chunk_size)
+            received = source.recv_into(view)
         except OSError as ex:
             raise GLOSocketError("The source socket is closed.") from ex
-        if not buffer:
+        if not received:
             raise GLOSocketError("The other socket is closed.")
-        msg += buffer
-        size -= len(buffer)
-    return msg
+        view = view[received:]
+
+
+def _recvall(source: socket.socket, size: int) -> bytearray:
+    """
+    Fonction utilitaire pour recv_mesg.
+
+    Préalloue un tampon de la taille voulue et le remplit
+    à l'aide de socket.recv_into.
+    """
+    buffer = bytearray(size)
+    _recvall_into(source, memoryview(buffer))
+    return buffer
+
+
+def _send_once(dest_soc: socket.socket,
+               views: "collections.deque[memoryview]") -> None:
+    """
+    Fonction utilitaire pour l'envoi de tampons.
+
+    Effectue un seul appel système d'envoi pour les tampons en tête de
+    `views` (scatter-gather avec socket.sendmsg lorsqu'il est disponible)
+    et retire de la file les octets effectivement transmis.
+    """
+    if hasattr(dest_soc, "sendmsg"):
+        batch = [views[index] for index in range(min(len(views), _IOV_MAX))]
+        sent = dest_soc.sendmsg(batch)
+    else:
+        sent = dest_soc.send(views[0])
+    while sent:
+        if sent >= len(views[0]):
+            sent -= len(views.popleft())
+        else:
+            views[0] = views[0][sent:]
+            sent = 0
+    while views and not views[0]:
+        views.popleft()
+
+
+def _as_views(buffers: Iterable[bytes]) -> "collections.deque[memoryview]":
+    """Convertit des tampons en une file de vues d'octets."""
+    return collections.deque(memoryview(buffer).cast("B")
+                             for buffer in buffers)
+
+
+def _sendall_buffers(dest_soc: socket.socket,
+                     buffers: Sequence[bytes]) -> None:
+    """
+    Fonction utilitaire pour send_mesg et GLOConnection.
+
+    Transmet une suite de tampons en un minimum d'appels système,
+    sans les concaténer.
+    """
+    views = _as_views(buffers)
+    while views:
+        _send_once(dest_soc, views)
+
+
+def send_available(dest_soc: socket.socket,
+                   views: "collections.deque[memoryview]") -> None:
+    """
+    Transmet autant de données de `views` que possible sans bloquer.
+
+    Destinée aux sockets non bloquants: les octets transmis sont retirés
+    de la file et ce qui reste devra être envoyé lorsque le socket sera de
+    nouveau prêt en écriture.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    try:
+        while views:
+            _send_once(dest_soc, views)
+    except (BlockingIOError, InterruptedError):
+        return
+    except OSError as ex:
+        raise GLOSocketError("Cannot send data with socket") from ex
 
 
-def send_mesg(dest_soc: socket.socket, message: str) -> None:
+def frame_bytes(data: Union[bytes, memoryview], compress: bool = False
+                ) -> "collections.deque[memoryview]":
+    """
+    Retourne les vues du préfixe de taille et des données d'un message
+    déjà encodé, sans copier les données. `data` peut être une vue d'un
+    fichier projeté en mémoire.
+
+    Avec `compress`, un message d'au moins COMPRESSION_THRESHOLD octets
+    est compressé avec zlib lorsque cela le raccourcit. À n'utiliser
+    qu'une fois la compression négociée avec l'autre socket.
+    """
+    if compress and len(data) >= COMPRESSION_THRESHOLD:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return _as_views([
+                struct.pack("!I", len(compressed) | _COMPRESSED_FLAG),
+                compressed
+            ])
+    return _as_views([struct.pack("!I", len(data)), data])
+
+
+def frame_mesg(message: str, compress: bool = False
+               ) -> "collections.deque[memoryview]":
+    """
+    Encode le message et retourne les vues de son préfixe de taille
+    et de ses données, prêtes à être ajoutées à une file d'envoi.
+    """
+    return frame_bytes(message.encode(encoding='utf-8'), compress)
+
+
+def _frame_length(prefix: Union[bytes, bytearray], compressed: bool
+                  ) -> tuple[int, bool]:
+    """
+    Analyse le préfixe de taille d'un message reçu et retourne la taille
+    transmise et l'indicateur de compression.
+
+    Lève une exception GLOSocketError si le message dépasse MAX_FRAME_SIZE
+    ou s'il est compressé alors que la compression n'a pas été négociée
+    (`compressed` faux).
+    """
+    try:
+        length, = struct.unpack("!I", prefix)
+    except struct.error as ex:
+        raise GLOSocketError("The received data was"
+                             " not the message's length") from ex
+    is_compressed = bool(length & _COMPRESSED_FLAG)
+    length &= ~_COMPRESSED_FLAG
+    if is_compressed and not compressed:
+        raise GLOSocketError("The received message was compressed"
+                             " without negotiation")
+    if length > MAX_FRAME_SIZE:
+        raise GLOSocketError("The received message is too large")
+    return length, is_compressed
+
+
+def _decompress(data: Union[bytes, bytearray]) -> bytes:
+    """
+    Décompresse le corps d'un message reçu avec le drapeau zlib, sans
+    produire plus de MAX_FRAME_SIZE octets.
+    """
+    decompressor = zlib.decompressobj()
+    try:
+        result = decompressor.decompress(data, MAX_FRAME_SIZE)
+    except zlib.error as ex:
+        raise GLOSocketError("The received data was"
+                             " not a valid compressed message") from ex
+    if decompressor.unconsumed_tail:
+        raise GLOSocketError("The received message is too large")
+    if not decompressor.eof or decompressor.unused_data:
+        raise GLOSocketError("The received data was"
+                             " not a valid compressed message")
+    return result
+
+
+def send_mesg(dest_soc: socket.socket, message: str,
+              compress: bool = False) -> None:
     """
     Encode le message puis le transmet à la destination.
 
     Lève une exception GLOSocketError en cas de problème
     de communication.
     """
-    data = message.encode(encoding='utf-8')
-    data_length = struct.pack("!I", len(data))
+    send_mesg_bytes(dest_soc, message.encode(encoding='utf-8'), compress)
+
+
+def send_mesg_bytes(dest_soc: socket.socket,
+                    data: Union[bytes, memoryview],
+                    compress: bool = False) -> None:
+    """
+    Transmet un message déjà encodé à la destination, sans le copier
+    s'il n'est pas compressé (voir `frame_bytes`).
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
     try:
-        dest_soc.sendall(data_length + data)
+        _sendall_buffers(dest_soc, frame_bytes(data, compress))
     except OSError as ex:
         raise GLOSocketError("Cannot send data with socket") from ex
 
 
-def recv_mesg(source_soc: socket.socket) -> str:
+def recv_mesg_bytes(source_soc: socket.socket, compressed: bool = False
+                    ) -> Union[bytes, bytearray]:
+    """
+    Récupère un message de la source sans le décoder.
+
+    Le tampon retourné est alloué une seule fois à partir de la
+    taille annoncée, ce qui évite les copies pour les gros messages.
+    `json.loads` accepte directement ce tampon. Si `compressed` est vrai,
+    c'est-à-dire si la compression a été négociée, un message compressé
+    est décompressé.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication ou si le message est refusé (voir `_frame_length`).
+    """
+    length, is_compressed = _frame_length(_recvall(source_soc, 4), compressed)
+    if is_compressed:
+        return _decompress(_recvall(source_soc, length))
+    return _recvall(source_soc, length)
+
+
+def recv_mesg(source_soc: socket.socket, compressed: bool = False) -> str:
     """
     Récupère un message de la source et le décode.
 
     Lève une exception GLOSocketError en cas de problème
     de communication.
     """
-    data_length = _recvall(source_soc, 4)
+    return recv_mesg_bytes(source_soc, compressed).decode('utf-8')
+
+
+class FrameDecoder:
+    """
+    Décodeur incrémental de messages préfixés par leur taille.
+
+    Destiné aux sockets non bloquants: les octets reçus sont fournis au fur
+    et à mesure avec `feed`, et les messages complets sont récupérés avec
+    `next_frame`. Le corps de chaque message grandit au fil des octets
+    reçus plutôt que d'être alloué d'après la taille annoncée, qui provient
+    de l'autre socket. Il est décompressé à sa récupération, lorsque la
+    compression a été négociée.
+    """
+
+    def __init__(self) -> None:
+        self._header = bytearray()
+        self._body: Optional[bytearray] = None
+        self._compressed = False
+        self._length = 0
+        self._frames: "collections.deque[tuple[bytearray, bool]]" = \
+            collections.deque()
+
+    def feed(self, data: bytes) -> None:
+        """
+        Ajoute des octets reçus et découpe les messages complets.
+
+        Lève une exception GLOSocketError si un message annonce une taille
+        supérieure à MAX_FRAME_SIZE.
+        """
+        view = memoryview(data).cast("B")
+        while view:
+            if self._body is None:
+                needed = 4 - len(self._header)
+                self._header += view[:needed]
+                view = view[needed:]
+                if len(self._header) < 4:
+                    break
+                # La compression est vérifiée par next_frame, une fois
+                # traitées les requêtes précédentes, dont HELLO.
+                self._length, self._compressed = _frame_length(
+                    self._header, True)
+                self._header.clear()
+                self._body = bytearray()
+            count = min(len(view), self._length - len(self._body))
+            self._body += view[:count]
+            view = view[count:]
+            if len(self._body) == self._length:
+                self._frames.append((self._body, self._compressed))
+                self._body = None
+
+    def next_frame(self, compressed: bool = False
+                   ) -> Optional[Union[bytes, bytearray]]:
+        """
+        Retourne le prochain message complet, ou None s'il n'y en a pas.
+
+        Lève une exception GLOSocketError si le message est compressé alors
+        que la compression n'a pas été négociée (`compressed` faux), ou si
+        sa décompression échoue.
+        """
+        if not self._frames:
+            return None
+        body, is_compressed = self._frames.popleft()
+        if not is_compressed:
+            return body
+        if not compressed:
+            raise GLOSocketError("The received message was compressed"
+                                 " without negotiation")
+        return _decompress(body)
+
+    @property
+    def has_frames(self) -> bool:
+        """Indique si des messages complets sont en attente."""
+        return bool(self._frames)
+
+
+async def send_mesg_async(writer: asyncio.StreamWriter, message: str,
+                          compress: bool = False) -> None:
+    """
+    Équivalent asyncio de send_mesg, avec le même préfixe de taille.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    await send_mesg_bytes_async(writer, message.encode(encoding='utf-8'),
+                                compress)
+
+
+async def send_mesg_bytes_async(writer: asyncio.StreamWriter,
+                                data: Union[bytes, memoryview],
+                                compress: bool = False) -> None:
+    """
+    Équivalent asyncio de send_mesg_bytes.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication.
+    """
+    writer.writelines(frame_bytes(data, compress))
     try:
-        length, = struct.unpack("!I", data_length)
-    except struct.error as ex:
-        raise GLOSocketError("The received data was"
-                             " not the message's length") from ex
+        await writer.drain()
+    except (OSError, RuntimeError) as ex:
+        raise GLOSocketError("Cannot send data with socket") from ex
+
+
+async def recv_mesg_bytes_async(reader: asyncio.StreamReader,
+                                compressed: bool = False) -> bytes:
+    """
+    Équivalent asyncio de recv_mesg_bytes.
+
+    Lève une exception GLOSocketError en cas de problème
+    de communication ou si le message est refusé.
+    """
+    try:
+        prefix = await reader.readexactly(4)
+    except (asyncio.IncompleteReadError, OSError) as ex:
+        raise GLOSocketError("The other socket is closed.") from ex
+    length, is_compressed = _frame_length(prefix, compressed)
+    try:
+        data = await reader.readexactly(length)
+    except (asyncio.IncompleteReadError, OSError) as ex:
+        raise GLOSocketError("The other socket is closed.") from ex
+    if is_compressed:
+        return _decompress(data)
+    return data
+
+
+class GLOConnection:
+    """
+    Connexion tamponnée permettant d'envoyer plusieurs requêtes
+    en un seul aller-retour.
+
+    Les messages mis en file avec `queue` ne sont transmis qu'à l'appel de
+    `flush`, en un seul envoi scatter-gather. Les réponses sont ensuite
+    lues dans l'ordre des requêtes avec `recv_responses`. Avec `compress`,
+    les gros messages sont compressés (voir `frame_bytes`).
+    """
+
+    def __init__(self, soc: socket.socket, compress: bool = False) -> None:
+        self._socket = soc
+        self._compress = compress
+        self._buffers: list[memoryview] = []
+        self._pending_responses = 0
+
+    @property
+    def socket(self) -> socket.socket:
+        """Socket sous-jacent de la connexion."""
+        return self._socket
+
+    @property
+    def pending_responses(self) -> int:
+        """Nombre de réponses attendues pour les messages déjà envoyés."""
+        return self._pending_responses
+
+    def queue(self, message: Union[str, bytes],
+              expect_response: bool = True) -> None:
+        """
+        Ajoute un message, texte ou déjà encodé, à la file d'envoi.
+
+        `expect_response` doit être faux pour les entêtes auxquelles le
+        serveur ne répond pas (par exemple `BYE` ou `AUTH_LOGOUT`).
+        """
+        if isinstance(message, str):
+            self._buffers.extend(frame_mesg(message, self._compress))
+        else:
+            self._buffers.extend(frame_bytes(message, self._compress))
+        if expect_response:
+            self._pending_responses += 1
+
+    def flush(self) -> None:
+        """
+        Transmet tous les messages en file.
+
+        Lève une exception GLOSocketError en cas de problème
+        de communication.
+        """
+        buffers, self._buffers = self._buffers, []
+        if not buffers:
+            return
+        try:
+            _sendall_buffers(self._socket, buffers)
+        except OSError as ex:
+            raise GLOSocketError("Cannot send data with socket") from ex
+
+    def send(self, message: str) -> None:
+        """Envoie immédiatement un message sans attendre de réponse."""
+        self.queue(message, expect_response=False)
+        self.flush()
+
+    def recv(self) -> str:
+        """Lit la prochaine réponse attendue."""
+        return self.recv_bytes().decode('utf-8')
+
+    def recv_bytes(self) -> Union[bytes, bytearray]:
+        """Lit la prochaine réponse attendue, sans la décoder."""
+        message = recv_mesg_bytes(self._socket, self._compress)
+        self._pending_responses = max(self._pending_responses - 1, 0)
+        return message
+
+    def recv_responses(self) -> list[str]:
+        """Vide la file d'envoi puis lit toutes les réponses attendues."""
+        self.flush()
+        return [self.recv() for _ in range(self._pending_responses)]
 
-    data = _recvall(source_soc, length)
-    return data.decode('utf-8')
+    def request_many(self, messages: Iterable[str]) -> list[str]:
+        """
+        Envoie toutes les requêtes en un seul envoi et retourne
+        leurs réponses dans le même ordre.
+        """
+        for message in messages:
+            self.queue(message)
+        return self.recv_responses()
@@ -0,0 +1,3259 @@
+"""\
+Module fournissant le stockage des boîtes de courriels du serveur.
+
+Le serveur n'accède aux données qu'à travers l'interface MailStorage.
+Trois moteurs sont fournis: FileSystemStorage, qui conserve la disposition
+historique (un dossier par utilisateur et un fichier JSON par courriel),
+SegmentLogStorage, qui ajoute les courriels d'une boîte à la fin d'un
+segment, et SQLiteStorage, qui regroupe toutes les données dans une seule
+base.
+
+Les moteurs ne synchronisent pas eux-mêmes les courriels reçus sur disque:
+les fichiers modifiés sont relevés par `track_writes`, et GroupCommit les
+synchronise selon le niveau de durabilité choisi.
+"""
+import abc
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import hmac
+import json
+import mmap
+import os
+import re
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import unicodedata
+from typing import (Any, BinaryIO, Callable, Iterable, Iterator, NotRequired,
+                    Optional, Sequence, TypedDict, Union)
+
+import gloutils
+
+try:
+    import fcntl
+except ImportError:  # Windows: un seul processus serveur.
+    fcntl = None
+
+# Nom des fichiers de courriels nommés d'après gloutils.new_message_id.
+_MESSAGE_FILENAME = re.compile(r"^\d{20}-\d+\.json$")
+
+# Verrous d'une boîte et de son index de recherche partagés entre les
+# processus du serveur.
+_LOCK_FILENAME = "index.lock"
+_SEARCH_LOCK_FILENAME = "search.lock"
+SEGMENT_SUFFIX = ".seg"
+# Suffixe des liens physiques, dans les boîtes, vers les contenus du
+# magasin BodyStore.
+BODY_SUFFIX = ".body"
+# Verrou des contenus de même préfixe du magasin BodyStore, et suffixe du
+# fichier de leurs détenteurs.
+_BODY_LOCK_FILENAME = "bodies.lock"
+_HOLDERS_SUFFIX = ".holders"
+# Taille encodée à partir de laquelle le contenu d'un courriel est placé
+# dans le magasin BodyStore plutôt qu'avec son en-tête. Un contenu plus
+# petit qu'un bloc du système de fichiers, remis à un seul destinataire,
+# coûterait plus en fichiers et en liens que ce qu'il pourrait faire gagner.
+SHARED_BODY_MIN_SIZE = 4096
+# Préfixe de taille des enregistrements des segments.
+_RECORD_PREFIX = struct.Struct("!I")
+# Proportion d'octets supprimés au-delà de laquelle un segment est compacté.
+COMPACTION_THRESHOLD = 0.5
+# Nombre de boîtes SQLite dont les identifiants des courriels sont gardés
+# en mémoire (voir SQLiteStorage._message_ids).
+MAILBOX_CACHE_SIZE = 256
+# Nombre de hachages de mots de passe gardés en mémoire, et durée en
+# secondes après laquelle un hachage est relu.
+CREDENTIAL_CACHE_SIZE = 4096
+CREDENTIAL_CACHE_TTL = 300
+# Limites du dossier des courriels perdus (voir LostIndex): au-delà de
+# LOST_MAX_SIZE octets, ou après LOST_MAX_AGE secondes, les courriels les
+# plus anciens sont évincés.
+LOST_MAX_SIZE = 256 << 20
+LOST_MAX_AGE = 30 * 24 * 3600
+# Niveaux de durabilité des remises (voir GroupCommit): aucune
+# synchronisation, synchronisation groupée de plusieurs remises, ou
+# synchronisation de chaque remise avant de la confirmer.
+DURABILITY_NONE = "none"
+DURABILITY_BATCH = "batch"
+DURABILITY_SYNC = "sync"
+DURABILITIES = (DURABILITY_NONE, DURABILITY_BATCH, DURABILITY_SYNC)
+# Mots indexés pour la recherche (voir search_terms): seuls les
+# SEARCH_CONTENT_LIMIT premiers caractères d'un contenu sont lus, et un mot
+# plus long que SEARCH_MAX_WORD, comme une donnée encodée, est ignoré.
+SEARCH_CONTENT_LIMIT = 1 << 20
+SEARCH_MIN_WORD = 2
+SEARCH_MAX_WORD = 64
+# Nombre maximal de mots d'une recherche.
+SEARCH_MAX_TERMS = 16
+# Nombre de boîtes dont l'index de recherche est gardé en mémoire.
+SEARCH_CACHE_SIZE = 64
+_SEARCH_WORD = re.compile(r"\w+")
+_DIACRITICS = re.compile("[\u0300-\u036f]")
+# Clé du contenu d'un courriel encodé en JSON, et taille des blocs lus pour
+# trouver la fin de ce contenu.
+_CONTENT_KEY = re.compile(rb'"content": "')
+_SCAN_BLOCK_SIZE = 1 << 20
+
+
+class MessageHeader(TypedDict, total=True):
+    """
+    En-tête d'un courriel stocké, utilisé pour la liste des courriels.
+
+    `wire` indique que le courriel est stocké au format de transmission
+    (voir encode_wire), ce qui n'est pas le cas des courriels plus anciens.
+    """
+    sender: str
+    subject: str
+    date: str
+    size: int
+    wire: NotRequired[bool]
+
+
+class IndexEntry(MessageHeader, total=True):
+    """
+    Entrée de l'index d'une boîte de courriels du système de fichiers.
+
+    Si le contenu du courriel est dans le magasin BodyStore, `filename` est
+    son talon (voir `_encode_stub`) et l'entrée donne aussi son
+    destinataire, l'empreinte `digest` du contenu, le nom `body` du lien
+    vers celui-ci et `physical`, la part de l'espace occupé qui revient au
+    courriel (par défaut, `size`): le contenu n'y compte qu'au prorata de
+    ses références, revu par une ligne `reshare` de l'index chaque fois
+    que leur nombre change (voir BodyStore).
+    """
+    filename: str
+    destination: NotRequired[str]
+    digest: NotRequired[str]
+    body: NotRequired[str]
+    physical: NotRequired[int]
+
+
+def encode_wire(email: gloutils.EmailContentPayload) -> bytes:
+    """
+    Encode le courriel exactement comme la réponse à INBOX_READING_CHOICE,
+    pour qu'il puisse être transmis sans être relu ni sérialisé de nouveau.
+    """
+    return json.dumps(gloutils.GloMessage(header=gloutils.Headers.OK,
+                                          payload=email)).encode("utf-8")
+
+
+def _content_literal(content: str) -> bytes:
+    """
+    Encode le contenu d'un courriel comme dans le format de transmission:
+    une chaîne JSON, guillemets compris.
+    """
+    return json.dumps(content).encode("ascii")
+
+
+def _wire_around(email: gloutils.EmailStreamStartPayload
+                 ) -> tuple[bytes, bytes]:
+    """
+    Retourne le format de transmission du courriel (voir encode_wire)
+    avant et après son contenu encodé par `_content_literal`.
+    """
+    encoded = encode_wire(gloutils.EmailContentPayload(
+        sender=email["sender"], destination=email["destination"],
+        subject=email["subject"], date=email["date"], content=""))
+    split = encoded.rindex(b'"content": "') + len(b'"content": ')
+    return encoded[:split], encoded[split + 2:]
+
+
+def _encode_stub(email: gloutils.EmailStreamStartPayload, digest: str,
+                 body: str) -> bytes:
+    """
+    Encode le talon d'un courriel dont le contenu est dans le magasin
+    BodyStore: son en-tête, l'empreinte du contenu et le nom du lien vers
+    celui-ci. Les index sont reconstruits à partir des talons.
+    """
+    return json.dumps({"sender": email["sender"],
+                       "destination": email["destination"],
+                       "subject": email["subject"], "date": email["date"],
+                       "digest": digest, "body": body}).encode("utf-8")
+
+
+def _stub_fields(stub: dict, body_path: str) -> Optional[dict]:
+    """
+    Retourne les champs de l'entrée d'index du talon décodé `stub`, ou
+    None si son contenu a disparu.
+    """
+    try:
+        stat = os.stat(body_path)
+    except FileNotFoundError:
+        return None
+    head, tail = _wire_around(stub)
+    # Le lien du magasin n'est pas une référence.
+    share = stat.st_size // max(stat.st_nlink - 1, 1)
+    return {"sender": stub["sender"], "subject": stub["subject"],
+            "date": stub["date"],
+            "size": len(head) + stat.st_size + len(tail),
+            "destination": stub["destination"], "digest": stub["digest"],
+            "body": stub["body"], "physical": len(head) + share + len(tail)}
+
+
+def decode_stored(data: Union[bytes, memoryview], wire: bool
+                  ) -> gloutils.EmailContentPayload:
+    """Décode un courriel stocké, au format de transmission ou non."""
+    stored = json.loads(bytes(data) if isinstance(data, memoryview) else data)
+    return stored["payload"] if wire else stored
+
+
+def _decode_escaped(piece: str) -> tuple[str, int]:
+    """
+    Décode le plus long début de `piece`, un morceau du texte d'une chaîne
+    JSON, qui ne coupe aucune séquence d'échappement ni paire de
+    substitution. Retourne le texte décodé et le nombre de caractères
+    consommés.
+    """
+    cut = len(piece)
+    while True:
+        try:
+            text = json.loads('"' + piece[:cut] + '"')
+        except ValueError:
+            # Seule la dernière séquence d'échappement peut être incomplète.
+            cut = piece.rfind("\\", 0, cut)
+            if cut < 0:
+                raise
+            continue
+        if text and "\ud800" <= text[-1] <= "\udbff":
+            # Paire de substitution coupée: retirer sa première moitié,
+            # une séquence \uXXXX de six caractères.
+            cut -= 6
+            continue
+        return text, cut
+
+
+def _closing_quote(data: Union[bytes, memoryview], start: int) -> int:
+    """
+    Retourne la position du guillemet qui ferme la chaîne JSON commençant
+    à `start`, sans la décoder: dans chaque bloc, les séquences \\\\ puis
+    \\" sont masquées et le premier guillemet restant est le bon.
+    """
+    position = start
+    while True:
+        block = bytes(data[position:position + _SCAN_BLOCK_SIZE])
+        masked = block.replace(b"\\\\", b"__").replace(b'\\"', b"__")
+        quote = masked.find(b'"')
+        if quote >= 0:
+            return position + quote
+        # Une barre oblique inverse en fin de bloc échappe le premier
+        # caractère du bloc suivant: elle est relue avec lui.
+        advance = len(block) - masked.endswith(b"\\")
+        if advance <= 0:
+            raise ValueError("Chaîne JSON non terminée")
+        position += advance
+
+
+def _leading_header(data: Union[bytes, memoryview], start: int
+                    ) -> Optional[dict]:
+    """
+    Décode les champs placés avant le contenu (qui commence à `start`),
+    ou retourne None si l'en-tête n'y est pas complet.
+    """
+    prefix = bytes(data[:start])
+    for closing in (b'"}}', b'"}'):
+        try:
+            stored = json.loads(prefix + closing)
+        except ValueError:
+            continue
+        email = stored.get("payload", stored)
+        if all(key in email
+               for key in ("sender", "destination", "subject", "date")):
+            return email
+    return None
+
+
+def _content_chunks(data: Union[bytes, memoryview], start: int,
+                    chunk_size: int) -> Iterator[str]:
+    """
+    Décode, morceau par morceau, la chaîne JSON qui commence à `start`,
+    en s'arrêtant à son guillemet fermant (voir `_closing_quote`).
+    """
+    position, pending = start, b""
+    while True:
+        block = bytes(data[position:position + chunk_size])
+        position += len(block)
+        piece = pending + block
+        masked = piece.replace(b"\\\\", b"__").replace(b'\\"', b"__")
+        quote = masked.find(b'"')
+        if quote >= 0:
+            piece = piece[:quote]
+        elif not block:
+            raise ValueError("Contenu de courriel tronqué")
+        text, used = _decode_escaped(piece.decode("ascii"))
+        pending = piece[used:]
+        if text:
+            yield text
+        if quote >= 0:
+            return
+
+
+def split_wire(data: Union[bytes, memoryview], chunk_size: int
+               ) -> tuple[gloutils.EmailStreamStartPayload, Iterator[str]]:
+    """
+    Sépare un courriel encodé en JSON (voir encode_wire) en son en-tête et
+    les morceaux d'au plus `chunk_size` caractères de son contenu.
+
+    Seul l'en-tête est décodé immédiatement: le contenu est décodé morceau
+    par morceau, au fil de l'itération, ce qui permet de transmettre un
+    courriel projeté en mémoire sans jamais le parcourir en entier d'un
+    coup. Si des champs de l'en-tête suivent le contenu, la fin de ce
+    dernier est d'abord cherchée pour les lire.
+    """
+    start = _CONTENT_KEY.search(data).end()
+    email = _leading_header(data, start)
+    if email is None:
+        end = _closing_quote(data, start)
+        stored = json.loads(bytes(data[:start]) + bytes(data[end:]))
+        email = stored.get("payload", stored)
+    header = gloutils.EmailStreamStartPayload(sender=email["sender"],
+                                              destination=email["destination"],
+                                              subject=email["subject"],
+                                              date=email["date"])
+    return header, _content_chunks(data, start, chunk_size)
+
+
+class MessageWriter:
+    """
+    Écriture incrémentale d'un courriel reçu par morceaux.
+
+    Le courriel est encodé en JSON au fil de l'eau dans un fichier
+    temporaire de `directory`, au format de transmission si `wire` est
+    vrai: son contenu n'est jamais gardé en mémoire en entier. Si `body`
+    est vrai, le fichier ne contient que le contenu encodé (voir
+    `_content_literal`), dont l'empreinte SHA-256 est calculée au passage
+    pour le magasin BodyStore; `size` reste la taille du courriel entier.
+    `commit` termine le fichier et le remet à `on_commit`, qui le place à
+    sa destination; le fichier temporaire est ensuite supprimé s'il existe
+    encore. Seul le début du contenu est gardé en mémoire, dans `text`,
+    pour l'index de recherche.
+    """
+
+    def __init__(self, directory: Optional[str],
+                 email: gloutils.EmailStreamStartPayload, wire: bool,
+                 on_commit: Callable[["MessageWriter"], None],
+                 body: bool = False) -> None:
+        self.email = email
+        self.wire = wire
+        template = gloutils.EmailContentPayload(
+            sender=email["sender"], destination=email["destination"],
+            subject=email["subject"], date=email["date"], content="")
+        encoded = (encode_wire(template) if wire
+                   else json.dumps(template).encode("utf-8"))
+        split = encoded.rindex(b'"content": "') + len(b'"content": "')
+        prefix, self._suffix = encoded[:split], encoded[split:]
+        self._hash = hashlib.sha256() if body else None
+        if body:
+            prefix, self._suffix = b'"', b'"'
+        self._on_commit = on_commit
+        fd, self.path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+        self._file = os.fdopen(fd, "wb")
+        self._write(prefix)
+        self.size = len(encoded)
+        self._text: list[str] = []
+        self._text_size = 0
+
+    @property
+    def digest(self) -> str:
+        """Empreinte du contenu, une fois le courriel terminé (`body`)."""
+        return self._hash.hexdigest()
+
+    def _write(self, data: bytes) -> None:
+        """Écrit dans le fichier temporaire, en calculant l'empreinte."""
+        self._file.write(data)
+        if self._hash is not None:
+            self._hash.update(data)
+
+    def write(self, text: str) -> None:
+        """Ajoute un morceau du contenu."""
+        data = json.dumps(text)[1:-1].encode("ascii")
+        self._write(data)
+        self.size += len(data)
+        if self._text_size < SEARCH_CONTENT_LIMIT:
+            text = text[:SEARCH_CONTENT_LIMIT - self._text_size]
+            self._text.append(text)
+            self._text_size += len(text)
+
+    @property
+    def text(self) -> str:
+        """Début du contenu, jusqu'à SEARCH_CONTENT_LIMIT caractères."""
+        return "".join(self._text)
+
+    def load(self) -> gloutils.EmailContentPayload:
+        """Relit le courriel terminé, pour les moteurs qui le stockent
+        en entier."""
+        with open(self.path, "rb") as file:
+            return decode_stored(file.read(), self.wire)
+
+    def commit(self) -> None:
+        """Termine le courriel et le remet au moteur de stockage."""
+        try:
+            self._write(self._suffix)
+            self._file.close()
+            self._on_commit(self)
+        finally:
+            self.abort()
+
+    def abort(self) -> None:
+        """Abandonne le courriel et supprime le fichier temporaire."""
+        self._file.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
+
+
+def _link_or_copy(source: str, target: str) -> None:
+    """
+    Crée un lien physique `target` vers `source`, ou une copie là où les
+    liens physiques ne sont pas disponibles.
+    """
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+class BodyStore:
+    """
+    Magasin des contenus de courriels, adressés par leur empreinte.
+
+    Chaque contenu est un fichier `<dossier>/<xx>/<empreinte SHA-256>` qui
+    le contient encodé par `_content_literal`, tel qu'il apparaît dans le
+    format de transmission. Les boîtes y font référence par des liens
+    physiques, et le fichier `<empreinte>.holders` voisin donne le nombre
+    de liens de chaque utilisateur: la part du contenu qui revient à
+    chaque courriel (voir IndexEntry) est revue par `on_reshare` chaque
+    fois que ce nombre change. Un contenu déjà présent n'est jamais
+    réécrit, et il quitte le magasin avec sa dernière référence.
+
+    Les liens et les détenteurs d'un contenu ne sont modifiés qu'en tenant
+    son verrou (voir `locked`), partagé entre les processus du serveur.
+    Chaque lien d'une boîte garde son contenu, même retiré du magasin.
+    """
+
+    def __init__(self, directory: str,
+                 on_reshare: Optional[Callable[[str, str, int, int], None]]
+                 = None) -> None:
+        self.directory = directory
+        self._on_reshare = on_reshare
+        # Verrou des contenus là où fcntl n'est pas disponible.
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, digest: str) -> str:
+        """Retourne le fichier du magasin pour l'empreinte."""
+        return os.path.join(self.directory, digest[:2], digest)
+
+    @contextlib.contextmanager
+    def locked(self, digest: str) -> Iterator[None]:
+        """
+        Verrou exclusif sur le contenu d'empreinte `digest` et ses
+        détenteurs, partagé entre les fils d'exécution et les processus du
+        serveur. Il couvre tous les contenus de même préfixe `<xx>`.
+        """
+        directory = os.path.dirname(self._path(digest))
+        os.makedirs(directory, exist_ok=True)
+        if fcntl is None:
+            with self._lock:
+                yield
+            return
+        fd = os.open(os.path.join(directory, _BODY_LOCK_FILENAME),
+                     os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _holders(self, digest: str) -> dict[str, int]:
+        """Retourne le nombre de liens de chaque détenteur du contenu."""
+        try:
+            with open(self._path(digest) + _HOLDERS_SUFFIX, "rb") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def _set_holders(self, digest: str, holders: dict[str, int],
+                     body_size: int, before: int) -> None:
+        """
+        Enregistre les détenteurs du contenu, qui en avaient `before` liens,
+        et revoit la part de ceux qui en gardent si leur nombre total a
+        changé.
+        """
+        path = self._path(digest) + _HOLDERS_SUFFIX
+        if holders:
+            data = json.dumps(holders).encode("utf-8")
+            _write_atomic(path, lambda file: file.write(data))
+        else:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+        after = sum(holders.values())
+        if (self._on_reshare is None or before <= 0 or after <= 0
+                or body_size // before == body_size // after):
+            return
+        for username in holders:
+            self._on_reshare(username, digest, body_size, body_size // after)
+
+    def _link(self, digest: str, target: str,
+              write: Callable[[BinaryIO], None]) -> None:
+        """
+        Lie au chemin `target` le contenu d'empreinte `digest`. S'il n'est
+        pas dans le magasin, il est d'abord écrit par `write` dans un
+        fichier temporaire, puis publié sous son empreinte.
+        """
+        path = self._path(digest)
+        _track(target, os.path.dirname(target))
+        try:
+            _link_or_copy(path, target)
+            return
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as file:
+                write(file)
+            with contextlib.suppress(OSError):
+                # Liens physiques indisponibles: le contenu n'est
+                # simplement pas partagé.
+                os.link(temp_path, path)
+                _track(os.path.dirname(path))
+            _link_or_copy(temp_path, target)
+        finally:
+            os.remove(temp_path)
+
+    def link(self, digest: str, targets: list[tuple[str, str]],
+             write: Callable[[BinaryIO], None]) -> tuple[int, int]:
+        """
+        Lie le contenu d'empreinte `digest` à chaque chemin des paires
+        (utilisateur, chemin) de `targets`; `write` l'écrit s'il n'est pas
+        dans le magasin. Retourne la taille du contenu et la part qui en
+        revient à chacune de ses références. Doit être appelée en tenant
+        le verrou `locked` du contenu.
+        """
+        holders = self._holders(digest)
+        before = sum(holders.values())
+        for username, target in targets:
+            self._link(digest, target, write)
+            holders[username] = holders.get(username, 0) + 1
+        body_size = os.path.getsize(targets[0][1])
+        self._set_holders(digest, holders, body_size, before)
+        return body_size, body_size // sum(holders.values())
+
+    def release(self, username: str, target: str, digest: str) -> None:
+        """
+        Supprime le lien `target` de l'utilisateur vers le contenu
+        d'empreinte `digest`, et retire ce dernier du magasin s'il n'a plus
+        d'autre référence.
+        """
+        with self.locked(digest):
+            body_size = os.path.getsize(target)
+            os.remove(target)
+            holders = self._holders(digest)
+            before = sum(holders.values())
+            if holders.get(username, 0) > 1:
+                holders[username] -= 1
+            else:
+                holders.pop(username, None)
+            self._set_holders(digest, holders, body_size, before)
+            path = self._path(digest)
+            with contextlib.suppress(FileNotFoundError):
+                if os.stat(path).st_nlink <= 1:
+                    os.remove(path)
+
+
+# Fichiers et dossiers modifiés par chaque fil d'exécution, relevés pendant
+# un bloc `track_writes`.
+_tracking = threading.local()
+
+
+@contextlib.contextmanager
+def track_writes() -> Iterator[set[str]]:
+    """
+    Relève les fichiers et dossiers modifiés par le fil d'exécution courant
+    pendant le bloc: ce sont ceux à synchroniser pour rendre ses écritures
+    durables (voir GroupCommit).
+    """
+    previous = getattr(_tracking, "paths", None)
+    _tracking.paths = set()
+    try:
+        yield _tracking.paths
+    finally:
+        _tracking.paths = previous
+
+
+def _track(*paths: str) -> None:
+    """Note des fichiers ou dossiers modifiés (voir `track_writes`)."""
+    tracked = getattr(_tracking, "paths", None)
+    if tracked is not None:
+        tracked.update(paths)
+
+
+def _write_atomic(path: str, write: Callable[[BinaryIO], None]) -> None:
+    """
+    Écrit un fichier d'un seul coup: `write` l'écrit dans un fichier
+    temporaire du même dossier, renommé ensuite. Un arrêt brutal ne laisse
+    jamais de fichier partiel sous le nom `path`.
+    """
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as file:
+            write(file)
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+    _track(path, directory)
+
+
+def sync_paths(paths: Iterable[str]) -> None:
+    """
+    Synchronise sur disque des fichiers et des dossiers: les contenus
+    d'abord, puis les dossiers qui les nomment, puis les index qui y font
+    référence, pour qu'un index durable ne désigne pas un contenu perdu.
+    Les fichiers supprimés entre-temps sont ignorés.
+    """
+    def _rank(path: str) -> int:
+        if os.path.basename(path) == gloutils.INDEX_FILENAME:
+            return 2
+        return 1 if os.path.isdir(path) else 0
+
+    for path in sorted(paths, key=_rank):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+        except OSError:
+            # Dossiers impossibles à ouvrir (Windows): rien à synchroniser.
+            continue
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class GroupCommit:
+    """
+    Confirmation des remises selon le niveau de durabilité.
+
+    Avec DURABILITY_NONE, une remise est confirmée dès que ses écritures
+    sont faites: un arrêt du serveur ne perd rien, mais une panne du
+    système peut perdre les dernières remises. Avec DURABILITY_SYNC, chaque
+    remise synchronise ses fichiers avant d'être confirmée. Avec
+    DURABILITY_BATCH, les remises sont confiées à un fil d'exécution qui
+    synchronise d'un coup toutes celles arrivées pendant la synchronisation
+    précédente (group commit): un index, un segment ou un dossier modifié
+    par plusieurs remises n'est synchronisé qu'une fois par lot.
+
+    `on_batch`, s'il est donné, est appelée après chaque lot avec le nombre
+    de remises et la durée de la synchronisation. `close` synchronise les
+    remises en attente et arrête le fil d'exécution.
+    """
+
+    def __init__(self, durability: str = DURABILITY_BATCH,
+                 on_batch: Optional[Callable[[int, float], None]] = None
+                 ) -> None:
+        self.durability = durability
+        self._on_batch = on_batch
+        self._pending: list[tuple[set[str], concurrent.futures.Future,
+                                  Any]] = []
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+
+    def commit(self, paths: set[str], result: Any) -> Any:
+        """
+        Confirme une remise dont les écritures ont modifié `paths` (voir
+        `track_writes`). Retourne `result`, après synchronisation selon le
+        niveau de durabilité, ou, avec DURABILITY_BATCH, un Future qui
+        prendra la valeur `result` une fois le lot synchronisé.
+        """
+        if self.durability == DURABILITY_NONE or not paths:
+            return result
+        if self.durability == DURABILITY_BATCH:
+            future: concurrent.futures.Future = concurrent.futures.Future()
+            with self._condition:
+                # Après `close`, les remises sont synchronisées une à une.
+                if not self._closed:
+                    if self._thread is None:
+                        self._thread = threading.Thread(
+                            target=self._run, name="group-commit",
+                            daemon=True)
+                        self._thread.start()
+                    self._pending.append((paths, future, result))
+                    self._condition.notify()
+                    return future
+        start = time.perf_counter()
+        sync_paths(paths)
+        if self._on_batch is not None:
+            self._on_batch(1, time.perf_counter() - start)
+        return result
+
+    def close(self) -> None:
+        """
+        Synchronise les remises en attente, confirme leurs Future et arrête
+        le fil d'exécution.
+        """
+        with self._condition:
+            self._closed = True
+            thread = self._thread
+            self._condition.notify()
+        if thread is not None:
+            thread.join()
+
+    def _run(self) -> None:
+        """Synchronise les lots de remises en attente, jusqu'à `close`."""
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                batch, self._pending = self._pending, []
+            start = time.perf_counter()
+            try:
+                sync_paths(set().union(*(paths for paths, _, _ in batch)))
+            except OSError as ex:
+                for _, future, _ in batch:
+                    future.set_exception(ex)
+                continue
+            if self._on_batch is not None:
+                self._on_batch(len(batch), time.perf_counter() - start)
+            for _, future, result in batch:
+                future.set_result(result)
+
+
+def map_file(path: str, offset: int = 0,
+             length: Optional[int] = None) -> memoryview:
+    """
+    Projette un fichier en mémoire, en lecture seule, et retourne la vue
+    des octets demandés. La projection est libérée avec la dernière vue.
+    Un fichier vide, qui ne peut être projeté, donne une vue vide.
+    """
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return memoryview(b"")
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    return view[offset:] if length is None else view[offset:offset + length]
+
+
+class MailboxIndex:
+    """
+    Index persistant d'une boîte de courriels.
+
+    Chaque courriel reçu ajoute une ligne JSON au fichier INDEX_FILENAME
+    du dossier de l'utilisateur, et chaque suppression une ligne de retrait
+    désignant l'entrée par sa clé `_KEY`. L'index est lu une seule fois puis
+    gardé en mémoire avec le total des tailles et celui de l'espace occupé
+    (voir IndexEntry), de sorte que la liste, l'accès au N-ième courriel et
+    les statistiques ne parcourent plus le dossier.
+
+    Les courriels sont numérotés à partir de 1, du plus récent au plus
+    ancien, comme dans le gabarit SUBJECT_DISPLAY.
+    """
+
+    _KEY = "filename"
+    _LOCK_NAME = _LOCK_FILENAME
+
+    def __init__(self, user_dir: str) -> None:
+        self._user_dir = user_dir
+        self._path = os.path.join(user_dir, gloutils.INDEX_FILENAME)
+        self._lock = threading.Lock()
+        self._entries: list[IndexEntry] = []
+        # Position de chaque entrée dans `_entries`, par clé.
+        self._positions: dict[str, int] = {}
+        self._size = 0
+        self._physical = 0
+        # Clés des entrées de chaque contenu partagé, par empreinte.
+        self._shared: dict[str, set[str]] = {}
+        self._offset = 0
+        self._inode: Optional[int] = None
+        self._lock_fd: Optional[int] = None
+
+    def _load(self) -> list[IndexEntry]:
+        """
+        Met à jour l'index en mémoire et le retourne.
+
+        Seules les lignes ajoutées depuis le dernier accès, éventuellement
+        par un autre processus du serveur, sont lues; le fichier n'est relu
+        en entier que s'il a été remplacé (reconstruction ou compactage).
+        L'index est reconstruit s'il n'existe pas encore.
+        """
+        try:
+            stat = os.stat(self._path)
+        except FileNotFoundError:
+            self._create()
+            stat = os.stat(self._path)
+        if stat.st_ino != self._inode or stat.st_size < self._offset:
+            self._reset(stat.st_ino)
+        if stat.st_size > self._offset:
+            self._read_tail()
+        return self._entries
+
+    def _create(self) -> None:
+        """Construit le fichier d'index avec `_scan` s'il n'existe pas."""
+        if os.path.exists(self._path):
+            return
+        with self._file_lock():
+            if not os.path.exists(self._path):
+                self._write_all(self._scan())
+
+    def _reset(self, inode: int) -> None:
+        """Vide l'index en mémoire avant de relire le fichier `inode`."""
+        self._entries = []
+        self._positions = {}
+        self._size = 0
+        self._physical = 0
+        self._shared = {}
+        self._offset = 0
+        self._inode = inode
+
+    def _read_tail(self) -> None:
+        """
+        Applique les lignes complètes ajoutées au fichier depuis `_offset`.
+        Une ligne incomplète, en cours d'écriture ou laissée par un arrêt
+        brutal, est ignorée.
+        """
+        with open(self._path, "rb") as index_file:
+            index_file.seek(self._offset)
+            data = index_file.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            self._apply(json.loads(line))
+        self._offset += end
+
+    def _apply(self, record: dict) -> None:
+        """Applique à l'index en mémoire une ligne du fichier."""
+        if "removed" in record:
+            kept = []
+            for entry in self._entries:
+                if entry[self._KEY] != record["removed"]:
+                    kept.append(entry)
+                    continue
+                self._size -= entry["size"]
+                self._physical -= entry.get("physical", entry["size"])
+                if "digest" in entry:
+                    self._shared[entry["digest"]].discard(entry[self._KEY])
+            if len(kept) < len(self._entries):
+                self._positions = {entry[self._KEY]: position
+                                   for position, entry in enumerate(kept)}
+            self._entries = kept
+        elif "reshare" in record:
+            for key in self._shared.get(record["reshare"], ()):
+                entry = self._entries[self._positions[key]]
+                physical = (entry["size"] - record["body_size"]
+                            + record["share"])
+                self._physical += physical - entry.get("physical",
+                                                       entry["size"])
+                entry["physical"] = physical
+        else:
+            self._positions[record[self._KEY]] = len(self._entries)
+            self._entries.append(record)
+            self._size += record["size"]
+            self._physical += record.get("physical", record["size"])
+            if "digest" in record:
+                self._shared.setdefault(record["digest"], set()).add(
+                    record[self._KEY])
+
+    @contextlib.contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        """
+        Verrou exclusif sur la boîte, partagé entre les processus du serveur
+        (sans effet là où fcntl n'est pas disponible). Doit être pris en
+        tenant `_lock`; il peut alors être repris sans se bloquer.
+        """
+        if fcntl is None or self._lock_fd is not None:
+            yield
+            return
+        self._lock_fd = os.open(os.path.join(self._user_dir, self._LOCK_NAME),
+                                os.O_RDWR | os.O_CREAT)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _scan(self) -> list[IndexEntry]:
+        """
+        Reconstruit les entrées d'un dossier qui n'a pas encore d'index, en
+        lisant une dernière fois chaque courriel, du plus ancien au plus
+        récent.
+
+        Les courriels nommés d'après leur identifiant sont triés par nom;
+        les fichiers plus anciens, nommés d'après leur date d'envoi, sont
+        placés avant eux dans l'ordre de leur dernière modification. Les
+        talons dont le contenu a disparu sont ignorés.
+        """
+        entries = []
+        ignored = {gloutils.PASSWORD_FILENAME, gloutils.INDEX_FILENAME}
+        files = [entry for entry in os.scandir(self._user_dir)
+                 if entry.is_file() and entry.name not in ignored
+                 and entry.name.endswith(".json")]
+        files.sort(key=lambda entry: (
+            (1, 0.0, entry.name) if _MESSAGE_FILENAME.match(entry.name)
+            else (0, entry.stat().st_mtime, entry.name)))
+        for file in files:
+            with open(file.path, "r") as email_file:
+                try:
+                    email = json.load(email_file)
+                except ValueError:
+                    # Fichier tronqué par une panne avant sa synchronisation.
+                    continue
+            if "digest" in email:
+                fields = _stub_fields(
+                    email, os.path.join(self._user_dir, email["body"]))
+                if fields is not None:
+                    entries.append(IndexEntry(fields, filename=file.name))
+                continue
+            wire = "header" in email
+            if wire:
+                email = email["payload"]
+            entries.append(IndexEntry(sender=email["sender"],
+                                      subject=email["subject"],
+                                      date=email["date"],
+                                      size=file.stat().st_size,
+                                      wire=wire,
+                                      filename=file.name))
+        return entries
+
+    def _write_all(self, entries: list) -> None:
+        """Remplace atomiquement le fichier d'index par `entries`."""
+        temp_path = self._path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as index_file:
+            for entry in entries:
+                index_file.write(json.dumps(entry) + "\n")
+            index_file.flush()
+            os.fsync(index_file.fileno())
+        os.replace(temp_path, self._path)
+
+    def _append_lines(self, records: list, track: bool = True,
+                      create: bool = True) -> None:
+        """
+        Ajoute des lignes au fichier d'index, relevé par `track_writes` si
+        `track` est vrai. Si `create` est faux, le fichier doit exister.
+
+        Les lignes sont écrites en un seul appel en mode ajout, pour qu'un
+        arrêt brutal ne laisse au pire qu'une ligne incomplète, ignorée
+        à la lecture.
+        """
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        fd = os.open(self._path, os.O_WRONLY | os.O_APPEND
+                     | (os.O_CREAT if create else 0))
+        try:
+            os.write(fd, lines.encode("utf-8"))
+        finally:
+            os.close(fd)
+        if track:
+            _track(self._path)
+
+    def load(self) -> None:
+        """
+        Charge l'index, en le reconstruisant au besoin. Doit être appelée
+        avant d'écrire un nouveau courriel dans le dossier, pour que la
+        reconstruction ne le compte pas une seconde fois.
+        """
+        with self._lock:
+            self._load()
+
+    def append(self, entry: IndexEntry) -> None:
+        """Ajoute un courriel à l'index."""
+        self.extend([entry])
+
+    def extend(self, entries: list[IndexEntry]) -> None:
+        """Ajoute plusieurs courriels à l'index, en une seule écriture."""
+        with self._lock, self._file_lock():
+            self._load()
+            self._append_lines(entries)
+            self._load()
+
+    def remove(self, number: int) -> Optional[IndexEntry]:
+        """Retire de l'index le N-ième courriel le plus récent et le retourne."""
+        with self._lock, self._file_lock():
+            entries = self._load()
+            if not 1 <= number <= len(entries):
+                return None
+            entry = entries[len(entries) - number]
+            self._append_lines([{"removed": entry[self._KEY]}])
+            self._load()
+            return entry
+
+    def reshare(self, digest: str, body_size: int, share: int) -> None:
+        """
+        Fixe à `share` octets la part du contenu partagé d'empreinte
+        `digest`, de `body_size` octets, qui revient à chaque courriel de
+        la boîte qui y fait référence (voir IndexEntry).
+        """
+        with self._lock, self._file_lock():
+            self._load()
+            if self._shared.get(digest):
+                self._append_lines([{"reshare": digest,
+                                     "body_size": body_size,
+                                     "share": share}])
+                self._load()
+
+    def key(self, entry: IndexEntry) -> str:
+        """Retourne la clé qui désigne l'entrée dans le fichier d'index."""
+        return entry[self._KEY]
+
+    def entries(self) -> list[IndexEntry]:
+        """Retourne les entrées du plus récent au plus ancien."""
+        with self._lock:
+            return self._load()[::-1]
+
+    def page(self, offset: int, limit: Optional[int]
+             ) -> tuple[list[IndexEntry], int]:
+        """
+        Retourne au plus `limit` entrées (toutes si `limit` est None), du
+        plus récent au plus ancien, en sautant les `offset` plus récentes,
+        ainsi que le nombre total d'entrées.
+        """
+        with self._lock:
+            entries = self._load()
+            total = len(entries)
+            stop = max(total - offset, 0)
+            start = 0 if limit is None else max(stop - limit, 0)
+            return entries[start:stop][::-1], total
+
+    def get(self, number: int) -> Optional[IndexEntry]:
+        """Retourne l'entrée du N-ième courriel le plus récent."""
+        with self._lock:
+            entries = self._load()
+            if 1 <= number <= len(entries):
+                return entries[len(entries) - number]
+        return None
+
+    def locate(self, keys: Iterable[str]) -> list[tuple[int, IndexEntry]]:
+        """
+        Retourne le numéro et l'entrée des courriels désignés par leur clé,
+        du plus récent au plus ancien, sans parcourir la boîte. Les clés
+        absentes de l'index sont ignorées.
+        """
+        with self._lock:
+            entries = self._load()
+            located = []
+            for key in keys:
+                position = self._positions.get(key)
+                if position is not None:
+                    located.append((len(entries) - position,
+                                    entries[position]))
+            located.sort(key=lambda item: item[0])
+            return located
+
+    def stats(self) -> tuple[int, int]:
+        """Retourne le nombre de courriels et leur taille totale."""
+        with self._lock:
+            return len(self._load()), self._size
+
+    def physical_size(self) -> int:
+        """Retourne l'espace occupé par les courriels (voir IndexEntry)."""
+        with self._lock:
+            self._load()
+            return self._physical
+
+
+class SegmentEntry(MessageHeader, total=True):
+    """
+    Entrée de l'index d'une boîte stockée en segments.
+
+    Comme pour IndexEntry, les champs `destination`, `digest` et `body`
+    désignent le contenu d'un courriel placé dans le magasin BodyStore;
+    l'enregistrement est alors son talon.
+    """
+    id: str
+    segment: str
+    offset: int
+    length: int
+    destination: NotRequired[str]
+    digest: NotRequired[str]
+    body: NotRequired[str]
+    physical: NotRequired[int]
+
+
+class SegmentIndex(MailboxIndex):
+    """
+    Index d'une boîte stockée dans des segments en ajout seul.
+
+    Un segment est un fichier d'enregistrements préfixés par leur taille
+    ("!I"), chacun contenant un courriel en JSON. Chaque entrée de l'index
+    donne le segment, la position et la taille de son enregistrement. Les
+    courriels supprimés restent dans leur segment, où une pierre tombale
+    les désigne, jusqu'au compactage, qui réécrit les enregistrements
+    vivants dans un nouveau segment puis remplace l'index d'un seul coup.
+
+    Un courriel dont le contenu est dans le magasin BodyStore n'a dans
+    son segment que son talon (voir `append_stub`): le compactage ne
+    recopie jamais son contenu.
+    """
+
+    _KEY = "id"
+
+    def __init__(self, user_dir: str) -> None:
+        super().__init__(user_dir)
+        self._segment: Optional[str] = None
+
+    def _reset(self, inode: int) -> None:
+        super()._reset(inode)
+        self._segment = None
+
+    def _segment_names(self) -> list[str]:
+        """Retourne les noms des segments du dossier, du plus ancien."""
+        return sorted(name for name in os.listdir(self._user_dir)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    def _records(self, name: str) -> Iterator[tuple[int, int, dict]]:
+        """
+        Parcourt les enregistrements du segment `name` et retourne, pour
+        chacun, la position et la taille de ses données et son contenu.
+        """
+        with open(os.path.join(self._user_dir, name), "rb") as segment:
+            offset = 0
+            while True:
+                prefix = segment.read(_RECORD_PREFIX.size)
+                if len(prefix) < _RECORD_PREFIX.size:
+                    return
+                length, = _RECORD_PREFIX.unpack(prefix)
+                data = segment.read(length)
+                if len(data) < length:
+                    return
+                try:
+                    record = json.loads(data)
+                except ValueError:
+                    # Fin du segment perdue dans une panne avant sa
+                    # synchronisation.
+                    return
+                offset += _RECORD_PREFIX.size
+                yield offset, length, record
+                offset += length
+
+    def _scan(self) -> list[SegmentEntry]:
+        """
+        Reconstruit l'index à partir des segments.
+
+        Les pierres tombales retirent les courriels supprimés depuis le
+        dernier compactage. Un segment compacté commence par la taille des
+        segments qu'il remplace: les enregistrements recopiés de ces
+        derniers, s'ils n'ont pas encore été supprimés, sont ignorés. Ceux
+        qui y ont été ajoutés après un compactage interrompu sont les plus
+        récents.
+
+        Les clés des entrées sont renouvelées: l'index de recherche de la
+        boîte, qui les désigne, est retiré pour être reconstruit avec elles.
+        """
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(os.path.join(self._user_dir,
+                                   gloutils.SEARCH_INDEX_FILENAME))
+        entries = []
+        removed = set()
+        replaced: dict[str, int] = {}
+        for name in self._segment_names():
+            for offset, length, email in self._records(name):
+                if "compacted" in email:
+                    replaced.update(email["compacted"])
+                    continue
+                if "removed" in email:
+                    removed.add(tuple(email["removed"]))
+                    continue
+                location = {"id": gloutils.new_message_id(),
+                            "segment": name, "offset": offset,
+                            "length": length}
+                if "digest" in email:
+                    fields = _stub_fields(
+                        email, os.path.join(self._user_dir, email["body"]))
+                    if fields is not None:
+                        entries.append(SegmentEntry(fields, **location))
+                    continue
+                wire = "header" in email
+                if wire:
+                    email = email["payload"]
+                entries.append(SegmentEntry(
+                    sender=email["sender"], subject=email["subject"],
+                    date=email["date"], size=length, wire=wire, **location))
+        entries = [entry for entry in entries
+                   if (entry["segment"], entry["offset"]) not in removed
+                   and entry["offset"] >= replaced.get(entry["segment"], 0)]
+        entries.sort(key=lambda entry: entry["segment"] in replaced)
+        return entries
+
+    def _current_segment(self) -> str:
+        """Retourne le segment auquel ajouter les nouveaux courriels."""
+        if self._segment is None:
+            entries = self._load()
+            self._segment = (entries[-1]["segment"] if entries else
+                             gloutils.new_message_id() + SEGMENT_SUFFIX)
+        return self._segment
+
+    def _append(self, records: list[tuple[gloutils.EmailStreamStartPayload,
+                                          bytes, dict]]
+                ) -> list[SegmentEntry]:
+        """
+        Ajoute les enregistrements `data` de chaque triplet `(email, data,
+        fields)` à la fin du segment courant, en une seule écriture, puis
+        leurs entrées à l'index, complétées par `fields`, et retourne ces
+        entrées.
+        """
+        with self._lock, self._file_lock():
+            self._load()
+            segment, offset = self._write_records(
+                [data for _, data, _ in records])
+            entries = []
+            for email, data, fields in records:
+                offset += _RECORD_PREFIX.size
+                entry = SegmentEntry(sender=email["sender"],
+                                     subject=email["subject"],
+                                     date=email["date"], size=len(data),
+                                     wire=True, id=gloutils.new_message_id(),
+                                     segment=segment, offset=offset,
+                                     length=len(data))
+                entry.update(fields)
+                entries.append(entry)
+                offset += len(data)
+            self._append_lines(entries)
+            self._load()
+            return entries
+
+    def _write_records(self, records: list[bytes]) -> tuple[str, int]:
+        """
+        Ajoute les enregistrements à la fin du segment courant, en une
+        seule écriture, et retourne le segment et la position du premier.
+        Doit être appelée en tenant les verrous de la boîte.
+        """
+        segment = self._current_segment()
+        fd = os.open(os.path.join(self._user_dir, segment),
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            offset = os.fstat(fd).st_size
+            os.write(fd, b"".join(_RECORD_PREFIX.pack(len(data)) + data
+                                  for data in records))
+        finally:
+            os.close(fd)
+        _track(os.path.join(self._user_dir, segment), self._user_dir)
+        return segment, offset
+
+    def remove(self, number: int) -> Optional[SegmentEntry]:
+        """
+        Retire de l'index le N-ième courriel le plus récent et le retourne.
+
+        Une pierre tombale désignant son enregistrement est d'abord ajoutée
+        au segment courant, pour que la suppression survive à une
+        reconstruction de l'index.
+        """
+        with self._lock, self._file_lock():
+            entries = self._load()
+            if not 1 <= number <= len(entries):
+                return None
+            entry = entries[len(entries) - number]
+            self._write_records([json.dumps(
+                {"removed": [entry["segment"], entry["offset"]]}
+            ).encode("utf-8")])
+            self._append_lines([{"removed": entry["id"]}])
+            self._load()
+            return entry
+
+    def append_record(self, email: gloutils.EmailContentPayload) -> str:
+        """
+        Ajoute le courriel à la fin du segment courant, puis à l'index, et
+        retourne sa clé.
+        """
+        return self._append([(email, encode_wire(email), {})])[0]["id"]
+
+    def extend_records(self, records: list[tuple[MessageHeader, bytes]]
+                       ) -> list[str]:
+        """
+        Ajoute des courriels déjà encodés, chacun avec son en-tête, en une
+        seule écriture du segment et de l'index, et retourne leurs clés.
+        """
+        return [entry["id"] for entry in self._append(
+            [(header, data, {"wire": header.get("wire", False)})
+             for header, data in records])]
+
+    def append_stub(self, email: gloutils.EmailStreamStartPayload,
+                    digest: str, body: str, size: int, physical: int) -> str:
+        """
+        Ajoute le talon d'un courriel de `size` octets, qui occupe
+        `physical` octets, dont le contenu, dans le magasin BodyStore, est
+        déjà lié dans la boîte sous le nom `body`, et retourne sa clé.
+        """
+        return self._append([(email, _encode_stub(email, digest, body),
+                              dict(size=size, wire=False,
+                                   destination=email["destination"],
+                                   digest=digest, body=body,
+                                   physical=physical))])[0]["id"]
+
+    def read_record(self, entry: SegmentEntry) -> bytes:
+        """Lit l'enregistrement d'une entrée en un seul pread."""
+        fd = os.open(os.path.join(self._user_dir, entry["segment"]),
+                     os.O_RDONLY)
+        try:
+            return os.pread(fd, entry["length"], entry["offset"])
+        finally:
+            os.close(fd)
+
+    def map_record(self, entry: SegmentEntry) -> memoryview:
+        """Retourne l'enregistrement d'une entrée, projeté en mémoire."""
+        return map_file(os.path.join(self._user_dir, entry["segment"]),
+                        entry["offset"], entry["length"])
+
+    def read_newest(self, number: int,
+                    read: Callable[[SegmentEntry], Any]) -> Any:
+        """
+        Retourne `read(entry)` pour l'entrée du N-ième courriel le plus
+        récent, ou None s'il n'existe pas.
+
+        La lecture se fait sans les verrous de la boîte: un compactage peut
+        supprimer le segment de l'entrée entre-temps. L'entrée est alors
+        relue dans l'index, à sa nouvelle place, et lue de nouveau.
+        """
+        entry = self.get(number)
+        while entry is not None:
+            try:
+                return read(entry)
+            except FileNotFoundError:
+                moved = self.get(number)
+                if moved is not None and all(
+                        moved[field] == entry[field]
+                        for field in ("id", "segment", "offset")):
+                    raise
+                entry = moved
+        return None
+
+    def garbage_ratio(self) -> float:
+        """Proportion des octets des segments qui ne sont plus indexés."""
+        with self._lock:
+            self._load()
+            total = sum(os.path.getsize(os.path.join(self._user_dir, name))
+                        for name in self._segment_names())
+            live = sum(_RECORD_PREFIX.size + entry["length"]
+                       for entry in self._entries)
+            return 0.0 if not total else 1 - live / total
+
+    def compact(self) -> None:
+        """
+        Réécrit les courriels vivants dans un nouveau segment, remplace
+        l'index, puis supprime les anciens segments.
+
+        Le nouveau segment est écrit sous un nom temporaire, ignoré par
+        `_scan`, puis renommé une fois synchronisé. Il commence par la
+        taille des segments qu'il remplace: si un arrêt brutal survient
+        avant leur suppression, une reconstruction de l'index ne compte pas
+        leurs courriels deux fois. Les restes d'un compactage interrompu
+        sont supprimés au compactage suivant.
+        """
+        with self._lock, self._file_lock():
+            entries = self._load()
+            old_segments = self._segment_names()
+            compacted = []
+            if entries:
+                segment = gloutils.new_message_id() + SEGMENT_SUFFIX
+                path = os.path.join(self._user_dir, segment)
+                header = json.dumps({"compacted": {
+                    name: os.path.getsize(os.path.join(self._user_dir, name))
+                    for name in old_segments}}).encode("utf-8")
+                with open(path + ".tmp", "wb") as output:
+                    output.write(_RECORD_PREFIX.pack(len(header)) + header)
+                    offset = _RECORD_PREFIX.size + len(header)
+                    for entry in entries:
+                        data = self.read_record(entry)
+                        output.write(_RECORD_PREFIX.pack(len(data)) + data)
+                        compacted.append(SegmentEntry(
+                            entry, segment=segment,
+                            offset=offset + _RECORD_PREFIX.size))
+                        offset += _RECORD_PREFIX.size + len(data)
+                    output.flush()
+                    os.fsync(output.fileno())
+                os.replace(path + ".tmp", path)
+            self._write_all(compacted)
+            for name in old_segments:
+                os.remove(os.path.join(self._user_dir, name))
+            for name in os.listdir(self._user_dir):
+                if name.endswith(SEGMENT_SUFFIX + ".tmp"):
+                    os.remove(os.path.join(self._user_dir, name))
+            self._load()
+
+
+class LostEntry(MessageHeader, total=True):
+    """
+    Entrée de l'index des courriels perdus: le destinataire introuvable
+    `recipient` d'un courriel conservé dans le fichier `filename`, reçu à
+    la date `stored`, en secondes depuis l'époque. Un courriel adressé à
+    plusieurs destinataires introuvables n'est conservé qu'une fois, avec
+    une entrée par destinataire.
+    """
+    id: str
+    recipient: str
+    filename: str
+    stored: float
+
+
+def _local_recipients(destination: str) -> list[str]:
+    """
+    Retourne les noms d'utilisateur, en minuscules et sans doublons, des
+    adresses de SERVER_DOMAIN du champ `destination`.
+    """
+    usernames: dict[str, None] = {}
+    for address in destination.split(gloutils.RECIPIENT_SEPARATOR):
+        username, at, domain = address.strip().partition("@")
+        if at and username and domain == gloutils.SERVER_DOMAIN:
+            usernames[username.lower()] = None
+    return list(usernames)
+
+
+class LostIndex(MailboxIndex):
+    """
+    Index, par destinataire, des courriels perdus du dossier
+    SERVER_LOST_DIR.
+
+    Comme pour une boîte, chaque courriel perdu ajoute au fichier
+    INDEX_FILENAME du dossier une ligne par destinataire introuvable, et
+    chaque retrait une ligne désignant l'entrée. En mémoire, les entrées
+    sont regroupées par destinataire: retrouver les courriels en attente
+    d'un compte ne parcourt plus le dossier. Les courriels n'y sont pas
+    numérotés: seules `add`, `redeliver` et `stats` s'appliquent.
+
+    Le dossier est borné: au-delà de `max_size` octets, ou après `max_age`
+    secondes, les courriels les plus anciens sont évincés à l'ajout
+    suivant. Un fichier n'est supprimé qu'avec la dernière entrée qui le
+    désigne.
+    """
+
+    _KEY = "id"
+
+    def __init__(self, lost_dir: str, max_size: int = LOST_MAX_SIZE,
+                 max_age: float = LOST_MAX_AGE) -> None:
+        super().__init__(lost_dir)
+        self._max_size = max_size
+        self._max_age = max_age
+        self._pending: dict[str, LostEntry] = {}
+        self._recipients: dict[str, dict[str, None]] = {}
+        self._references: collections.Counter[str] = collections.Counter()
+
+    def _reset(self, inode: int) -> None:
+        super()._reset(inode)
+        self._pending = {}
+        self._recipients = {}
+        self._references = collections.Counter()
+
+    def _apply(self, record: dict) -> None:
+        """
+        Applique une ligne du fichier. La taille d'un fichier n'est comptée
+        qu'une fois, quel que soit le nombre d'entrées qui le désignent.
+        """
+        if "removed" not in record:
+            self._pending[record["id"]] = record
+            self._recipients.setdefault(
+                record["recipient"], {})[record["id"]] = None
+            if not self._references[record["filename"]]:
+                self._size += record["size"]
+            self._references[record["filename"]] += 1
+            return
+        entry = self._pending.pop(record["removed"], None)
+        if entry is None:
+            return
+        ids = self._recipients[entry["recipient"]]
+        del ids[entry["id"]]
+        if not ids:
+            del self._recipients[entry["recipient"]]
+        self._references[entry["filename"]] -= 1
+        if not self._references[entry["filename"]]:
+            del self._references[entry["filename"]]
+            self._size -= entry["size"]
+
+    def _scan(self) -> list[LostEntry]:
+        """
+        Indexe les courriels d'un dossier qui n'a pas encore d'index, du
+        plus ancien au plus récent, sous chaque adresse de SERVER_DOMAIN de
+        leur destinataire. Les courriels sont lus une dernière fois, qu'ils
+        soient au format de transmission ou non.
+        """
+        entries = []
+        files = [entry for entry in os.scandir(self._user_dir)
+                 if entry.is_file() and entry.name.endswith(".json")]
+        files.sort(key=lambda entry: (entry.stat().st_mtime, entry.name))
+        for file in files:
+            with open(file.path, "r") as email_file:
+                try:
+                    email = json.load(email_file)
+                except ValueError:
+                    # Fichier tronqué par une panne avant sa synchronisation.
+                    continue
+            wire = "header" in email
+            if wire:
+                email = email["payload"]
+            stat = file.stat()
+            for recipient in _local_recipients(email["destination"]):
+                entries.append(LostEntry(sender=email["sender"],
+                                         subject=email["subject"],
+                                         date=email["date"],
+                                         size=stat.st_size, wire=wire,
+                                         id=gloutils.new_message_id(),
+                                         recipient=recipient,
+                                         filename=file.name,
+                                         stored=stat.st_mtime))
+        return entries
+
+    def _expired(self) -> list[LostEntry]:
+        """
+        Retourne les entrées les plus anciennes à évincer pour respecter
+        les limites du dossier.
+        """
+        deadline = time.time() - self._max_age
+        size = self._size
+        released: collections.Counter[str] = collections.Counter()
+        expired = []
+        for entry in self._pending.values():
+            if size <= self._max_size and entry["stored"] >= deadline:
+                break
+            expired.append(entry)
+            released[entry["filename"]] += 1
+            if (released[entry["filename"]]
+                    == self._references[entry["filename"]]):
+                size -= entry["size"]
+        return expired
+
+    def _remove(self, entries: list[LostEntry]) -> None:
+        """
+        Retire les entrées de l'index, puis supprime les fichiers qui ne
+        sont plus désignés par aucune entrée.
+        """
+        if not entries:
+            return
+        self._append_lines([{"removed": entry["id"]} for entry in entries])
+        self._load()
+        for filename in {entry["filename"] for entry in entries}:
+            if filename not in self._references:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self._user_dir, filename))
+
+    def path(self, entry: LostEntry) -> str:
+        """Retourne le chemin du fichier d'une entrée."""
+        return os.path.join(self._user_dir, entry["filename"])
+
+    def add(self, entries: list[LostEntry]) -> None:
+        """
+        Ajoute les entrées d'un courriel déjà écrit dans le dossier, puis
+        évince les courriels au-delà des limites.
+        """
+        with self._lock, self._file_lock():
+            self._load()
+            self._append_lines(entries)
+            self._load()
+            self._remove(self._expired())
+
+    def redeliver(self, recipient: str,
+                  deliver: Callable[[list[LostEntry]], None]) -> int:
+        """
+        Passe à `deliver` les entrées en attente du destinataire, de la
+        plus ancienne à la plus récente, puis les retire du dossier.
+
+        `deliver` est appelée en tenant le verrou du dossier: un courriel
+        n'est ni remis deux fois, ni évincé pendant sa remise. Retourne le
+        nombre de courriels remis.
+        """
+        recipient = recipient.lower()
+        with self._lock:
+            self._load()
+            if recipient not in self._recipients:
+                return 0
+            with self._file_lock():
+                self._load()
+                entries = [self._pending[entry_id] for entry_id
+                           in self._recipients.get(recipient, ())]
+                if entries:
+                    deliver(entries)
+                    self._remove(entries)
+                return len(entries)
+
+    def stats(self) -> tuple[int, int]:
+        """
+        Retourne le nombre d'entrées en attente et la taille totale des
+        fichiers qu'elles désignent.
+        """
+        with self._lock:
+            self._load()
+            return len(self._pending), self._size
+
+
+def search_terms(*texts: str) -> list[str]:
+    """
+    Retourne les termes distincts des textes pour la recherche: leurs mots
+    de SEARCH_MIN_WORD à SEARCH_MAX_WORD caractères, en minuscules et sans
+    accents, de sorte que « Été » et « ete » se retrouvent. Seuls les
+    SEARCH_CONTENT_LIMIT premiers caractères de chaque texte sont lus.
+    """
+    # Le texte n'est découpé par expression régulière, et ses accents
+    # retirés, qu'une fois séparé aux espaces et dédoublonné.
+    tokens = set()
+    for text in texts:
+        tokens.update(text[:SEARCH_CONTENT_LIMIT].casefold().split())
+    words = []
+    for token in tokens:
+        if not token.isascii():
+            token = _DIACRITICS.sub("", unicodedata.normalize("NFKD", token))
+        words += _SEARCH_WORD.findall(token)
+    return sorted({word for word in words
+                   if SEARCH_MIN_WORD <= len(word) <= SEARCH_MAX_WORD})
+
+
+def _email_terms(email: gloutils.EmailStreamStartPayload,
+                 content: str) -> list[str]:
+    """Retourne les termes de l'expéditeur, du sujet et du contenu."""
+    return search_terms(email["sender"], email["subject"], content)
+
+
+class InvertedIndex:
+    """
+    Index inversé en mémoire: chaque terme donne l'ensemble des clés des
+    courriels qui le contiennent. N'est pas protégé contre les accès
+    concurrents.
+    """
+
+    def __init__(self) -> None:
+        self._documents: dict[str, list[str]] = {}
+        self._postings: dict[str, set[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def add(self, key: str, terms: list[str]) -> None:
+        """Indexe les termes d'un courriel, s'il ne l'est pas déjà."""
+        if key in self._documents:
+            return
+        self._documents[key] = terms
+        for term in terms:
+            self._postings.setdefault(term, set()).add(key)
+
+    def discard(self, key: str) -> None:
+        """Retire un courriel de l'index, s'il y figure."""
+        for term in self._documents.pop(key, ()):
+            keys = self._postings[term]
+            keys.discard(key)
+            if not keys:
+                del self._postings[term]
+
+    def documents(self) -> list[tuple[str, list[str]]]:
+        """Retourne la clé et les termes de chaque courriel indexé."""
+        return list(self._documents.items())
+
+    def search(self, terms: Sequence[str]) -> set[str]:
+        """
+        Retourne les clés des courriels qui contiennent tous les termes, en
+        partant de l'ensemble le plus petit.
+        """
+        postings = sorted((self._postings.get(term, set())
+                           for term in terms), key=len)
+        if not postings:
+            return set()
+        return postings[0].intersection(*postings[1:])
+
+
+class SearchIndex(MailboxIndex):
+    """
+    Index de recherche d'une boîte de courriels.
+
+    Chaque courriel remis ajoute au fichier SEARCH_INDEX_FILENAME du
+    dossier de l'utilisateur une ligne JSON donnant sa clé dans l'index de
+    la boîte et ses termes (voir `search_terms`), et chaque suppression
+    une ligne de retrait; les lignes sont relues dans un InvertedIndex.
+    L'index n'est chargé qu'à la première recherche: un ajout ou un
+    retrait n'est qu'une écriture en fin de fichier.
+
+    Le fichier est construit à partir des courriels de la boîte (voir
+    `documents`) s'il n'existe pas, et réécrit, à une suppression, lorsque
+    ses lignes inutiles dépassent COMPACTION_THRESHOLD des lignes: une
+    recherche ne fait que lire les lignes ajoutées depuis la précédente.
+    """
+
+    _LOCK_NAME = _SEARCH_LOCK_FILENAME
+
+    def __init__(self, user_dir: str,
+                 documents: Callable[[], list[tuple[str, list[str]]]]
+                 ) -> None:
+        super().__init__(user_dir)
+        self._path = os.path.join(user_dir, gloutils.SEARCH_INDEX_FILENAME)
+        self._documents = documents
+        self._index = InvertedIndex()
+        self._lines = 0
+
+    def _reset(self, inode: int) -> None:
+        super()._reset(inode)
+        self._index = InvertedIndex()
+        self._lines = 0
+
+    def _apply(self, record: dict) -> None:
+        self._lines += 1
+        if "removed" in record:
+            self._index.discard(record["removed"])
+        else:
+            self._index.add(record["key"], record["terms"])
+
+    def _scan(self) -> list:
+        """Relit et indexe les courriels de la boîte (voir `documents`)."""
+        return [{"key": key, "terms": terms}
+                for key, terms in self._documents()]
+
+    def add(self, documents: list[tuple[str, list[str]]]) -> None:
+        """
+        Ajoute au fichier, en une seule écriture et sans charger l'index,
+        les termes de courriels désignés par leur clé.
+        """
+        if not documents:
+            return
+        records = [{"key": key, "terms": terms} for key, terms in documents]
+        with self._lock:
+            while True:
+                self._create()
+                try:
+                    self._append_lines(records, create=False)
+                    return
+                except FileNotFoundError:
+                    # Fichier retiré par la reconstruction de la boîte
+                    # depuis `_create`: il est reconstruit à son tour.
+                    continue
+
+    def discard(self, key: str) -> None:
+        """
+        Ajoute au fichier le retrait d'un courriel supprimé. Si l'index est
+        chargé, le fichier est réécrit avec les seuls courriels indexés
+        lorsque les autres lignes dépassent COMPACTION_THRESHOLD des lignes.
+        """
+        with self._lock:
+            try:
+                self._append_lines([{"removed": key}], create=False)
+            except FileNotFoundError:
+                # Le fichier sera construit sans le courriel supprimé.
+                return
+            if self._inode is None:
+                return
+            self._load()
+            if (self._lines - len(self._index)
+                    <= COMPACTION_THRESHOLD * self._lines):
+                return
+            with self._file_lock():
+                self._load()
+                self._write_all([{"key": key, "terms": terms}
+                                 for key, terms in self._index.documents()])
+                self._load()
+
+    def search(self, terms: Sequence[str]) -> set[str]:
+        """Retourne les clés des courriels qui contiennent tous les termes."""
+        with self._lock:
+            self._load()
+            return self._index.search(terms)
+
+
+class CredentialCache:
+    """
+    Cache borné des hachages de mots de passe, partagé par les fils
+    d'exécution.
+
+    Les entrées les moins récemment utilisées sont évincées au-delà de
+    `capacity`, et chaque entrée expire après `ttl` secondes pour qu'un
+    changement fait par un autre processus finisse par être vu. Seuls les
+    comptes existants sont mis en cache.
+    """
+
+    def __init__(self, capacity: int = CREDENTIAL_CACHE_SIZE,
+                 ttl: float = CREDENTIAL_CACHE_TTL) -> None:
+        self._capacity = capacity
+        self._ttl = ttl
+        self._entries: collections.OrderedDict[str, tuple[str, float]] = \
+            collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, username: str) -> Optional[str]:
+        """Retourne le hachage en cache du compte, ou None."""
+        key = username.lower()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            password_hash, expiry = entry
+            if expiry < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return password_hash
+
+    def put(self, username: str, password_hash: str) -> None:
+        """Met en cache le hachage du compte."""
+        with self._lock:
+            self._entries[username.lower()] = (password_hash,
+                                               time.monotonic() + self._ttl)
+            self._entries.move_to_end(username.lower())
+            while len(self._entries) > self._capacity:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username: str) -> None:
+        """Retire le compte du cache."""
+        with self._lock:
+            self._entries.pop(username.lower(), None)
+
+
+class LRUCache:
+    """
+    Cache borné partagé par les fils d'exécution: les valeurs les moins
+    récemment utilisées sont évincées au-delà de `capacity`.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self._capacity = capacity
+        self._entries: collections.OrderedDict[str, Any] = \
+            collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, create: Callable[[], Any]) -> Any:
+        """Retourne la valeur de `key`, créée par `create` si elle manque."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                value = self._entries[key] = create()
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._capacity:
+                self._entries.popitem(last=False)
+            return value
+
+    def peek(self, key: str) -> Any:
+        """Retourne la valeur de `key`, ou None, sans la marquer utilisée."""
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key: str, value: Any) -> None:
+        """Remplace la valeur de `key`."""
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._capacity:
+                self._entries.popitem(last=False)
+
+
+class MailStorage(abc.ABC):
+    """
+    Interface des moteurs de stockage du serveur.
+
+    Les noms d'utilisateur sont insensibles à la casse. Les courriels d'une
+    boîte sont numérotés à partir de 1, du plus récent au plus ancien.
+
+    Les hachages des mots de passe vérifiés sont gardés dans un
+    CredentialCache: une connexion répétée ne relit pas le stockage.
+    """
+
+    def __init__(self) -> None:
+        self._credentials = CredentialCache()
+
+    @abc.abstractmethod
+    def user_exists(self, username: str) -> bool:
+        """Indique si le compte existe."""
+
+    @abc.abstractmethod
+    def create_user(self, username: str, password_hash: str) -> bool:
+        """
+        Crée le compte et sa boîte de courriels.
+
+        Retourne faux si le compte existe déjà.
+        """
+
+    @abc.abstractmethod
+    def get_password_hash(self, username: str) -> Optional[str]:
+        """Retourne le hachage du mot de passe, ou None si le compte
+        n'existe pas."""
+
+    def verify_password(self, username: str, password_hash: str) -> bool:
+        """Vérifie, en temps constant, le hachage fourni pour le compte."""
+        stored_hash = self._credentials.get(username)
+        if stored_hash is None:
+            stored_hash = self.get_password_hash(username)
+            if stored_hash is None:
+                return False
+            self._credentials.put(username, stored_hash)
+        return hmac.compare_digest(password_hash, stored_hash)
+
+    def invalidate_credentials(self, username: str) -> None:
+        """
+        Oublie le hachage en cache du compte. Doit être appelée par les
+        moteurs lorsqu'un mot de passe est créé ou modifié.
+        """
+        self._credentials.invalidate(username)
+
+    @abc.abstractmethod
+    def session_epoch(self, username: str) -> Optional[int]:
+        """
+        Retourne l'époque des sessions du compte, qui entre dans la
+        signature de ses jetons de session, ou None si le compte n'existe
+        pas.
+        """
+
+    @abc.abstractmethod
+    def revoke_sessions(self, username: str) -> None:
+        """
+        Passe à l'époque suivante des sessions du compte: les jetons remis
+        jusque-là ne sont plus acceptés.
+        """
+
+    @abc.abstractmethod
+    def append_message(self, username: str,
+                       email: gloutils.EmailContentPayload) -> None:
+        """Ajoute un courriel à la boîte d'un compte existant."""
+
+    @abc.abstractmethod
+    def store_lost(self, email: gloutils.EmailContentPayload,
+                   recipients: Sequence[str]) -> None:
+        """
+        Conserve un courriel pour les destinataires introuvables
+        `recipients`, jusqu'à la création de leur compte (voir
+        `redeliver_lost`) ou son éviction.
+        """
+
+    @abc.abstractmethod
+    def redeliver_lost(self, username: str) -> int:
+        """
+        Remet à la boîte du compte, en une seule opération, les courriels
+        perdus qui lui étaient adressés, et retourne leur nombre.
+        """
+
+    def _redeliver_registered(self, recipients: Sequence[str]) -> None:
+        """
+        Remet aussitôt les courriels perdus des destinataires dont le compte
+        a été créé entre la recherche du destinataire et `store_lost`.
+        """
+        for username in recipients:
+            if self.user_exists(username):
+                self.redeliver_lost(username)
+
+    @abc.abstractmethod
+    def list_headers(self, username: str, offset: int = 0,
+                     limit: Optional[int] = None
+                     ) -> tuple[list[MessageHeader], int]:
+        """
+        Retourne au plus `limit` en-têtes (toutes si `limit` est None) à
+        partir du `offset`-ième courriel le plus récent, ainsi que le
+        nombre total de courriels de la boîte.
+        """
+
+    @abc.abstractmethod
+    def fetch_message(self, username: str, number: int
+                      ) -> Optional[gloutils.EmailContentPayload]:
+        """Retourne le N-ième courriel le plus récent, ou None."""
+
+    def fetch_message_wire(self, username: str, number: int
+                           ) -> Optional[Union[bytes, memoryview]]:
+        """
+        Retourne le N-ième courriel le plus récent au format de transmission
+        (voir encode_wire), ou None.
+
+        Les moteurs qui stockent les courriels dans ce format retournent une
+        vue projetée en mémoire, transmise au client sans copie.
+        """
+        email = self.fetch_message(username, number)
+        return None if email is None else encode_wire(email)
+
+    def stream_message(self, username: str, number: int, chunk_size: int
+                       ) -> Optional[tuple[gloutils.EmailStreamStartPayload,
+                                           Iterator[str]]]:
+        """
+        Retourne l'en-tête du N-ième courriel le plus récent et les
+        morceaux de son contenu (voir split_wire), ou None.
+
+        Les moteurs qui projettent les courriels en mémoire (voir
+        `fetch_message_wire`) ne les chargent jamais en entier.
+        """
+        wire = self.fetch_message_wire(username, number)
+        return None if wire is None else split_wire(wire, chunk_size)
+
+    def deliver(self, usernames: list[str],
+                email: gloutils.EmailContentPayload,
+                lost: Sequence[str] = ()) -> None:
+        """
+        Ajoute un courriel à la boîte de plusieurs comptes existants et le
+        conserve comme courriel perdu pour les destinataires introuvables
+        `lost`.
+
+        Les moteurs ne stockent le contenu qu'une seule fois, chaque boîte
+        n'en recevant qu'une référence; par défaut, le courriel est ajouté
+        à chaque boîte avec `append_message`.
+        """
+        for username in usernames:
+            self.append_message(username, email)
+        if lost:
+            self.store_lost(email, lost)
+
+    def open_delivery(self, usernames: list[str],
+                      email: gloutils.EmailStreamStartPayload,
+                      lost: Sequence[str] = ()) -> MessageWriter:
+        """
+        Commence la réception d'un courriel transmis par morceaux, remis à
+        la fin comme avec `deliver` (voir MessageWriter).
+
+        Par défaut, le courriel est relu en entier à la fin et remis avec
+        `deliver`.
+        """
+        return MessageWriter(None, email, False, lambda writer:
+                             self.deliver(usernames, writer.load(), lost))
+
+    def open_message(self, username: str,
+                     email: gloutils.EmailStreamStartPayload
+                     ) -> MessageWriter:
+        """
+        Commence l'ajout d'un courriel, reçu par morceaux, à la boîte d'un
+        compte existant (voir `open_delivery`).
+        """
+        return self.open_delivery([username], email)
+
+    def open_lost(self, email: gloutils.EmailStreamStartPayload,
+                  recipients: Sequence[str]) -> MessageWriter:
+        """
+        Commence la réception par morceaux d'un courriel dont les
+        destinataires `recipients` sont introuvables (voir
+        `open_delivery`).
+        """
+        return self.open_delivery([], email, lost=recipients)
+
+    @abc.abstractmethod
+    def delete_message(self, username: str, number: int) -> bool:
+        """
+        Supprime le N-ième courriel le plus récent.
+
+        Retourne faux si ce courriel n'existe pas.
+        """
+
+    @abc.abstractmethod
+    def search(self, username: str, terms: Sequence[str], offset: int = 0,
+               limit: Optional[int] = None
+               ) -> tuple[list[tuple[int, MessageHeader]], int]:
+        """
+        Cherche les courriels de la boîte dont l'expéditeur, le sujet et le
+        contenu réunis contiennent tous les termes `terms` (voir
+        `search_terms`). Retourne, du plus récent au plus ancien, au plus
+        `limit` d'entre eux (tous si `limit` est None) en sautant les
+        `offset` plus récents, chacun avec son numéro dans la boîte, ainsi
+        que le nombre total de courriels trouvés.
+
+        Les moteurs tiennent un index inversé par boîte, mis à jour à la
+        remise de chaque courriel.
+        """
+
+    @abc.abstractmethod
+    def stats(self, username: str) -> tuple[int, int]:
+        """Retourne le nombre de courriels de la boîte et leur taille."""
+
+    def physical_size(self, username: str) -> int:
+        """
+        Retourne la part de l'espace occupé qui revient à la boîte: un
+        contenu partagé par plusieurs courriels n'y compte qu'au prorata de
+        ses références. Par défaut, rien n'est partagé.
+        """
+        return self.stats(username)[1]
+
+    def close(self) -> None:
+        """Libère les ressources du moteur."""
+
+
+class FileSystemStorage(MailStorage):
+    """
+    Stockage dans un dossier par utilisateur, contenant le fichier du mot
+    de passe, un fichier JSON par courriel et l'index MailboxIndex.
+
+    Les courriels perdus sont placés dans le dossier SERVER_LOST_DIR,
+    indexé par destinataire (voir LostIndex), et déplacés dans la boîte du
+    destinataire à la création de son compte. Le contenu d'un courriel
+    remis à plusieurs destinataires, ou d'au moins SHARED_BODY_MIN_SIZE
+    octets, est placé dans le magasin BodyStore du dossier
+    SERVER_BODIES_DIR: un contenu identique, d'où qu'il vienne, n'y est
+    écrit qu'une fois, et chaque boîte n'en reçoit qu'un lien physique et
+    un talon (voir `_encode_stub`).
+
+    Chaque boîte a son index de recherche SearchIndex, auquel les
+    courriels remis sont ajoutés avec leur clé dans l'index de la boîte,
+    et dont ils sont retirés à leur suppression.
+    """
+
+    def __init__(self, data_dir: str) -> None:
+        super().__init__()
+        self._data_dir = data_dir
+        self._lost_dir = os.path.join(data_dir, gloutils.SERVER_LOST_DIR)
+        os.makedirs(self._lost_dir, exist_ok=True)
+        self._lost = LostIndex(self._lost_dir)
+        self._bodies = BodyStore(
+            os.path.join(data_dir, gloutils.SERVER_BODIES_DIR),
+            self._reshare)
+        self._mailboxes: dict[str, MailboxIndex] = {}
+        self._search_indexes = LRUCache(SEARCH_CACHE_SIZE)
+
+    def _user_dir(self, username: str) -> str:
+        """Retourne le dossier de l'utilisateur."""
+        return os.path.join(self._data_dir, username.lower())
+
+    def _mailbox(self, username: str) -> MailboxIndex:
+        """Retourne l'index, gardé en mémoire, de la boîte de l'utilisateur."""
+        username = username.lower()
+        mailbox = self._mailboxes.get(username)
+        if mailbox is None:
+            mailbox = self._mailboxes.setdefault(
+                username, MailboxIndex(self._user_dir(username)))
+        return mailbox
+
+    def _search_index(self, username: str, cache: bool = True
+                      ) -> SearchIndex:
+        """
+        Retourne l'index de recherche de la boîte de l'utilisateur.
+
+        Les index chargés par une recherche (`cache` vrai) sont gardés en
+        mémoire pour les SEARCH_CACHE_SIZE boîtes les plus récemment
+        consultées. Une remise ou une suppression passe par l'index gardé
+        s'il existe, et sinon par un index qui n'est pas chargé.
+        """
+        username = username.lower()
+
+        def _create() -> SearchIndex:
+            return SearchIndex(self._user_dir(username),
+                               lambda: self._search_documents(username))
+
+        if cache:
+            return self._search_indexes.get(username, _create)
+        return self._search_indexes.peek(username) or _create()
+
+    def _search_documents(self, username: str
+                          ) -> list[tuple[str, list[str]]]:
+        """
+        Relit les courriels de la boîte et retourne la clé et les termes de
+        chacun, pour construire son index de recherche.
+        """
+        mailbox = self._mailbox(username)
+        documents = []
+        for entry in mailbox.entries():
+            try:
+                email = self._read_entry(username, entry)
+            except FileNotFoundError:
+                # Courriel supprimé depuis la lecture de l'index.
+                continue
+            documents.append((mailbox.key(entry),
+                              _email_terms(email, email["content"])))
+        return documents
+
+    def user_exists(self, username: str) -> bool:
+        return os.path.exists(self._user_dir(username))
+
+    def create_user(self, username: str, password_hash: str) -> bool:
+        user_dir = self._user_dir(username)
+        try:
+            os.makedirs(user_dir)
+        except FileExistsError:
+            return False
+        with open(os.path.join(user_dir, gloutils.PASSWORD_FILENAME),
+                  "a") as f:
+            f.write(password_hash)
+        self.invalidate_credentials(username)
+        return True
+
+    def get_password_hash(self, username: str) -> Optional[str]:
+        try:
+            with open(os.path.join(self._user_dir(username),
+                                   gloutils.PASSWORD_FILENAME), "r") as f:
+                return f.readline()
+        except FileNotFoundError:
+            return None
+
+    def session_epoch(self, username: str) -> Optional[int]:
+        """L'époque est dans le fichier SESSION_FILENAME du compte."""
+        try:
+            with open(os.path.join(self._user_dir(username),
+                                   gloutils.SESSION_FILENAME), "r") as f:
+                return int(f.read() or 0)
+        except FileNotFoundError:
+            return 0 if self.user_exists(username) else None
+
+    def revoke_sessions(self, username: str) -> None:
+        epoch = self.session_epoch(username)
+        if epoch is None:
+            return
+        _write_atomic(os.path.join(self._user_dir(username),
+                                   gloutils.SESSION_FILENAME),
+                      lambda f: f.write(str(epoch + 1).encode("ascii")))
+
+    def append_message(self, username: str,
+                       email: gloutils.EmailContentPayload) -> None:
+        self.deliver([username], email)
+
+    def _append_inline(self, username: str,
+                       email: gloutils.EmailContentPayload) -> str:
+        """
+        Ajoute à la boîte un courriel stocké avec son contenu et retourne sa
+        clé dans l'index.
+        """
+        mailbox = self._mailbox(username)
+        mailbox.load()
+        filename = f"{gloutils.new_message_id()}.json"
+        data = encode_wire(email)
+        _write_atomic(os.path.join(self._user_dir(username), filename),
+                      lambda json_file: json_file.write(data))
+        mailbox.append(IndexEntry(
+            sender=email["sender"],
+            subject=email["subject"],
+            date=email["date"],
+            size=len(data),
+            wire=True,
+            filename=filename
+        ))
+        return filename
+
+    def store_lost(self, email: gloutils.EmailContentPayload,
+                   recipients: Sequence[str]) -> None:
+        self._lost.load()
+        filename = f"{gloutils.new_message_id()}.json"
+        data = encode_wire(email)
+        _write_atomic(os.path.join(self._lost_dir, filename),
+                      lambda json_file: json_file.write(data))
+        self._index_lost(email, filename, len(data), recipients)
+
+    def _index_lost(self, email: gloutils.EmailStreamStartPayload,
+                    filename: str, size: int,
+                    recipients: Sequence[str]) -> None:
+        """
+        Indexe un courriel perdu, déjà écrit au format de transmission dans
+        le fichier `filename` du dossier SERVER_LOST_DIR.
+        """
+        stored = time.time()
+        self._lost.add([LostEntry(sender=email["sender"],
+                                  subject=email["subject"],
+                                  date=email["date"], size=size, wire=True,
+                                  id=gloutils.new_message_id(),
+                                  recipient=username.lower(),
+                                  filename=filename, stored=stored)
+                        for username in recipients])
+        self._redeliver_registered(recipients)
+
+    def redeliver_lost(self, username: str) -> int:
+        return self._lost.redeliver(
+            username, lambda entries: self._redeliver(username, entries))
+
+    def _redeliver(self, username: str, entries: list[LostEntry]) -> None:
+        """
+        Ajoute à la boîte les courriels perdus des entrées: chaque fichier
+        y est lié sous un nouveau nom, puis toutes les entrées sont ajoutées
+        à l'index, et à l'index de recherche, en une seule écriture.
+        """
+        mailbox = self._mailbox(username)
+        mailbox.load()
+        user_dir = self._user_dir(username)
+        redelivered = []
+        documents = []
+        for entry in entries:
+            filename = f"{gloutils.new_message_id()}.json"
+            target = os.path.join(user_dir, filename)
+            _link_or_copy(self._lost.path(entry), target)
+            _track(target)
+            with open(target, "rb") as email_file:
+                email = decode_stored(email_file.read(), entry["wire"])
+            documents.append((filename, _email_terms(email,
+                                                     email["content"])))
+            redelivered.append(IndexEntry(sender=entry["sender"],
+                                          subject=entry["subject"],
+                                          date=entry["date"],
+                                          size=entry["size"],
+                                          wire=entry["wire"],
+                                          filename=filename))
+        _track(user_dir)
+        mailbox.extend(redelivered)
+        self._search_index(username, cache=False).add(documents)
+
+    def _deliver_shared(self, usernames: list[str],
+                        email: gloutils.EmailStreamStartPayload, size: int,
+                        digest: str, write: Callable[[BinaryIO], None]
+                        ) -> list[str]:
+        """
+        Remet à chaque compte un courriel de `size` octets dont le contenu,
+        d'empreinte `digest`, est écrit par `write` s'il n'est pas déjà
+        dans le magasin, et retourne sa clé dans l'index de chaque boîte.
+
+        Les liens sont créés et les courriels ajoutés aux boîtes en tenant
+        le verrou du contenu, pour que leur part de celui-ci (voir
+        IndexEntry) tienne compte de toutes ses références.
+        """
+        for username in usernames:
+            self._mailbox(username).load()
+        message_ids = [gloutils.new_message_id() for _ in usernames]
+        with self._bodies.locked(digest):
+            body_size, share = self._bodies.link(
+                digest,
+                [(username.lower(), os.path.join(self._user_dir(username),
+                                                 message_id + BODY_SUFFIX))
+                 for username, message_id in zip(usernames, message_ids)],
+                write)
+            return [self._append_stub(username, email, size, digest,
+                                      message_id, size - body_size + share)
+                    for username, message_id in zip(usernames, message_ids)]
+
+    def _append_stub(self, username: str,
+                     email: gloutils.EmailStreamStartPayload, size: int,
+                     digest: str, message_id: str, physical: int) -> str:
+        """
+        Ajoute à la boîte le talon d'un courriel de `size` octets, qui
+        occupe `physical` octets, dont le contenu est déjà lié dans son
+        dossier sous le nom `message_id + BODY_SUFFIX`, et retourne sa clé
+        dans l'index.
+        """
+        filename, body = f"{message_id}.json", message_id + BODY_SUFFIX
+        stub = _encode_stub(email, digest, body)
+        _write_atomic(os.path.join(self._user_dir(username), filename),
+                      lambda stub_file: stub_file.write(stub))
+        self._mailbox(username).append(IndexEntry(
+            sender=email["sender"],
+            subject=email["subject"],
+            date=email["date"],
+            size=size,
+            filename=filename,
+            destination=email["destination"],
+            digest=digest,
+            body=body,
+            physical=physical
+        ))
+        return filename
+
+    def _reshare(self, username: str, digest: str, body_size: int,
+                 share: int) -> None:
+        """Revoit la part du contenu partagé `digest` de la boîte."""
+        self._mailbox(username).reshare(digest, body_size, share)
+
+    def deliver(self, usernames: list[str],
+                email: gloutils.EmailContentPayload,
+                lost: Sequence[str] = ()) -> None:
+        literal = _content_literal(email["content"])
+        terms = _email_terms(email, email["content"])
+        if len(usernames) > 1 or len(literal) >= SHARED_BODY_MIN_SIZE:
+            head, tail = _wire_around(email)
+            size = len(head) + len(literal) + len(tail)
+            digest = hashlib.sha256(literal).hexdigest()
+            keys = self._deliver_shared(usernames, email, size, digest,
+                                        lambda file: file.write(literal))
+            for username, key in zip(usernames, keys):
+                self._search_index(username, cache=False).add(
+                    [(key, terms)])
+        else:
+            for username in usernames:
+                key = self._append_inline(username, email)
+                self._search_index(username, cache=False).add(
+                    [(key, terms)])
+        if lost:
+            self.store_lost(email, lost)
+
+    def open_delivery(self, usernames: list[str],
+                      email: gloutils.EmailStreamStartPayload,
+                      lost: Sequence[str] = ()) -> MessageWriter:
+        def _commit(writer: MessageWriter) -> None:
+            terms = _email_terms(email, writer.text)
+
+            def _write(output: BinaryIO) -> None:
+                with open(writer.path, "rb") as source:
+                    shutil.copyfileobj(source, output)
+
+            keys = self._deliver_shared(usernames, email, writer.size,
+                                        writer.digest, _write)
+            for username, key in zip(usernames, keys):
+                self._search_index(username, cache=False).add(
+                    [(key, terms)])
+            if lost:
+                head, tail = _wire_around(email)
+
+                def _copy(output: BinaryIO) -> None:
+                    with open(writer.path, "rb") as source:
+                        output.write(head)
+                        shutil.copyfileobj(source, output)
+                        output.write(tail)
+
+                self._lost.load()
+                filename = f"{gloutils.new_message_id()}.json"
+                _write_atomic(os.path.join(self._lost_dir, filename), _copy)
+                self._index_lost(email, filename, writer.size, lost)
+
+        return MessageWriter(self._bodies.directory, email, True, _commit,
+                             body=True)
+
+    def _body_path(self, username: str, entry: IndexEntry) -> str:
+        """Retourne le lien vers le contenu partagé d'une entrée."""
+        return os.path.join(self._user_dir(username), entry["body"])
+
+    def _read_shared(self, username: str, entry: IndexEntry
+                     ) -> gloutils.EmailContentPayload:
+        """Relit un courriel dont le contenu est dans le magasin."""
+        with open(self._body_path(username, entry), "rb") as body_file:
+            content = json.loads(body_file.read())
+        return gloutils.EmailContentPayload(
+            sender=entry["sender"], destination=entry["destination"],
+            subject=entry["subject"], date=entry["date"], content=content)
+
+    def _shared_wire(self, username: str, entry: IndexEntry) -> bytes:
+        """
+        Reconstitue le format de transmission d'un courriel dont le contenu
+        est dans le magasin.
+        """
+        head, tail = _wire_around(entry)
+        with open(self._body_path(username, entry), "rb") as body_file:
+            return head + body_file.read() + tail
+
+    def list_headers(self, username: str, offset: int = 0,
+                     limit: Optional[int] = None
+                     ) -> tuple[list[MessageHeader], int]:
+        return self._mailbox(username).page(offset, limit)
+
+    def _read_entry(self, username: str, entry: IndexEntry
+                    ) -> gloutils.EmailContentPayload:
+        """Relit le courriel d'une entrée de l'index de la boîte."""
+        if "digest" in entry:
+            return self._read_shared(username, entry)
+        with open(os.path.join(self._user_dir(username), entry["filename"]),
+                  "rb") as f:
+            return decode_stored(f.read(), entry.get("wire", False))
+
+    def fetch_message(self, username: str, number: int
+                      ) -> Optional[gloutils.EmailContentPayload]:
+        entry = self._mailbox(username).get(number)
+        return None if entry is None else self._read_entry(username, entry)
+
+    def fetch_message_wire(self, username: str, number: int
+                           ) -> Optional[Union[bytes, memoryview]]:
+        entry = self._mailbox(username).get(number)
+        if entry is not None and "digest" in entry:
+            return self._shared_wire(username, entry)
+        if entry is None or not entry.get("wire", False):
+            return super().fetch_message_wire(username, number)
+        return map_file(os.path.join(self._user_dir(username),
+                                     entry["filename"]))
+
+    def stream_message(self, username: str, number: int, chunk_size: int
+                       ) -> Optional[tuple[gloutils.EmailStreamStartPayload,
+                                           Iterator[str]]]:
+        entry = self._mailbox(username).get(number)
+        if entry is None or "digest" not in entry:
+            return super().stream_message(username, number, chunk_size)
+        header = gloutils.EmailStreamStartPayload(
+            sender=entry["sender"], destination=entry["destination"],
+            subject=entry["subject"], date=entry["date"])
+        body = map_file(self._body_path(username, entry))
+        return header, _content_chunks(body, 1, chunk_size)
+
+    def delete_message(self, username: str, number: int) -> bool:
+        entry = self._mailbox(username).remove(number)
+        if entry is None:
+            return False
+        self._search_index(username, cache=False).discard(entry["filename"])
+        os.remove(os.path.join(self._user_dir(username), entry["filename"]))
+        if "digest" in entry:
+            self._bodies.release(username.lower(),
+                                 self._body_path(username, entry),
+                                 entry["digest"])
+        return True
+
+    def search(self, username: str, terms: Sequence[str], offset: int = 0,
+               limit: Optional[int] = None
+               ) -> tuple[list[tuple[int, MessageHeader]], int]:
+        """
+        Les clés trouvées sont numérotées une à une d'après l'index de la
+        boîte (voir `MailboxIndex.locate`), qui ignore celles des courriels
+        supprimés par un autre processus depuis le dernier chargement.
+        L'index de la boîte est chargé d'abord: s'il est reconstruit, ses
+        clés changent, et l'index de recherche est reconstruit avec elles.
+        """
+        mailbox = self._mailbox(username)
+        mailbox.load()
+        found = self._search_index(username).search(terms)
+        results = mailbox.locate(found)
+        stop = None if limit is None else offset + limit
+        return results[offset:stop], len(results)
+
+    def stats(self, username: str) -> tuple[int, int]:
+        return self._mailbox(username).stats()
+
+    def physical_size(self, username: str) -> int:
+        """
+        Le total est tenu à jour par l'index de la boîte, y compris la part
+        des contenus partagés, revue par le magasin BodyStore chaque fois
+        que d'autres boîtes y ajoutent ou en retirent des liens.
+        """
+        return self._mailbox(username).physical_size()
+
+
+class SegmentLogStorage(FileSystemStorage):
+    """
+    Stockage des boîtes en segments en ajout seul (voir SegmentIndex).
+
+    Les comptes et les courriels perdus sont conservés comme dans
+    FileSystemStorage, mais les boîtes ne sont pas compatibles avec celles
+    de ce dernier: un même dossier de données ne doit servir qu'à un des
+    deux moteurs. L'envoi d'un courriel est un seul ajout en fin de
+    segment suivi d'une ligne d'index, et sa lecture un seul pread.
+
+    Après une suppression, la boîte est compactée dans un fil d'exécution
+    d'arrière-plan lorsque plus de COMPACTION_THRESHOLD de ses octets ne
+    sont plus utilisés. `compact_all` compacte toutes les boîtes hors ligne.
+    """
+
+    def __init__(self, data_dir: str) -> None:
+        super().__init__(data_dir)
+        self._compacting: set[str] = set()
+        self._compacting_lock = threading.Lock()
+
+    def _mailbox(self, username: str) -> SegmentIndex:
+        username = username.lower()
+        mailbox = self._mailboxes.get(username)
+        if mailbox is None:
+            mailbox = self._mailboxes.setdefault(
+                username, SegmentIndex(self._user_dir(username)))
+        return mailbox
+
+    def _append_inline(self, username: str,
+                       email: gloutils.EmailContentPayload) -> str:
+        return self._mailbox(username).append_record(email)
+
+    def _append_stub(self, username: str,
+                     email: gloutils.EmailStreamStartPayload, size: int,
+                     digest: str, message_id: str, physical: int) -> str:
+        return self._mailbox(username).append_stub(
+            email, digest, message_id + BODY_SUFFIX, size, physical)
+
+    def _redeliver(self, username: str, entries: list[LostEntry]) -> None:
+        """
+        Les courriels perdus sont relus et ajoutés au segment courant en
+        une seule écriture.
+        """
+        records = []
+        for entry in entries:
+            with open(self._lost.path(entry), "rb") as lost_file:
+                records.append((entry, lost_file.read()))
+        keys = self._mailbox(username).extend_records(records)
+        documents = []
+        for key, (entry, data) in zip(keys, records):
+            email = decode_stored(data, entry["wire"])
+            documents.append((key, _email_terms(email, email["content"])))
+        self._search_index(username, cache=False).add(documents)
+
+    def _read_entry(self, username: str, entry: SegmentEntry
+                    ) -> gloutils.EmailContentPayload:
+        if "digest" in entry:
+            return self._read_shared(username, entry)
+        return decode_stored(self._mailbox(username).read_record(entry),
+                             entry.get("wire", False))
+
+    def fetch_message(self, username: str, number: int
+                      ) -> Optional[gloutils.EmailContentPayload]:
+        return self._mailbox(username).read_newest(
+            number, lambda entry: self._read_entry(username, entry))
+
+    def fetch_message_wire(self, username: str, number: int
+                           ) -> Optional[Union[bytes, memoryview]]:
+        mailbox = self._mailbox(username)
+
+        def _read(entry: SegmentEntry) -> Union[bytes, memoryview]:
+            if "digest" in entry:
+                return self._shared_wire(username, entry)
+            if not entry.get("wire", False):
+                return encode_wire(self._read_entry(username, entry))
+            return mailbox.map_record(entry)
+
+        return mailbox.read_newest(number, _read)
+
+    def delete_message(self, username: str, number: int) -> bool:
+        mailbox = self._mailbox(username)
+        entry = mailbox.remove(number)
+        if entry is None:
+            return False
+        self._search_index(username, cache=False).discard(entry["id"])
+        if "digest" in entry:
+            self._bodies.release(username.lower(),
+                                 self._body_path(username, entry),
+                                 entry["digest"])
+        if mailbox.garbage_ratio() > COMPACTION_THRESHOLD:
+            self._compact_in_background(username.lower())
+        return True
+
+    def _compact_in_background(self, username: str) -> None:
+        """Lance le compactage de la boîte s'il n'est pas déjà en cours."""
+        with self._compacting_lock:
+            if username in self._compacting:
+                return
+            self._compacting.add(username)
+
+        def _compact() -> None:
+            try:
+                self._mailbox(username).compact()
+            finally:
+                with self._compacting_lock:
+                    self._compacting.discard(username)
+
+        threading.Thread(target=_compact, daemon=True).start()
+
+    def compact_all(self) -> None:
+        """Compacte toutes les boîtes, par exemple pendant un arrêt."""
+        for entry in os.scandir(self._data_dir):
+            if (entry.is_dir() and entry.name != gloutils.SERVER_LOST_DIR
+                    and any(name.endswith(SEGMENT_SUFFIX)
+                            for name in os.listdir(entry.path))):
+                self._mailbox(entry.name).compact()
+
+
+class SQLiteStorage(MailStorage):
+    """
+    Stockage dans une base SQLite unique, en mode WAL.
+
+    Les courriels sont indexés par destinataire et par identifiant
+    (gloutils.new_message_id, donc par date de réception), et le nombre de
+    courriels et la taille de chaque boîte sont tenus à jour dans la table
+    des utilisateurs, avec l'espace qu'elle occupe (voir `physical_size`).
+    Les identifiants des courriels des boîtes consultées sont gardés en
+    mémoire pour trouver le N-ième courriel sans parcourir la boîte (voir
+    `_message_ids`). Chaque fil d'exécution utilise sa propre connexion, et
+    `close` les ferme toutes.
+
+    Le contenu d'un courriel remis à plusieurs destinataires, ou d'au
+    moins SHARED_BODY_MIN_SIZE octets, est conservé dans la table `bodies`,
+    indexée par l'empreinte SHA-256 du contenu: un contenu identique n'y
+    figure qu'une fois, avec le nombre de courriels qui y font référence,
+    et il est supprimé avec le dernier d'entre eux.
+
+    Les courriels perdus sont conservés dans la table `lost_messages`, une
+    ligne par destinataire introuvable, indexée par destinataire, et
+    évincés au-delà de LOST_MAX_SIZE octets ou de LOST_MAX_AGE secondes.
+
+    Les termes de chaque courriel (voir `search_terms`) sont conservés
+    dans la table `search_documents`, une ligne par courriel indexée comme
+    les courriels et tenue à jour dans les mêmes transactions: l'ajout ne
+    modifie que les dernières pages de la boîte, là où une ligne par terme
+    en modifierait une par terme. L'index inversé d'une boîte est construit
+    en mémoire à la première recherche, gardé pour les SEARCH_CACHE_SIZE
+    boîtes les plus récemment consultées, puis complété à chaque recherche
+    par les courriels reçus depuis (voir `_search_index`).
+    """
+
+    _LOST_TABLE = """
+        CREATE TABLE IF NOT EXISTS lost_messages (
+            recipient TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (recipient, message_id)
+        ) WITHOUT ROWID
+    """
+    # Taille totale des courriels perdus, tenue à jour par des déclencheurs
+    # pour que l'éviction ne parcoure pas la table.
+    _LOST_SIZE = (
+        "CREATE TABLE IF NOT EXISTS lost_size (size INTEGER NOT NULL)",
+        "INSERT INTO lost_size"
+        " SELECT (SELECT COALESCE(SUM(size), 0) FROM lost_messages)"
+        " WHERE NOT EXISTS (SELECT 1 FROM lost_size)",
+        "CREATE TRIGGER IF NOT EXISTS lost_messages_insert AFTER INSERT"
+        " ON lost_messages BEGIN"
+        " UPDATE lost_size SET size = size + NEW.size; END",
+        "CREATE TRIGGER IF NOT EXISTS lost_messages_delete AFTER DELETE"
+        " ON lost_messages BEGIN"
+        " UPDATE lost_size SET size = size - OLD.size; END",
+    )
+    _SEARCH_TABLE = """
+        CREATE TABLE IF NOT EXISTS search_documents (
+            recipient TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            terms TEXT NOT NULL,
+            PRIMARY KEY (recipient, message_id)
+        ) WITHOUT ROWID
+    """
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password_hash TEXT NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            mailbox_size INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            recipient TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            sender TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            date TEXT NOT NULL,
+            content TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            PRIMARY KEY (recipient, message_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS bodies (
+            body_id INTEGER PRIMARY KEY,
+            content TEXT NOT NULL,
+            refcount INTEGER NOT NULL,
+            digest TEXT,
+            size INTEGER NOT NULL DEFAULT 0
+        );
+    """
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self._path = path
+        self._local = threading.local()
+        self._connections: set[sqlite3.Connection] = set()
+        self._connections_lock = threading.Lock()
+        # Identifiants des courriels des boîtes consultées, en ordre
+        # croissant.
+        self._message_ids_cache = LRUCache(MAILBOX_CACHE_SIZE)
+        self._message_ids_lock = threading.Lock()
+        # Index inversés des boîtes déjà consultées par une recherche, avec
+        # les identifiants de leurs courriels en ordre croissant.
+        self._search_indexes = LRUCache(SEARCH_CACHE_SIZE)
+        self._search_lock = threading.Lock()
+        with self._connect() as connection:
+            connection.executescript(self._SCHEMA)
+            # Les migrations sont faites dans une seule transaction, qu'un
+            # autre processus du serveur démarré en même temps attend.
+            connection.execute("BEGIN IMMEDIATE")
+            columns = [row[1] for row in connection.execute(
+                "PRAGMA table_info(messages)")]
+            if "body_id" not in columns:
+                connection.execute(
+                    "ALTER TABLE messages ADD COLUMN body_id INTEGER")
+            columns = [row[1] for row in connection.execute(
+                "PRAGMA table_info(users)")]
+            if "session_epoch" not in columns:
+                connection.execute("ALTER TABLE users ADD COLUMN"
+                                   " session_epoch INTEGER NOT NULL DEFAULT 0")
+            columns = [row[1] for row in connection.execute(
+                "PRAGMA table_info(bodies)")]
+            if "digest" not in columns:
+                connection.execute("ALTER TABLE bodies ADD COLUMN digest TEXT")
+                connection.execute("ALTER TABLE bodies ADD COLUMN size"
+                                   " INTEGER NOT NULL DEFAULT 0")
+                connection.execute("UPDATE bodies SET size = length(content)")
+            connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS"
+                               " bodies_digest ON bodies (digest)")
+            connection.execute("CREATE INDEX IF NOT EXISTS messages_body"
+                               " ON messages (body_id)")
+            columns = [row[1] for row in connection.execute(
+                "PRAGMA table_info(users)")]
+            if "physical_size" not in columns:
+                connection.execute("ALTER TABLE users ADD COLUMN"
+                                   " physical_size INTEGER NOT NULL DEFAULT 0")
+                connection.execute(
+                    "UPDATE users SET physical_size = (SELECT COALESCE(SUM("
+                    "CASE WHEN body_id IS NULL THEN messages.size"
+                    " ELSE messages.size - bodies.size"
+                    " + bodies.size / refcount END), 0)"
+                    " FROM messages LEFT JOIN bodies USING (body_id)"
+                    " WHERE recipient = username)")
+            columns = [row[1] for row in connection.execute(
+                "PRAGMA table_info(lost_messages)")]
+            if columns and "recipient" not in columns:
+                self._migrate_lost(connection)
+            connection.execute(self._LOST_TABLE)
+            connection.execute("CREATE INDEX IF NOT EXISTS lost_messages_age"
+                               " ON lost_messages (message_id)")
+            for statement in self._LOST_SIZE:
+                connection.execute(statement)
+            if not connection.execute(
+                    "PRAGMA table_info(search_documents)").fetchall():
+                self._migrate_search(connection)
+
+    def _migrate_lost(self, connection: sqlite3.Connection) -> None:
+        """
+        Remplace l'ancienne table des courriels perdus, une ligne par
+        courriel, par une ligne par adresse de SERVER_DOMAIN du
+        destinataire.
+        """
+        connection.execute(
+            "ALTER TABLE lost_messages RENAME TO lost_messages_old")
+        connection.execute(self._LOST_TABLE)
+        rows = connection.execute(
+            "SELECT message_id, destination, data FROM lost_messages_old")
+        connection.executemany(
+            "INSERT OR IGNORE INTO lost_messages"
+            " (recipient, message_id, size, data) VALUES (?, ?, ?, ?)",
+            [(recipient, message_id, len(data), data)
+             for message_id, destination, data in rows
+             for recipient in _local_recipients(destination)])
+        connection.execute("DROP TABLE lost_messages_old")
+
+    def _migrate_search(self, connection: sqlite3.Connection) -> None:
+        """Crée la table `search_documents` et y indexe les courriels."""
+        connection.execute(self._SEARCH_TABLE)
+        rows = connection.execute(
+            "SELECT recipient, message_id, sender, subject,"
+            " COALESCE(bodies.content, messages.content)"
+            " FROM messages LEFT JOIN bodies USING (body_id)")
+        connection.executemany(
+            "INSERT INTO search_documents (recipient, message_id, terms)"
+            " VALUES (?, ?, ?)",
+            ((recipient, message_id,
+              " ".join(search_terms(sender, subject, content)))
+             for recipient, message_id, sender, subject, content in rows))
+
+    def _connect(self) -> sqlite3.Connection:
+        """Retourne la connexion du fil d'exécution courant."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Seul `close` utilise la connexion depuis un autre fil.
+            connection = sqlite3.connect(self._path, timeout=30,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.add(connection)
+        return connection
+
+    def _track_commit(self) -> None:
+        """
+        Note la base et son journal WAL (voir `track_writes`): avec
+        PRAGMA synchronous=NORMAL, SQLite ne synchronise le journal qu'aux
+        points de contrôle, et synchroniser le journal suffit à rendre les
+        transactions validées durables.
+        """
+        _track(self._path + "-wal", self._path)
+
+    def user_exists(self, username: str) -> bool:
+        return self.get_password_hash(username) is not None
+
+    def create_user(self, username: str, password_hash: str) -> bool:
+        try:
+            with self._connect() as connection:
+                connection.execute(
+                    "INSERT INTO users (username, password_hash)"
+                    " VALUES (?, ?)", (username.lower(), password_hash))
+        except sqlite3.IntegrityError:
+            return False
+        self.invalidate_credentials(username)
+        return True
+
+    def get_password_hash(self, username: str) -> Optional[str]:
+        row = self._connect().execute(
+            "SELECT password_hash FROM users WHERE username = ?",
+            (username.lower(),)).fetchone()
+        return None if row is None else row[0]
+
+    def session_epoch(self, username: str) -> Optional[int]:
+        row = self._connect().execute(
+            "SELECT session_epoch FROM users WHERE username = ?",
+            (username.lower(),)).fetchone()
+        return None if row is None else row[0]
+
+    def revoke_sessions(self, username: str) -> None:
+        with self._connect() as connection:
+            connection.execute(
+                "UPDATE users SET session_epoch = session_epoch + 1"
+                " WHERE username = ?", (username.lower(),))
+
+    def append_message(self, username: str,
+                       email: gloutils.EmailContentPayload) -> None:
+        self.deliver([username], email)
+
+    def _append_inline(self, username: str,
+                       email: gloutils.EmailContentPayload) -> None:
+        """Ajoute à la boîte un courriel stocké avec son contenu."""
+        size = len(json.dumps(email))
+        message_id = gloutils.new_message_id()
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT INTO messages (recipient, message_id, sender,"
+                " destination, subject, date, content, size)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (username.lower(), message_id,
+                 email["sender"], email["destination"], email["subject"],
+                 email["date"], email["content"], size))
+            self._index_terms(connection, [(username.lower(), message_id)],
+                              _email_terms(email, email["content"]))
+            connection.execute(
+                "UPDATE users SET message_count = message_count + 1,"
+                " mailbox_size = mailbox_size + ?,"
+                " physical_size = physical_size + ? WHERE username = ?",
+                (size, size, username.lower()))
+        self._track_commit()
+
+    def deliver(self, usernames: list[str],
+                email: gloutils.EmailContentPayload,
+                lost: Sequence[str] = ()) -> None:
+        literal = _content_literal(email["content"])
+        if len(usernames) == 1 and len(literal) < SHARED_BODY_MIN_SIZE:
+            self._append_inline(usernames[0], email)
+        elif usernames:
+            self._append_shared(usernames, email, literal)
+        if lost:
+            self.store_lost(email, lost)
+
+    def _append_shared(self, usernames: list[str],
+                       email: gloutils.EmailContentPayload,
+                       literal: bytes) -> None:
+        """
+        Ajoute le courriel à la boîte de chaque compte, en référençant son
+        contenu encodé `literal` dans la table `bodies`.
+        """
+        digest = hashlib.sha256(literal).hexdigest()
+        size = len(json.dumps(email))
+        messages = [(username.lower(), gloutils.new_message_id())
+                    for username in usernames]
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT INTO bodies (content, refcount, digest, size)"
+                " VALUES (?, ?, ?, ?) ON CONFLICT (digest) DO UPDATE"
+                " SET refcount = refcount + excluded.refcount",
+                (email["content"], len(usernames), digest, len(literal)))
+            body_id, refcount, body_size = connection.execute(
+                "SELECT body_id, refcount, size FROM bodies WHERE digest = ?",
+                (digest,)).fetchone()
+            self._reshare(connection, body_id, body_size,
+                          refcount - len(usernames), refcount)
+            connection.executemany(
+                "INSERT INTO messages (recipient, message_id, sender,"
+                " destination, subject, date, content, size, body_id)"
+                " VALUES (?, ?, ?, ?, ?, ?, '', ?, ?)",
+                [(recipient, message_id, email["sender"],
+                  email["destination"], email["subject"], email["date"],
+                  size, body_id) for recipient, message_id in messages])
+            self._index_terms(connection, messages,
+                              _email_terms(email, email["content"]))
+            physical = size - body_size + body_size // refcount
+            connection.executemany(
+                "UPDATE users SET message_count = message_count + 1,"
+                " mailbox_size = mailbox_size + ?,"
+                " physical_size = physical_size + ? WHERE username = ?",
+                [(size, physical, username.lower())
+                 for username in usernames])
+        self._track_commit()
+
+    @staticmethod
+    def _reshare(connection: sqlite3.Connection, body_id: int,
+                 body_size: int, before: int, after: int) -> None:
+        """
+        Revoit l'espace occupé par les boîtes qui font référence au contenu
+        `body_id`, de `body_size` octets, quand son nombre de références
+        passe de `before` à `after` (voir `physical_size`).
+        """
+        if before <= 0 or after <= 0:
+            return
+        delta = body_size // after - body_size // before
+        if delta:
+            connection.execute(
+                "UPDATE users SET physical_size = physical_size + ?"
+                " * (SELECT COUNT(*) FROM messages"
+                " WHERE body_id = ? AND recipient = username)"
+                " WHERE username IN"
+                " (SELECT recipient FROM messages WHERE body_id = ?)",
+                (delta, body_id, body_id))
+
+    @staticmethod
+    def _index_terms(connection: sqlite3.Connection,
+                     messages: list[tuple[str, str]],
+                     terms: list[str]) -> None:
+        """
+        Conserve les termes des courriels désignés par leur destinataire et
+        leur identifiant.
+        """
+        connection.executemany(
+            "INSERT OR IGNORE INTO search_documents"
+            " (recipient, message_id, terms) VALUES (?, ?, ?)",
+            [(recipient, message_id, " ".join(terms))
+             for recipient, message_id in messages])
+
+    def store_lost(self, email: gloutils.EmailContentPayload,
+                   recipients: Sequence[str]) -> None:
+        data = json.dumps(email)
+        message_id = gloutils.new_message_id()
+        with self._connect() as connection:
+            connection.executemany(
+                "INSERT INTO lost_messages (recipient, message_id, size, data)"
+                " VALUES (?, ?, ?, ?)",
+                [(username.lower(), message_id, len(data), data)
+                 for username in recipients])
+            self._evict_lost(connection)
+        self._track_commit()
+        self._redeliver_registered(recipients)
+
+    @staticmethod
+    def _evict_lost(connection: sqlite3.Connection) -> None:
+        """
+        Supprime les courriels perdus reçus il y a plus de LOST_MAX_AGE
+        secondes, puis les plus anciens au-delà de LOST_MAX_SIZE octets.
+        Les identifiants étant des horodatages, l'âge se lit dans l'index
+        `lost_messages_age`, et la taille totale dans `lost_size`.
+        """
+        cutoff = time.time_ns() - int(LOST_MAX_AGE * 1e9)
+        connection.execute("DELETE FROM lost_messages WHERE message_id < ?",
+                           (f"{cutoff:020d}",))
+        total, = connection.execute("SELECT size FROM lost_size").fetchone()
+        if total <= LOST_MAX_SIZE:
+            return
+        evicted = []
+        for recipient, message_id, size in connection.execute(
+                "SELECT recipient, message_id, size FROM lost_messages"
+                " ORDER BY message_id"):
+            if total <= LOST_MAX_SIZE:
+                break
+            evicted.append((recipient, message_id))
+            total -= size
+        connection.executemany(
+            "DELETE FROM lost_messages WHERE recipient = ? AND message_id = ?",
+            evicted)
+
+    def redeliver_lost(self, username: str) -> int:
+        with self._connect() as connection:
+            rows = sorted(connection.execute(
+                "DELETE FROM lost_messages WHERE recipient = ?"
+                " RETURNING message_id, size, data",
+                (username.lower(),)).fetchall())
+            if not rows:
+                return 0
+            emails = [(gloutils.new_message_id(), json.loads(data), size)
+                      for _, size, data in rows]
+            connection.executemany(
+                "INSERT INTO messages (recipient, message_id, sender,"
+                " destination, subject, date, content, size)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(username.lower(), message_id,
+                  email["sender"], email["destination"], email["subject"],
+                  email["date"], email["content"], size)
+                 for message_id, email, size in emails])
+            for message_id, email, _ in emails:
+                self._index_terms(connection,
+                                  [(username.lower(), message_id)],
+                                  _email_terms(email, email["content"]))
+            total = sum(size for _, _, size in emails)
+            connection.execute(
+                "UPDATE users SET message_count = message_count + ?,"
+                " mailbox_size = mailbox_size + ?,"
+                " physical_size = physical_size + ? WHERE username = ?",
+                (len(rows), total, total, username.lower()))
+        self._track_commit()
+        return len(rows)
+
+    def _read_since(self, connection: sqlite3.Connection, username: str,
+                    known: list[str], query: str) -> tuple[list, bool]:
+        """
+        Lit les lignes de `query`, dont la première colonne est un
+        identifiant de courriel, pour les courriels de la boîte postérieurs
+        au dernier de `known`, les identifiants déjà connus en ordre
+        croissant. `query` reçoit le destinataire et ce dernier identifiant.
+
+        Si le nombre de courriels de la boîte ne correspond plus, après une
+        suppression par un autre processus ou un courriel validé après un
+        plus récent, les lignes de toute la boîte sont lues. Retourne les
+        lignes et vrai si elles remplacent `known`.
+        """
+        # Une seule transaction de lecture, pour que le nombre de courriels
+        # et les lignes lues correspondent au même état de la base.
+        connection.execute("BEGIN")
+        try:
+            row = connection.execute(
+                "SELECT message_count FROM users WHERE username = ?",
+                (username,)).fetchone()
+            rows = connection.execute(
+                query, (username, known[-1] if known else "")).fetchall()
+            if len(known) + len(rows) == (row[0] if row else 0):
+                return rows, False
+            return connection.execute(query, (username, "")).fetchall(), True
+        finally:
+            connection.commit()
+
+    def _message_ids(self, connection: sqlite3.Connection, username: str
+                     ) -> list[str]:
+        """
+        Retourne les identifiants des courriels de la boîte en ordre
+        croissant, complétés par ceux reçus depuis le dernier appel (voir
+        `_read_since`). Doit être appelée en tenant `_message_ids_lock`.
+        """
+        message_ids = self._message_ids_cache.get(username, list)
+        rows, replaced = self._read_since(
+            connection, username, message_ids,
+            "SELECT message_id FROM messages"
+            " WHERE recipient = ? AND message_id > ? ORDER BY message_id")
+        if replaced:
+            message_ids = []
+            self._message_ids_cache.put(username, message_ids)
+        message_ids.extend(message_id for message_id, in rows)
+        return message_ids
+
+    def _message_id(self, connection: sqlite3.Connection, username: str,
+                    number: int) -> Optional[str]:
+        """Retourne l'identifiant du N-ième courriel le plus récent."""
+        with self._message_ids_lock:
+            message_ids = self._message_ids(connection, username)
+            if 1 <= number <= len(message_ids):
+                return message_ids[-number]
+        return None
+
+    def _forget_message(self, username: str, message_id: str) -> None:
+        """Retire un courriel supprimé des identifiants gardés en mémoire."""
+        with self._message_ids_lock:
+            message_ids = self._message_ids_cache.peek(username)
+            if message_ids is not None:
+                position = bisect.bisect_left(message_ids, message_id)
+                if message_ids[position:position + 1] == [message_id]:
+                    del message_ids[position]
+
+    def list_headers(self, username: str, offset: int = 0,
+                     limit: Optional[int] = None
+                     ) -> tuple[list[MessageHeader], int]:
+        """
+        Les identifiants gardés en mémoire donnent les bornes de la page,
+        lue ensuite dans l'index des courriels sans sauter les précédents.
+        """
+        username = username.lower()
+        connection = self._connect()
+        with self._message_ids_lock:
+            message_ids = self._message_ids(connection, username)
+            total = len(message_ids)
+            stop = max(total - offset, 0)
+            start = 0 if limit is None else max(stop - limit, 0)
+            if start >= stop:
+                return [], total
+            first, last = message_ids[start], message_ids[stop - 1]
+        rows = connection.execute(
+            "SELECT sender, subject, date, size FROM messages"
+            " WHERE recipient = ? AND message_id BETWEEN ? AND ?"
+            " ORDER BY message_id DESC", (username, first, last))
+        headers = [MessageHeader(sender=sender, subject=subject, date=date,
+                                 size=size)
+                   for sender, subject, date, size in rows]
+        return headers, total
+
+    def fetch_message(self, username: str, number: int
+                      ) -> Optional[gloutils.EmailContentPayload]:
+        username = username.lower()
+        connection = self._connect()
+        message_id = self._message_id(connection, username, number)
+        if message_id is None:
+            return None
+        row = connection.execute(
+            "SELECT sender, destination, subject, date,"
+            " COALESCE(bodies.content, messages.content)"
+            " FROM messages LEFT JOIN bodies USING (body_id)"
+            " WHERE recipient = ? AND message_id = ?",
+            (username, message_id)).fetchone()
+        if row is None:
+            return None
+        sender, destination, subject, date, content = row
+        return gloutils.EmailContentPayload(sender=sender,
+                                            destination=destination,
+                                            subject=subject, date=date,
+                                            content=content)
+
+    def delete_message(self, username: str, number: int) -> bool:
+        username = username.lower()
+        message_id = self._message_id(self._connect(), username, number)
+        if message_id is None:
+            return False
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT size, body_id FROM messages"
+                " WHERE recipient = ? AND message_id = ?",
+                (username, message_id)).fetchone()
+            if row is None:
+                # Supprimé entre-temps par un autre fil ou processus.
+                return False
+            size, body_id = row
+            physical = size
+            connection.execute(
+                "DELETE FROM messages WHERE recipient = ? AND message_id = ?",
+                (username.lower(), message_id))
+            connection.execute(
+                "DELETE FROM search_documents"
+                " WHERE recipient = ? AND message_id = ?",
+                (username.lower(), message_id))
+            if body_id is not None:
+                refcount, body_size = connection.execute(
+                    "UPDATE bodies SET refcount = refcount - 1"
+                    " WHERE body_id = ? RETURNING refcount + 1, size",
+                    (body_id,)).fetchone()
+                physical = size - body_size + body_size // refcount
+                self._reshare(connection, body_id, body_size,
+                              refcount, refcount - 1)
+                connection.execute(
+                    "DELETE FROM bodies WHERE body_id = ? AND refcount <= 0",
+                    (body_id,))
+            connection.execute(
+                "UPDATE users SET message_count = message_count - 1,"
+                " mailbox_size = mailbox_size - ?,"
+                " physical_size = physical_size - ? WHERE username = ?",
+                (size, physical, username.lower()))
+        self._forget_message(username, message_id)
+        with self._search_lock:
+            cached = self._search_indexes.peek(username)
+            if cached is not None:
+                index, message_ids = cached
+                index.discard(message_id)
+                position = bisect.bisect_left(message_ids, message_id)
+                if message_ids[position:position + 1] == [message_id]:
+                    del message_ids[position]
+        return True
+
+    def _search_index(self, connection: sqlite3.Connection, username: str
+                      ) -> tuple[InvertedIndex, list[str]]:
+        """
+        Retourne l'index inversé de la boîte et les identifiants de ses
+        courriels en ordre croissant, complétés par les courriels reçus
+        depuis le dernier appel (voir `_read_since`). Doit être appelée en
+        tenant `_search_lock`.
+        """
+        index, message_ids = self._search_indexes.get(
+            username, lambda: (InvertedIndex(), []))
+        rows, replaced = self._read_since(
+            connection, username, message_ids,
+            "SELECT message_id, terms FROM search_documents"
+            " WHERE recipient = ? AND message_id > ? ORDER BY message_id")
+        if replaced:
+            index, message_ids = InvertedIndex(), []
+            self._search_indexes.put(username, (index, message_ids))
+        for message_id, document in rows:
+            index.add(message_id, document.split())
+            message_ids.append(message_id)
+        return index, message_ids
+
+    def search(self, username: str, terms: Sequence[str], offset: int = 0,
+               limit: Optional[int] = None
+               ) -> tuple[list[tuple[int, MessageHeader]], int]:
+        """
+        Les identifiants trouvés sont numérotés un à un par leur rang parmi
+        ceux de la boîte, gardés avec l'index inversé; seuls les en-têtes des
+        courriels de la page demandée sont lus ensuite.
+        """
+        username = username.lower()
+        connection = self._connect()
+        with self._search_lock:
+            index, message_ids = self._search_index(connection, username)
+            numbered = sorted(
+                (len(message_ids) - bisect.bisect_left(message_ids,
+                                                       message_id),
+                 message_id)
+                for message_id in index.search(terms))
+        stop = None if limit is None else offset + limit
+        results = []
+        for number, message_id in numbered[offset:stop]:
+            row = connection.execute(
+                "SELECT sender, subject, date, size FROM messages"
+                " WHERE recipient = ? AND message_id = ?",
+                (username, message_id)).fetchone()
+            if row is not None:
+                sender, subject, date, size = row
+                results.append((number, MessageHeader(
+                    sender=sender, subject=subject, date=date, size=size)))
+        return results, len(numbered)
+
+    def stats(self, username: str) -> tuple[int, int]:
+        row = self._connect().execute(
+            "SELECT message_count, mailbox_size FROM users"
+            " WHERE username = ?", (username.lower(),)).fetchone()
+        return (0, 0) if row is None else (row[0], row[1])
+
+    def physical_size(self, username: str) -> int:
+        """
+        Retourne l'espace occupé par les courriels de la boîte, tenu à jour
+        dans la table des utilisateurs: la taille de chaque courriel, dont
+        le contenu partagé ne compte que pour sa part, revue à chaque
+        remise ou suppression d'un courriel qui y fait référence.
+        """
+        row = self._connect().execute(
+            "SELECT physical_size FROM users WHERE username = ?",
+            (username.lower(),)).fetchone()
+        return 0 if row is None else row[0]
+
+    def close(self) -> None:
+        with self._connections_lock:
+            connections, self._connections = self._connections, set()
+            self._local = threading.local()
+        for connection in connections:
+            connection.close()
@@ -3,14 +3,24 @@ Module fournissant les constantes, énumérations,
 protocoles et gabarits à utiliser pour le TP4.
 """
 import enum
-from typing import TypedDict, Union
+import json
+import os
+import struct
+import threading
+import time
+from typing import NotRequired, TypedDict, Union
 import datetime
 
 APP_PORT = 5321
 SERVER_DATA_DIR = "glo_server_data"
 SERVER_LOST_DIR = "LOST"
+SERVER_BODIES_DIR = "BODIES"
 SERVER_DOMAIN = "glo2000.ca"
 PASSWORD_FILENAME = "pass"  # nosec:B105
+SESSION_FILENAME = "session"
+INDEX_FILENAME = "index"
+SEARCH_INDEX_FILENAME = "search"
+SQLITE_FILENAME = "mail.sqlite3"
 
 CLIENT_AUTH_CHOICE = """Menu de connexion
 1. Créer un compte
@@ -20,10 +30,25 @@ CLIENT_USE_CHOICE = """Menu principal
 1. Consultation de courriels
 2. Envoi de courriels
 3. Statistiques
-4. Se déconnecter"""
+4. Se déconnecter
+5. Recherche de courriels"""
 
 SUBJECT_DISPLAY = "#{number} {sender} - {subject} {date}"
 
+INBOX_PAGE_SIZE = 20
+INBOX_PAGE_MAX = 200
+
+# Un courriel peut être envoyé à plusieurs adresses séparées par ce
+# caractère dans `destination`, jusqu'à MAX_RECIPIENTS.
+RECIPIENT_SEPARATOR = ","
+MAX_RECIPIENTS = 1000
+
+# Taille, en caractères, des morceaux d'un courriel transmis par morceaux,
+# et taille de contenu à partir de laquelle le client envoie un courriel
+# par morceaux.
+STREAM_CHUNK_SIZE = 1 << 16
+STREAM_THRESHOLD = 1 << 20
+
 EMAIL_DISPLAY = """De : {sender}
 À : {to}
 Sujet : {subject}
@@ -33,7 +58,8 @@ Date : {date}
 """
 
 STATS_DISPLAY = """Nombre de messages : {count}
-Taille du dossier : {size} octets"""
+Taille du dossier : {size} octets
+Espace occupé : {physical_size} octets"""
 
 
 class Headers(enum.IntEnum):
@@ -55,6 +81,21 @@ class Headers(enum.IntEnum):
 
     STATS_REQUEST = enum.auto()
 
+    INBOX_PAGE_REQUEST = enum.auto()
+
+    HELLO = enum.auto()
+
+    EMAIL_STREAM_START = enum.auto()
+    EMAIL_STREAM_CHUNK = enum.auto()
+    EMAIL_STREAM_END = enum.auto()
+
+    AUTH_RESUME = enum.auto()
+
+    METRICS_REQUEST = enum.auto()
+    PROFILE_REQUEST = enum.auto()
+
+    SEARCH_REQUEST = enum.auto()
+
 
 class ErrorPayload(TypedDict, total=True):
     """Payload pour les messages d'erreurs."""
@@ -76,20 +117,123 @@ class EmailContentPayload(TypedDict, total=True):
     content: str
 
 
+class EmailStreamStartPayload(TypedDict, total=True):
+    """
+    Payload pour le début d'un courriel transmis par morceaux: le courriel
+    sans son contenu, qui suit dans des messages EMAIL_STREAM_CHUNK jusqu'à
+    EMAIL_STREAM_END.
+    """
+    sender: str
+    destination: str
+    subject: str
+    date: str
+
+
+class EmailChunkPayload(TypedDict, total=True):
+    """Payload pour un morceau du contenu d'un courriel."""
+    data: str
+
+
 class EmailListPayload(TypedDict, total=True):
     """Payload pour les consulation de courriel."""
     email_list: list[str]
 
 
+class EmailPageRequestPayload(TypedDict, total=True):
+    """Payload pour la demande d'une page de la liste des courriels."""
+    offset: int
+    limit: int
+
+
+class EmailPagePayload(TypedDict, total=True):
+    """
+    Payload pour une page de la liste des courriels.
+
+    `offset` est le nombre de courriels plus récents que le premier de la
+    page et `total` le nombre de courriels de la boîte.
+    """
+    email_list: list[str]
+    offset: int
+    total: int
+
+
+class SearchRequestPayload(TypedDict, total=True):
+    """
+    Payload pour la recherche de courriels: les mots cherchés dans
+    l'expéditeur, le sujet et le contenu, et la page de résultats voulue
+    (par défaut, les INBOX_PAGE_SIZE plus récents). Les résultats sont
+    transmis comme une page de la liste des courriels, `total` étant le
+    nombre de courriels trouvés.
+    """
+    query: str
+    offset: NotRequired[int]
+    limit: NotRequired[int]
+
+
 class EmailChoicePayload(TypedDict, total=True):
-    """Payload pour le choix du courriel à consulter."""
+    """
+    Payload pour le choix du courriel à consulter.
+
+    Avec `stream`, le courriel est transmis par morceaux.
+    """
     choice: int
+    stream: NotRequired[bool]
 
 
 class StatsPayload(TypedDict, total=True):
-    """Payload pour les statistiques."""
+    """
+    Payload pour les statistiques.
+
+    `size` est la taille des courriels de la boîte et `physical_size` la
+    part de l'espace réellement occupé qui lui revient: un contenu partagé
+    avec d'autres courriels n'y compte qu'au prorata de ses références.
+    """
     count: int
     size: int
+    physical_size: NotRequired[int]
+
+
+class HelloPayload(TypedDict, total=True):
+    """
+    Payload pour la négociation du codec et de la compression.
+
+    Le client propose les codecs et les compressions qu'il connaît par
+    ordre de préférence et le serveur répond avec ceux qu'il retient: un
+    seul codec, et au plus une compression.
+    """
+    codecs: list[str]
+    compression: NotRequired[list[str]]
+
+
+class SessionPayload(TypedDict, total=True):
+    """
+    Payload portant le jeton de session remis à la connexion, que le
+    client présente avec AUTH_RESUME pour reprendre sa session.
+    """
+    token: str
+
+
+class MetricsPayload(TypedDict, total=True):
+    """
+    Payload pour les métriques du serveur (voir glometrics.Metrics).
+    """
+    metrics: dict
+
+
+class RecipientResult(TypedDict, total=True):
+    """Résultat de l'envoi d'un courriel à l'un de ses destinataires."""
+    destination: str
+    error_message: NotRequired[str]
+
+
+class DeliveryReportPayload(TypedDict, total=True):
+    """
+    Payload de la réponse à l'envoi d'un courriel: le résultat pour chaque
+    destinataire et, si l'un d'eux n'a pas reçu le courriel, un message
+    d'erreur résumant les échecs.
+    """
+    results: list[RecipientResult]
+    error_message: NotRequired[str]
 
 
 class GloMessage(TypedDict, total=False):
@@ -101,10 +245,185 @@ class GloMessage(TypedDict, total=False):
     """
     header: Headers
     payload: Union[ErrorPayload, AuthPayload, EmailContentPayload,
-                   EmailListPayload, EmailChoicePayload, StatsPayload]
+                   EmailListPayload, EmailPageRequestPayload,
+                   EmailPagePayload, EmailChoicePayload, StatsPayload,
+                   HelloPayload, EmailStreamStartPayload, EmailChunkPayload,
+                   SessionPayload, MetricsPayload, DeliveryReportPayload,
+                   SearchRequestPayload]
+
+
+# Codecs des messages. Une connexion commence toujours en JSON; l'entête
+# HELLO permet ensuite de passer au codec binaire, plus compact et plus
+# rapide à analyser.
+CODEC_JSON = "json"
+CODEC_BINARY = "binary"
+CODECS = (CODEC_BINARY, CODEC_JSON)
+
+# Compressions des gros messages, négociées avec l'entête HELLO
+# (voir glosocket.frame_bytes).
+COMPRESSION_ZLIB = "zlib"
+COMPRESSIONS = (COMPRESSION_ZLIB,)
+
+# Champs connus des payloads, transmis par leur indice dans le codec
+# binaire. Les nouveaux champs doivent être ajoutés à la fin.
+_PAYLOAD_FIELDS = (
+    "error_message", "username", "password", "sender", "destination",
+    "subject", "date", "content", "email_list", "offset", "limit", "total",
+    "choice", "count", "size", "codecs", "compression", "stream", "data",
+    "token", "metrics", "results", "physical_size", "query",
+)
+_FIELD_IDS = {name: index for index, name in enumerate(_PAYLOAD_FIELDS)}
+# Indice réservé aux champs inconnus, transmis avec leur nom.
+_NAMED_FIELD = 0xFF
+
+_TYPE_STR = 0
+_TYPE_INT = 1
+_TYPE_BOOL = 2
+_TYPE_STR_LIST = 3
+_TYPE_JSON = 4
+
+# Entête d'un champ (indice, type) suivie d'une taille ou d'une valeur.
+_FIELD_HEADER = struct.Struct("!BB")
+_FIELD_SIZED = struct.Struct("!BBI")
+_FIELD_INT = struct.Struct("!BBq")
+_FIELD_BOOL = struct.Struct("!BBB")
+_LENGTH = struct.Struct("!I")
+_INT = struct.Struct("!q")
+
+
+def _pack_field(parts: list[bytes], field_id: int, value) -> None:
+    """Ajoute l'indice, le type puis la valeur d'un champ de payload."""
+    if isinstance(value, bool):
+        parts.append(_FIELD_BOOL.pack(field_id, _TYPE_BOOL, value))
+    elif isinstance(value, int) and -(1 << 63) <= value < (1 << 63):
+        parts.append(_FIELD_INT.pack(field_id, _TYPE_INT, value))
+    elif isinstance(value, str):
+        data = value.encode("utf-8")
+        parts.append(_FIELD_SIZED.pack(field_id, _TYPE_STR, len(data)))
+        parts.append(data)
+    elif (isinstance(value, list)
+          and all(isinstance(item, str) for item in value)):
+        parts.append(_FIELD_SIZED.pack(field_id, _TYPE_STR_LIST, len(value)))
+        for item in value:
+            data = item.encode("utf-8")
+            parts.append(_LENGTH.pack(len(data)))
+            parts.append(data)
+    else:
+        data = json.dumps(value).encode("utf-8")
+        parts.append(_FIELD_SIZED.pack(field_id, _TYPE_JSON, len(data)))
+        parts.append(data)
+
+
+def encode_message(message: GloMessage, codec: str = CODEC_JSON) -> bytes:
+    """
+    Sérialise un message avec le codec donné.
+
+    Le codec binaire transmet l'entête sur un octet, suivie du nombre de
+    champs du payload puis, pour chaque champ, de son indice, de son type
+    et de sa valeur. Les chaînes sont préfixées par leur taille. Un
+    message sans payload tient sur un seul octet.
+    """
+    if codec == CODEC_JSON:
+        return json.dumps(message).encode("utf-8")
+    payload = message.get("payload")
+    if payload is None:
+        return bytes((message["header"],))
+    parts = [bytes((message["header"], len(payload)))]
+    for name, value in payload.items():
+        field_id = _FIELD_IDS.get(name)
+        if field_id is None:
+            # Champ inconnu: son nom est transmis avant le champ lui-même.
+            data = name.encode("utf-8")
+            parts.append(_FIELD_HEADER.pack(_NAMED_FIELD, len(data)))
+            parts.append(data)
+            field_id = _NAMED_FIELD
+        _pack_field(parts, field_id, value)
+    return b"".join(parts)
+
+
+def _decode_binary(data: Union[bytes, bytearray]) -> GloMessage:
+    """Décode un message binaire; voir `encode_message`."""
+    message = GloMessage(header=Headers(data[0]))
+    size = len(data)
+    if size == 1:
+        return message
+    payload = {}
+    position = 2
+    for _ in range(data[1]):
+        field_id, kind = _FIELD_HEADER.unpack_from(data, position)
+        position += 2
+        if field_id == _NAMED_FIELD:
+            name = data[position:position + kind].decode("utf-8")
+            position += kind
+            field_id, kind = _FIELD_HEADER.unpack_from(data, position)
+            position += 2
+        else:
+            name = _PAYLOAD_FIELDS[field_id]
+        if kind == _TYPE_INT:
+            payload[name], = _INT.unpack_from(data, position)
+            position += 8
+        elif kind == _TYPE_BOOL:
+            payload[name] = bool(data[position])
+            position += 1
+        elif kind == _TYPE_STR_LIST:
+            count, = _LENGTH.unpack_from(data, position)
+            position += 4
+            items = []
+            for _ in range(count):
+                length, = _LENGTH.unpack_from(data, position)
+                position += 4
+                items.append(data[position:position + length].decode("utf-8"))
+                position += length
+            payload[name] = items
+        elif kind == _TYPE_STR or kind == _TYPE_JSON:
+            length, = _LENGTH.unpack_from(data, position)
+            position += 4
+            value = data[position:position + length].decode("utf-8")
+            position += length
+            payload[name] = value if kind == _TYPE_STR else json.loads(value)
+        else:
+            raise ValueError(f"Type de champ inconnu: {kind}")
+    if position != size:
+        raise ValueError("Taille du message binaire invalide")
+    message["payload"] = payload
+    return message
+
+
+def decode_message(data: Union[bytes, bytearray],
+                   codec: str = CODEC_JSON) -> GloMessage:
+    """
+    Désérialise un message reçu avec le codec donné.
+
+    Lève une exception ValueError si le message est invalide.
+    """
+    if codec == CODEC_JSON:
+        return json.loads(data)
+    try:
+        return _decode_binary(data)
+    except (IndexError, struct.error) as ex:
+        raise ValueError("Message binaire invalide") from ex
 
 
 def get_current_utc_time() -> str:
     """Récupère l'heure courante au fuseau UTC et la formatte en string."""
     current_time = datetime.datetime.now(datetime.timezone.utc)
     return current_time.strftime("%a, %d %b %Y %H:%M:%S %z")
+
+
+_last_message_ns = 0
+_message_id_lock = threading.Lock()
+
+
+def new_message_id() -> str:
+    """
+    Génère un identifiant de courriel unique et triable.
+
+    L'identifiant est un horodatage en nanosecondes, strictement croissant
+    au sein du processus, suivi du numéro du processus. L'ordre
+    lexicographique des identifiants est donc l'ordre de réception, même
+    pour plusieurs courriels reçus dans la même seconde.
+    """
+    global _last_message_ns
+    with _message_id_lock:
+        _last_message_ns = max(time.time_ns(), _last_message_ns + 1)
+        return f"{_last_message_ns:020d}-{os.getpid():07d}"
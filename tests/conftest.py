@@ -0,0 +1,39 @@
+"""Configuration des tests: les modules du projet sont à la racine."""
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import glostorage  # noqa: E402
+import gloutils  # noqa: E402
+import TP4_server  # noqa: E402
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """Serveur sur un port libre, avec un stockage dans `tmp_path`."""
+    monkeypatch.setattr(gloutils, "APP_PORT", 0)
+    storage = glostorage.FileSystemStorage(str(tmp_path))
+    instance = TP4_server.Server(storage,
+                                 durability=glostorage.DURABILITY_NONE)
+    yield instance
+    instance.cleanup()
+
+
+@pytest.fixture
+def pooled_server(tmp_path, monkeypatch):
+    """
+    Comme `server`, avec un bassin de deux fils d'exécution et au plus un
+    traitement STATS_REQUEST à la fois.
+    """
+    monkeypatch.setattr(gloutils, "APP_PORT", 0)
+    storage = glostorage.FileSystemStorage(str(tmp_path))
+    instance = TP4_server.Server(
+        storage, workers=2,
+        queue_limits={gloutils.Headers.STATS_REQUEST: 1},
+        durability=glostorage.DURABILITY_NONE)
+    yield instance
+    instance.cleanup()
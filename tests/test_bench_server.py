@@ -0,0 +1,26 @@
+"""Tests des utilitaires du générateur de charge bench_server."""
+import argparse
+
+import pytest
+
+import bench_server
+import gloutils
+
+
+def test_percentile_uses_nearest_rank():
+    samples = [float(value) for value in range(1, 101)]
+    assert bench_server._percentile(samples, 0.5) == 51.0
+    assert bench_server._percentile(samples, 0.99) == 100.0
+    assert bench_server._percentile([], 0.5) == 0.0
+
+
+def test_parse_weight_accepts_mix_headers():
+    assert bench_server._parse_weight(" stats_request=4") == (
+        gloutils.Headers.STATS_REQUEST, 4)
+
+
+@pytest.mark.parametrize("value", [
+    "STATS_REQUEST", "STATS_REQUEST=-1", "INCONNU=1", "AUTH_LOGIN=1"])
+def test_parse_weight_rejects_invalid_weights(value):
+    with pytest.raises(argparse.ArgumentTypeError):
+        bench_server._parse_weight(value)
@@ -0,0 +1,81 @@
+"""Tests de l'API programmatique du client contre un serveur local."""
+import asyncio
+import concurrent.futures
+import threading
+
+import pytest
+
+import gloutils
+import TP4_client
+
+
+@pytest.fixture
+def address(server, monkeypatch):
+    """
+    Sert `server` avec le moteur asyncio dans un fil d'exécution et
+    retourne l'adresse à laquelle le client se connecte.
+    """
+    server._executor = concurrent.futures.ThreadPoolExecutor(2)
+    server._server_socket.setblocking(False)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    async def _start() -> asyncio.Server:
+        return await asyncio.start_server(server._handle_stream,
+                                          sock=server._server_socket)
+
+    engine = asyncio.run_coroutine_threadsafe(_start(), loop).result()
+    monkeypatch.setattr(gloutils, "APP_PORT",
+                        server._server_socket.getsockname()[1])
+    yield "127.0.0.1"
+
+    async def _stop() -> None:
+        # Les clients ont prévenu le serveur avec BYE: leurs coroutines se
+        # terminent d'elles-mêmes.
+        engine.close()
+        await asyncio.gather(*asyncio.all_tasks() - {asyncio.current_task()})
+
+    asyncio.run_coroutine_threadsafe(_stop(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def test_client_api_round_trip(address):
+    client = TP4_client.Client(address)
+    try:
+        client.register("alice", "MotDePasse1234")
+        assert client.username == "alice"
+        results = client.send_email("alice@glo2000.ca", "Sujet", "Bonjour")
+        assert results == [{"destination": "alice@glo2000.ca"}]
+        page = client.list_emails()
+        assert page["total"] == 1
+        assert client.get_email(1)["content"] == "Bonjour"
+        assert client.stats()["count"] == 1
+        with pytest.raises(TP4_client.ClientError):
+            client.get_email(2)
+    finally:
+        client.close()
+
+
+def test_batch_sends_every_email_on_one_connection(address):
+    client = TP4_client.Client(address)
+    try:
+        client.register("alice", "MotDePasse1234")
+        batch = [("alice@glo2000.ca", f"Sujet {index}", "Bonjour")
+                 for index in range(TP4_client.BATCH_WINDOW + 2)]
+        batch.append(("personne@ailleurs.ca", "Perdu", "Bonjour"))
+        errors = list(client.send_emails(batch))
+        assert errors[:-1] == [None] * (TP4_client.BATCH_WINDOW + 2)
+        assert errors[-1] is not None
+        assert client.stats()["count"] == TP4_client.BATCH_WINDOW + 2
+    finally:
+        client.close()
+
+
+def test_read_batch_skips_blank_lines():
+    lines = ['{"destination": "a@glo2000.ca", "subject": "s",'
+             ' "content": "c"}\n', "\n"]
+    assert list(TP4_client._read_batch(lines)) == [
+        ("a@glo2000.ca", "s", "c")]
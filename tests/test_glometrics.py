@@ -0,0 +1,34 @@
+"""Tests du profilage à la demande de glometrics."""
+import os
+import pstats
+
+import glometrics
+
+
+def _busy(count: int) -> int:
+    return sum(range(count))
+
+
+def test_profiler_only_profiles_during_its_window(tmp_path):
+    profiler = glometrics.Profiler(str(tmp_path), window=60.0)
+    assert profiler.run(_busy, 10) == 45
+    assert profiler.poll() is None
+    assert profiler.start()
+    assert not profiler.start()
+    assert profiler.run(_busy, 1000) == 499500
+    assert profiler.poll() > 0
+    profiler.stop()
+    assert profiler.poll() is None
+    assert not profiler.active
+    files = os.listdir(tmp_path)
+    assert len(files) == 1
+    stats = pstats.Stats(str(tmp_path / files[0]))
+    assert any(name == "_busy" for _, _, name in stats.stats)
+
+
+def test_empty_window_writes_no_profile(tmp_path):
+    profiler = glometrics.Profiler(str(tmp_path / "profils"), window=60.0)
+    assert profiler.start()
+    profiler.stop()
+    assert profiler.poll() is None
+    assert not os.path.exists(tmp_path / "profils")
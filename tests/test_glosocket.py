@@ -0,0 +1,171 @@
+"""Tests du découpage des messages de glosocket."""
+import asyncio
+import socket
+import struct
+import zlib
+
+import pytest
+
+import glosocket
+
+
+@pytest.fixture
+def sockets():
+    first, second = socket.socketpair()
+    yield first, second
+    first.close()
+    second.close()
+
+
+def test_recv_mesg_round_trip(sockets):
+    sender, receiver = sockets
+    glosocket.send_mesg(sender, "é" * 5000)
+    glosocket.send_mesg(sender, "")
+    assert glosocket.recv_mesg(receiver) == "é" * 5000
+    assert glosocket.recv_mesg(receiver) == ""
+
+
+def test_recv_mesg_bytes_rejects_oversized_prefix(sockets):
+    sender, receiver = sockets
+    sender.sendall(struct.pack("!I", glosocket.MAX_FRAME_SIZE + 1))
+    with pytest.raises(glosocket.GLOSocketError, match="too large"):
+        glosocket.recv_mesg_bytes(receiver)
+
+
+def test_recv_mesg_bytes_rejects_closed_socket(sockets):
+    sender, receiver = sockets
+    sender.sendall(struct.pack("!I", 10) + b"abc")
+    sender.close()
+    with pytest.raises(glosocket.GLOSocketError):
+        glosocket.recv_mesg_bytes(receiver)
+
+
+def test_recv_mesg_bytes_async_rejects_oversized_prefix():
+    async def _receive():
+        reader = asyncio.StreamReader()
+        reader.feed_data(struct.pack("!I", glosocket.MAX_FRAME_SIZE + 1))
+        reader.feed_eof()
+        await glosocket.recv_mesg_bytes_async(reader)
+
+    with pytest.raises(glosocket.GLOSocketError, match="too large"):
+        asyncio.run(_receive())
+
+
+def _frame(data: bytes) -> bytes:
+    return b"".join(glosocket.frame_bytes(data))
+
+
+def test_frame_decoder_splits_frames_fed_byte_by_byte():
+    decoder = glosocket.FrameDecoder()
+    data = _frame(b"premier") + _frame(b"") + _frame(b"x" * 3000)
+    for index in range(len(data)):
+        decoder.feed(data[index:index + 1])
+    assert decoder.next_frame() == b"premier"
+    assert decoder.next_frame() == b""
+    assert decoder.next_frame() == b"x" * 3000
+    assert decoder.next_frame() is None
+    assert not decoder.has_frames
+
+
+def test_frame_decoder_keeps_partial_frame():
+    decoder = glosocket.FrameDecoder()
+    data = _frame(b"complet") + _frame(b"partiel")
+    decoder.feed(data[:-3])
+    assert decoder.next_frame() == b"complet"
+    assert decoder.next_frame() is None
+    decoder.feed(data[-3:])
+    assert decoder.next_frame() == b"partiel"
+
+
+def test_frame_decoder_rejects_oversized_prefix():
+    decoder = glosocket.FrameDecoder()
+    with pytest.raises(glosocket.GLOSocketError, match="too large"):
+        decoder.feed(struct.pack("!I", glosocket.MAX_FRAME_SIZE + 1))
+
+
+def test_frame_decoder_does_not_preallocate_announced_size():
+    decoder = glosocket.FrameDecoder()
+    decoder.feed(struct.pack("!I", glosocket.MAX_FRAME_SIZE) + b"abc")
+    assert len(decoder._body) == 3
+    assert decoder.next_frame() is None
+
+
+def test_compressed_round_trip(sockets):
+    sender, receiver = sockets
+    message = "courriel " * 1000
+    frames = glosocket.frame_mesg(message, compress=True)
+    prefix, = struct.unpack("!I", frames[0])
+    assert prefix & glosocket._COMPRESSED_FLAG
+    glosocket.send_mesg(sender, message, compress=True)
+    assert glosocket.recv_mesg(receiver, compressed=True) == message
+
+
+def test_small_messages_are_not_compressed():
+    frames = glosocket.frame_mesg("court", compress=True)
+    prefix, = struct.unpack("!I", frames[0])
+    assert prefix == len("court")
+
+
+def test_compressed_frame_requires_negotiation(sockets):
+    sender, receiver = sockets
+    glosocket.send_mesg(sender, "courriel " * 1000, compress=True)
+    with pytest.raises(glosocket.GLOSocketError, match="negotiation"):
+        glosocket.recv_mesg(receiver)
+
+
+def test_frame_decoder_requires_negotiation():
+    decoder = glosocket.FrameDecoder()
+    decoder.feed(b"".join(glosocket.frame_mesg("x" * 5000, compress=True)))
+    decoder.feed(_frame(b"suivant"))
+    with pytest.raises(glosocket.GLOSocketError, match="negotiation"):
+        decoder.next_frame()
+
+
+def test_frame_decoder_decompresses_when_negotiated():
+    decoder = glosocket.FrameDecoder()
+    decoder.feed(b"".join(glosocket.frame_mesg("x" * 5000, compress=True)))
+    assert decoder.next_frame(compressed=True) == b"x" * 5000
+
+
+def _compressed_frame(data: bytes) -> bytes:
+    return struct.pack("!I", len(data) | glosocket._COMPRESSED_FLAG) + data
+
+
+def test_decompression_bomb_is_rejected():
+    bomb = zlib.compress(b"\0" * (glosocket.MAX_FRAME_SIZE + 1), 9)
+    decoder = glosocket.FrameDecoder()
+    decoder.feed(_compressed_frame(bomb))
+    with pytest.raises(glosocket.GLOSocketError, match="too large"):
+        decoder.next_frame(compressed=True)
+
+
+@pytest.mark.parametrize("data", [
+    b"pas du zlib",
+    zlib.compress(b"tronque" * 100)[:-4],
+    zlib.compress(b"complet") + b"reste",
+])
+def test_invalid_compressed_frame_is_rejected(data):
+    decoder = glosocket.FrameDecoder()
+    decoder.feed(_compressed_frame(data))
+    with pytest.raises(glosocket.GLOSocketError, match="not a valid"):
+        decoder.next_frame(compressed=True)
+
+
+def test_connection_sends_queued_requests_on_flush(sockets):
+    client, server = sockets
+    connection = glosocket.GLOConnection(client)
+    connection.queue("premier")
+    connection.queue(b"second")
+    connection.queue("au revoir", expect_response=False)
+    server.setblocking(False)
+    with pytest.raises(BlockingIOError):
+        server.recv(1)
+    server.setblocking(True)
+    connection.flush()
+    assert connection.pending_responses == 2
+    assert [glosocket.recv_mesg(server) for _ in range(3)] == [
+        "premier", "second", "au revoir"]
+    glosocket.send_mesg(server, "réponse 1")
+    glosocket.send_mesg(server, "réponse 2")
+    assert connection.recv_responses() == ["réponse 1", "réponse 2"]
+    assert connection.pending_responses == 0
@@ -0,0 +1,641 @@
+"""Tests des moteurs de stockage de glostorage et de leur contrat commun."""
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import glostorage
+import gloutils
+
+BACKENDS = ["filesystem", "segment", "sqlite"]
+
+
+def make_storage(kind: str, data_dir: str) -> glostorage.MailStorage:
+    """Retourne un moteur `kind` dont les données sont dans `data_dir`."""
+    if kind == "sqlite":
+        return glostorage.SQLiteStorage(
+            os.path.join(data_dir, gloutils.SQLITE_FILENAME))
+    if kind == "segment":
+        return glostorage.SegmentLogStorage(data_dir)
+    return glostorage.FileSystemStorage(data_dir)
+
+
+def make_email(subject: str, content: str = "contenu",
+               destination: str = "bob@glo2000.ca"
+               ) -> gloutils.EmailContentPayload:
+    return gloutils.EmailContentPayload(
+        sender="alice@glo2000.ca", destination=destination,
+        subject=subject, date="2026-01-01 00:00:00", content=content)
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def storage(backend, tmp_path):
+    instance = make_storage(backend, str(tmp_path))
+    instance.create_user("bob", "hachage")
+    yield instance
+    instance.close()
+
+
+def test_duplicate_registration_is_refused(storage):
+    assert storage.user_exists("BOB")
+    assert not storage.create_user("Bob", "autre")
+    assert storage.get_password_hash("bob") == "hachage"
+    assert storage.verify_password("bob", "hachage")
+    assert not storage.verify_password("bob", "autre")
+    assert storage.get_password_hash("carl") is None
+    assert not storage.verify_password("carl", "hachage")
+
+
+def test_session_epoch_is_advanced_by_revocation(storage, backend,
+                                                tmp_path):
+    epoch = storage.session_epoch("BOB")
+    assert epoch is not None
+    assert storage.session_epoch("carl") is None
+    storage.revoke_sessions("Bob")
+    assert storage.session_epoch("bob") == epoch + 1
+    storage.revoke_sessions("carl")
+    assert storage.session_epoch("carl") is None
+    reopened = make_storage(backend, str(tmp_path))
+    try:
+        assert reopened.session_epoch("bob") == epoch + 1
+    finally:
+        reopened.close()
+
+
+def test_messages_are_numbered_newest_first(storage):
+    for index in range(5):
+        storage.append_message("bob", make_email(f"sujet {index}"))
+    headers, total = storage.list_headers("bob")
+    assert total == 5
+    assert [header["subject"] for header in headers] == [
+        f"sujet {index}" for index in range(4, -1, -1)]
+    headers, total = storage.list_headers("bob", offset=1, limit=2)
+    assert [header["subject"] for header in headers] == ["sujet 3",
+                                                         "sujet 2"]
+    assert storage.fetch_message("bob", 1)["subject"] == "sujet 4"
+    assert storage.fetch_message("bob", 5)["subject"] == "sujet 0"
+    assert storage.fetch_message("bob", 0) is None
+    assert storage.fetch_message("bob", 6) is None
+
+
+@pytest.mark.parametrize("content", ["court \"é\"\n", "x" * 10000])
+def test_fetch_formats_agree(storage, content):
+    email = make_email("sujet", content)
+    storage.append_message("bob", email)
+    assert storage.fetch_message("bob", 1) == email
+    wire = storage.fetch_message_wire("bob", 1)
+    assert gloutils.decode_message(bytes(wire))["payload"] == email
+    header, chunks = storage.stream_message("bob", 1, 1000)
+    assert header["subject"] == "sujet"
+    assert "".join(chunks) == content
+
+
+def test_delete_message(storage):
+    for index in range(3):
+        storage.append_message("bob", make_email(f"sujet {index}"))
+    assert storage.delete_message("bob", 2)
+    assert not storage.delete_message("bob", 3)
+    assert not storage.delete_message("bob", 0)
+    headers, total = storage.list_headers("bob")
+    assert total == 2
+    assert [header["subject"] for header in headers] == ["sujet 2",
+                                                         "sujet 0"]
+
+
+def test_deliver_to_several_recipients(storage):
+    storage.create_user("carl", "hachage")
+    content = "partagé " * 1000
+    storage.deliver(["bob", "carl"], make_email("commun", content))
+    for username in ("bob", "carl"):
+        assert storage.fetch_message(username, 1)["content"] == content
+    assert storage.delete_message("bob", 1)
+    assert storage.fetch_message("carl", 1)["content"] == content
+
+
+def test_streamed_delivery(storage):
+    email = make_email("morceaux", "")
+    header = gloutils.EmailStreamStartPayload(
+        sender=email["sender"], destination=email["destination"],
+        subject=email["subject"], date=email["date"])
+    writer = storage.open_message("bob", header)
+    for _ in range(100):
+        writer.write("morceau é\n")
+    writer.commit()
+    assert storage.fetch_message("bob", 1)["content"] == "morceau é\n" * 100
+
+
+def test_lost_messages_are_redelivered_on_registration(storage):
+    storage.store_lost(make_email("perdu", destination="carl@glo2000.ca"),
+                       ["carl"])
+    assert storage.create_user("carl", "hachage")
+    assert storage.redeliver_lost("carl") == 1
+    assert storage.fetch_message("carl", 1)["subject"] == "perdu"
+    assert storage.redeliver_lost("carl") == 0
+
+
+def test_lost_email_waits_for_each_recipient(storage):
+    storage.store_lost(make_email(
+        "perdu", destination="carl@glo2000.ca, dave@glo2000.ca"),
+        ["carl", "dave"])
+    assert storage.create_user("carl", "hachage")
+    assert storage.redeliver_lost("carl") == 1
+    assert storage.create_user("dave", "hachage")
+    assert storage.redeliver_lost("dave") == 1
+    assert storage.fetch_message("dave", 1)["subject"] == "perdu"
+    assert storage.redeliver_lost("carl") == 0
+
+
+def _lost_entry(filename: str, recipient: str,
+                stored: float) -> glostorage.LostEntry:
+    return glostorage.LostEntry(
+        sender="alice@glo2000.ca", subject=filename, date="", size=100,
+        id=gloutils.new_message_id(), recipient=recipient,
+        filename=filename, stored=stored)
+
+
+def test_lost_index_evicts_oldest_emails(tmp_path):
+    index = glostorage.LostIndex(str(tmp_path), max_size=250, max_age=60)
+    now = time.time()
+    for filename, recipients in [("a.json", ["carl", "dave"]),
+                                 ("b.json", ["carl"]),
+                                 ("c.json", ["erin"])]:
+        (tmp_path / filename).write_bytes(b"x" * 100)
+        index.add([_lost_entry(filename, recipient, now)
+                   for recipient in recipients])
+    # a.json, compté une fois pour ses deux destinataires, est évincé
+    # lorsque c.json fait dépasser la limite.
+    assert index.stats() == (2, 200)
+    assert not (tmp_path / "a.json").exists()
+    delivered = []
+    assert index.redeliver("carl", delivered.extend) == 1
+    assert [entry["filename"] for entry in delivered] == ["b.json"]
+    assert not (tmp_path / "b.json").exists()
+    assert index.stats() == (1, 100)
+
+
+def test_lost_index_evicts_expired_emails(tmp_path):
+    index = glostorage.LostIndex(str(tmp_path), max_age=60)
+    for filename, stored in [("a.json", time.time() - 120),
+                             ("b.json", time.time())]:
+        (tmp_path / filename).write_bytes(b"x" * 100)
+        index.add([_lost_entry(filename, "carl", stored)])
+    assert index.stats() == (1, 100)
+    assert not (tmp_path / "a.json").exists()
+
+
+def test_data_survives_reopening(storage, backend, tmp_path):
+    storage.append_message("bob", make_email("durable"))
+    reopened = make_storage(backend, str(tmp_path))
+    try:
+        assert reopened.fetch_message("bob", 1)["subject"] == "durable"
+        assert not reopened.create_user("bob", "autre")
+    finally:
+        reopened.close()
+
+
+def _subjects(storage: glostorage.MailStorage, username: str = "bob"
+              ) -> list[str]:
+    headers, _ = storage.list_headers(username)
+    return [header["subject"] for header in headers]
+
+
+def test_sqlite_close_closes_every_connection(tmp_path):
+    storage = make_storage("sqlite", str(tmp_path))
+    storage.create_user("bob", "hachage")
+    worker = threading.Thread(target=storage.stats, args=("bob",))
+    worker.start()
+    worker.join()
+    connections = list(storage._connections)
+    assert len(connections) == 2
+    storage.close()
+    for connection in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            connection.execute("SELECT 1")
+    # Le moteur rouvre une connexion au besoin.
+    assert storage.stats("bob") == (0, 0)
+    storage.close()
+
+
+def test_sqlite_numbering_follows_other_processes(tmp_path):
+    first = make_storage("sqlite", str(tmp_path))
+    second = make_storage("sqlite", str(tmp_path))
+    try:
+        first.create_user("bob", "hachage")
+        for index in range(5):
+            first.append_message("bob", make_email(f"sujet {index}"))
+        assert first.fetch_message("bob", 2)["subject"] == "sujet 3"
+        # L'autre processus supprime un courriel et en reçoit un autre.
+        assert second.delete_message("bob", 4)
+        second.append_message("bob", make_email("sujet 5"))
+        assert _subjects(first) == ["sujet 5", "sujet 4", "sujet 3",
+                                    "sujet 2", "sujet 0"]
+        assert first.fetch_message("bob", 5)["subject"] == "sujet 0"
+        assert first.fetch_message("bob", 6) is None
+        assert first.delete_message("bob", 1)
+        assert _subjects(second) == ["sujet 4", "sujet 3", "sujet 2",
+                                     "sujet 0"]
+        headers, total = second.list_headers("bob", 3, 10)
+        assert total == 4
+        assert [header["subject"] for header in headers] == ["sujet 0"]
+        assert second.list_headers("bob", 4, 10) == ([], 4)
+    finally:
+        first.close()
+        second.close()
+
+
+@pytest.fixture
+def segments(tmp_path):
+    instance = glostorage.SegmentLogStorage(str(tmp_path))
+    instance.create_user("bob", "hachage")
+    for index in range(6):
+        instance.append_message("bob", make_email(f"sujet {index}"))
+    instance.deliver(["bob"], make_email("partagé", "x" * 10000))
+    return instance
+
+
+def _rebuild(data_dir) -> glostorage.SegmentLogStorage:
+    """Retire l'index de la boîte et retourne un moteur qui le reconstruit."""
+    os.remove(os.path.join(data_dir, "bob", gloutils.INDEX_FILENAME))
+    return glostorage.SegmentLogStorage(str(data_dir))
+
+
+def test_segment_deletions_survive_index_rebuild(segments, tmp_path):
+    assert segments.delete_message("bob", 2)
+    assert segments.delete_message("bob", 4)
+    expected = _subjects(segments)
+    assert _subjects(_rebuild(tmp_path)) == expected
+
+
+def test_segment_compaction_keeps_live_messages(segments, tmp_path):
+    user_dir = os.path.join(tmp_path, "bob")
+    for _ in range(4):
+        assert segments.delete_message("bob", 2)
+    expected = _subjects(segments)
+    size = sum(os.path.getsize(os.path.join(user_dir, name))
+               for name in os.listdir(user_dir)
+               if name.endswith(glostorage.SEGMENT_SUFFIX))
+    segments._mailbox("bob").compact()
+    assert sum(os.path.getsize(os.path.join(user_dir, name))
+               for name in os.listdir(user_dir)
+               if name.endswith(glostorage.SEGMENT_SUFFIX)) < size
+    assert _subjects(segments) == expected
+    assert segments.fetch_message("bob", 1)["content"] == "x" * 10000
+    assert _subjects(_rebuild(tmp_path)) == expected
+
+
+def test_interrupted_compaction_does_not_duplicate(segments, tmp_path):
+    user_dir = os.path.join(tmp_path, "bob")
+    assert segments.delete_message("bob", 3)
+    expected = _subjects(segments)
+    # Panne après le renommage du segment compacté, avant le remplacement
+    # de l'index et la suppression des anciens segments.
+    saved = {}
+    for name in os.listdir(user_dir):
+        if (name.endswith(glostorage.SEGMENT_SUFFIX)
+                or name == gloutils.INDEX_FILENAME):
+            with open(os.path.join(user_dir, name), "rb") as file:
+                saved[name] = file.read()
+    segments._mailbox("bob").compact()
+    for name, data in saved.items():
+        with open(os.path.join(user_dir, name), "wb") as file:
+            file.write(data)
+    # Sortie d'un compactage interrompu avant son renommage.
+    with open(os.path.join(user_dir, "0" + glostorage.SEGMENT_SUFFIX
+                           + ".tmp"), "wb") as file:
+        file.write(b"\0\0\0\5xxxxx")
+    reopened = glostorage.SegmentLogStorage(str(tmp_path))
+    assert _subjects(reopened) == expected
+    reopened.append_message("bob", make_email("après la panne"))
+    expected = _subjects(reopened)
+    rebuilt = _rebuild(tmp_path)
+    assert _subjects(rebuilt) == expected
+    rebuilt._mailbox("bob").compact()
+    assert _subjects(rebuilt) == expected
+    assert not [name for name in os.listdir(user_dir)
+                if name.endswith(".tmp")]
+    assert _subjects(_rebuild(tmp_path)) == expected
+
+
+@pytest.mark.parametrize("method", ["read_record", "map_record"])
+def test_segment_read_survives_compaction(segments, monkeypatch, method):
+    mailbox = segments._mailbox("bob")
+    read = getattr(mailbox, method)
+    compacted = []
+
+    def _compact_first(entry):
+        # Le compactage supprime le segment de l'entrée déjà relue.
+        if not compacted:
+            compacted.append(True)
+            mailbox.compact()
+        return read(entry)
+
+    monkeypatch.setattr(mailbox, method, _compact_first)
+    if method == "read_record":
+        assert segments.fetch_message("bob", 2)["subject"] == "sujet 5"
+    else:
+        wire = segments.fetch_message_wire("bob", 2)
+        assert gloutils.decode_message(bytes(wire))["payload"][
+            "subject"] == "sujet 5"
+    assert compacted
+
+
+def test_segment_reads_during_background_compaction(segments):
+    expected = _subjects(segments)
+    mailbox = segments._mailbox("bob")
+    done = threading.Event()
+
+    def _compact() -> None:
+        while not done.is_set():
+            mailbox.compact()
+
+    compactor = threading.Thread(target=_compact)
+    compactor.start()
+    try:
+        for _ in range(50):
+            for number, subject in enumerate(expected, start=1):
+                assert segments.fetch_message("bob", number)[
+                    "subject"] == subject
+                wire = segments.fetch_message_wire("bob", number)
+                assert gloutils.decode_message(bytes(wire))["payload"][
+                    "subject"] == subject
+    finally:
+        done.set()
+        compactor.join()
+
+
+def test_map_file_of_empty_file(tmp_path):
+    path = tmp_path / "vide"
+    path.write_bytes(b"")
+    assert bytes(glostorage.map_file(str(path))) == b""
+
+
+def test_map_file_range(tmp_path):
+    path = tmp_path / "plein"
+    path.write_bytes(b"0123456789")
+    assert bytes(glostorage.map_file(str(path), 2, 3)) == b"234"
+    assert bytes(glostorage.map_file(str(path), 8)) == b"89"
+
+
+def test_empty_message_file_is_served(tmp_path):
+    storage = glostorage.FileSystemStorage(str(tmp_path))
+    storage.create_user("bob", "hachage")
+    storage.append_message("bob", make_email("vide", ""))
+    assert storage.fetch_message("bob", 1)["content"] == ""
+    header, chunks = storage.stream_message("bob", 1, 1000)
+    assert "".join(chunks) == ""
+
+
+def test_stats_follow_deliveries_and_deletions(storage):
+    assert storage.stats("bob") == (0, 0)
+    for index in range(4):
+        storage.append_message("bob", make_email(f"sujet {index}",
+                                                 "é" * index))
+    headers, _ = storage.list_headers("bob")
+    count, size = storage.stats("bob")
+    assert count == 4
+    assert size == sum(header["size"] for header in headers) > 0
+    deleted = storage.list_headers("bob", 1, 1)[0][0]["size"]
+    assert storage.delete_message("bob", 2)
+    assert storage.stats("bob") == (3, size - deleted)
+
+
+def test_filesystem_stats_survive_index_rebuild(tmp_path):
+    storage = glostorage.FileSystemStorage(str(tmp_path))
+    storage.create_user("bob", "hachage")
+    for index in range(3):
+        storage.append_message("bob", make_email(f"sujet {index}"))
+    storage.deliver(["bob"], make_email("partagé", "x" * 10000))
+    assert storage.delete_message("bob", 3)
+    expected = storage.stats("bob"), _subjects(storage)
+    os.remove(os.path.join(tmp_path, "bob", gloutils.INDEX_FILENAME))
+    rebuilt = glostorage.FileSystemStorage(str(tmp_path))
+    assert (rebuilt.stats("bob"), _subjects(rebuilt)) == expected
+
+
+def test_physical_size_counts_shared_bodies_once(storage, backend,
+                                                 tmp_path):
+    storage.create_user("carl", "hachage")
+    storage.append_message("bob", make_email("court"))
+    assert storage.physical_size("bob") == storage.stats("bob")[1]
+    content = "partagé " * 2000
+    storage.deliver(["bob", "carl"], make_email("commun", content))
+    _, bob_size = storage.stats("bob")
+    _, carl_size = storage.stats("carl")
+    bob_physical = storage.physical_size("bob")
+    carl_physical = storage.physical_size("carl")
+    assert bob_physical < bob_size
+    assert carl_physical < carl_size
+    # Le contenu n'est compté qu'une fois entre les deux boîtes.
+    assert (bob_physical + carl_physical
+            < bob_size + carl_size - len(content) // 2)
+    reopened = make_storage(backend, str(tmp_path))
+    try:
+        assert reopened.physical_size("bob") == bob_physical
+    finally:
+        reopened.close()
+    assert storage.delete_message("bob", 1)
+    assert storage.delete_message("bob", 1)
+    assert storage.physical_size("bob") == 0
+
+
+def test_identical_bodies_are_deduplicated(storage):
+    storage.create_user("carl", "hachage")
+    content = "identique " * 1000
+    storage.append_message("bob", make_email("premier", content))
+    storage.append_message("carl", make_email("second", content))
+    _, size = storage.stats("bob")
+    assert storage.physical_size("carl") < storage.stats("carl")[1]
+    assert storage.physical_size("bob") <= size
+    assert storage.fetch_message("carl", 1)["content"] == content
+    assert storage.delete_message("bob", 1)
+    assert storage.fetch_message("carl", 1)["content"] == content
+
+
+def test_shares_follow_other_holders(storage, backend, tmp_path):
+    storage.create_user("carl", "hachage")
+    storage.create_user("dave", "hachage")
+    content = "partagé " * 2000
+    storage.deliver(["bob", "carl"], make_email("commun", content))
+    storage.append_message("dave", make_email("commun", content))
+    shared = storage.physical_size("bob")
+    assert storage.physical_size("carl") == shared
+    assert storage.delete_message("dave", 1)
+    assert storage.delete_message("carl", 1)
+    # Seul détenteur restant, bob occupe désormais tout le contenu.
+    _, bob_size = storage.stats("bob")
+    assert storage.physical_size("bob") == bob_size > shared
+    reopened = make_storage(backend, str(tmp_path))
+    try:
+        assert reopened.physical_size("bob") == bob_size
+    finally:
+        reopened.close()
+
+
+def test_sqlite_physical_size_is_migrated(tmp_path):
+    path = str(tmp_path / gloutils.SQLITE_FILENAME)
+    storage = glostorage.SQLiteStorage(path)
+    storage.create_user("bob", "hachage")
+    storage.create_user("carl", "hachage")
+    storage.deliver(["bob", "carl"], make_email("commun", "x" * 10000))
+    storage.append_message("bob", make_email("court"))
+    expected = storage.physical_size("bob")
+    storage.close()
+    with sqlite3.connect(path) as connection:
+        connection.execute("ALTER TABLE users DROP COLUMN physical_size")
+    connection.close()
+    reopened = glostorage.SQLiteStorage(path)
+    try:
+        assert reopened.physical_size("bob") == expected
+    finally:
+        reopened.close()
+
+
+def test_group_commit_close_flushes_pending_batches(monkeypatch):
+    synced = []
+    syncing = threading.Event()
+    release = threading.Event()
+
+    def _sync(paths) -> None:
+        syncing.set()
+        release.wait(5)
+        synced.append(set(paths))
+
+    monkeypatch.setattr(glostorage, "sync_paths", _sync)
+    commits = glostorage.GroupCommit(glostorage.DURABILITY_BATCH)
+    first = commits.commit({"a"}, "premier")
+    assert syncing.wait(5)
+    # Le second lot attend la fin de la synchronisation du premier.
+    second = commits.commit({"b"}, "second")
+    closer = threading.Thread(target=commits.close)
+    closer.start()
+    release.set()
+    closer.join(5)
+    assert not closer.is_alive()
+    assert first.result(0) == "premier"
+    assert second.result(0) == "second"
+    # Après `close`, une remise est synchronisée avant d'être confirmée.
+    assert commits.commit({"c"}, "troisième") == "troisième"
+    assert synced == [{"a"}, {"b"}, {"c"}]
+
+
+@pytest.fixture
+def mailbox(backend, tmp_path):
+    """Moteur dont la boîte de bob contient dix courriels."""
+    storage = make_storage(backend, str(tmp_path))
+    storage.create_user("bob", "hachage")
+    for index in range(10):
+        storage.append_message("bob", make_email(
+            f"sujet {index}", "pomme" if index % 2 else "poire"))
+    yield storage
+    storage.close()
+
+
+def _found(storage, terms, offset=0, limit=None):
+    results, total = storage.search("bob", terms, offset, limit)
+    return [(number, header["subject"]) for number, header in results], total
+
+
+def test_search_terms_are_normalized():
+    assert glostorage.search_terms("Été à Québec!", "x ÉTÉ") == [
+        "ete", "quebec"]
+
+
+def test_search_numbers_results_newest_first(mailbox):
+    assert _found(mailbox, ["pomme"]) == (
+        [(1, "sujet 9"), (3, "sujet 7"), (5, "sujet 5"), (7, "sujet 3"),
+         (9, "sujet 1")], 5)
+    assert _found(mailbox, ["pomme"], 1, 2) == (
+        [(3, "sujet 7"), (5, "sujet 5")], 5)
+    assert _found(mailbox, ["pomme", "sujet"])[1] == 5
+    assert _found(mailbox, ["pomme", "poire"]) == ([], 0)
+    assert _found(mailbox, ["alice", "glo2000"])[1] == 10
+
+
+def test_search_follows_deletions_and_deliveries(mailbox, backend,
+                                                 tmp_path):
+    other = make_storage(backend, str(tmp_path))
+    try:
+        _found(mailbox, ["pomme"])
+        assert other.delete_message("bob", 1)
+        assert _found(mailbox, ["pomme"]) == (
+            [(2, "sujet 7"), (4, "sujet 5"), (6, "sujet 3"),
+             (8, "sujet 1")], 4)
+        for _ in range(6):
+            assert mailbox.delete_message("bob", 1)
+        other.append_message("bob", make_email("nouveau", "pomme"))
+        assert _found(mailbox, ["pomme"]) == (
+            [(1, "nouveau"), (3, "sujet 1")], 2)
+        assert _found(mailbox, ["poire"]) == (
+            [(2, "sujet 2"), (4, "sujet 0")], 2)
+    finally:
+        other.close()
+
+
+def test_redelivered_lost_messages_are_searchable(mailbox):
+    mailbox.store_lost(make_email("perdu", "banane", "carl@glo2000.ca"),
+                       ["carl"])
+    mailbox.create_user("carl", "hachage")
+    mailbox.redeliver_lost("carl")
+    results, total = mailbox.search("carl", ["banane"])
+    assert total == 1
+    assert results[0][1]["subject"] == "perdu"
+
+
+@pytest.mark.parametrize("kind", ["filesystem", "segment"])
+def test_search_file_is_pruned_and_rebuilt(kind, tmp_path):
+    storage = make_storage(kind, str(tmp_path))
+    storage.create_user("bob", "hachage")
+    for index in range(10):
+        storage.append_message("bob", make_email(f"sujet {index}"))
+    search_path = os.path.join(tmp_path, "bob",
+                               gloutils.SEARCH_INDEX_FILENAME)
+    assert _found(storage, ["sujet"])[1] == 10
+    for _ in range(8):
+        assert storage.delete_message("bob", 1)
+    with open(search_path) as search_file:
+        assert len(search_file.readlines()) < 10
+    # Boîte antérieure à l'index de recherche.
+    os.remove(search_path)
+    reopened = make_storage(kind, str(tmp_path))
+    assert _found(reopened, ["sujet"]) == (
+        [(1, "sujet 1"), (2, "sujet 0")], 2)
+
+
+def test_search_survives_segment_index_rebuild(tmp_path):
+    storage = make_storage("segment", str(tmp_path))
+    storage.create_user("bob", "hachage")
+    for index in range(3):
+        storage.append_message("bob", make_email(f"sujet {index}"))
+    assert _found(storage, ["sujet"])[1] == 3
+    os.remove(os.path.join(tmp_path, "bob", gloutils.INDEX_FILENAME))
+    reopened = make_storage("segment", str(tmp_path))
+    assert _found(reopened, ["sujet"]) == (
+        [(1, "sujet 2"), (2, "sujet 1"), (3, "sujet 0")], 3)
+
+
+def test_search_indexes_are_bounded(mailbox, monkeypatch):
+    monkeypatch.setattr(mailbox._search_indexes, "_capacity", 2)
+    for username in ("u1", "u2", "u3"):
+        mailbox.create_user(username, "hachage")
+        mailbox.append_message(username, make_email("kiwi"))
+        assert mailbox.search(username, ["kiwi"])[1] == 1
+    assert len(mailbox._search_indexes._entries) == 2
+    assert mailbox.search("u1", ["kiwi"])[1] == 1
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = glostorage.LRUCache(2)
+    assert cache.get("a", lambda: 1) == 1
+    assert cache.get("b", lambda: 2) == 2
+    assert cache.get("a", lambda: 0) == 1
+    cache.put("c", 3)
+    assert cache.peek("b") is None
+    assert cache.peek("a") == 1
+    assert cache.get("c", lambda: 0) == 3
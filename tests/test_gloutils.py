@@ -0,0 +1,61 @@
+"""Tests des identifiants et des codecs de messages de gloutils."""
+import pytest
+
+import gloutils
+
+MESSAGES = [
+    gloutils.GloMessage(header=gloutils.Headers.BYE),
+    gloutils.GloMessage(header=gloutils.Headers.OK, payload={}),
+    gloutils.GloMessage(
+        header=gloutils.Headers.EMAIL_SENDING,
+        payload=gloutils.EmailContentPayload(
+            sender="alice@glo2000.ca", destination="bob@glo2000.ca",
+            subject="Été", date="2026-01-01", content="é\n" * 1000)),
+    gloutils.GloMessage(
+        header=gloutils.Headers.INBOX_PAGE_REQUEST,
+        payload={"offset": 0, "limit": -(1 << 63), "stream": True}),
+    gloutils.GloMessage(
+        header=gloutils.Headers.OK,
+        payload={"email_list": ["#1 a - b c", ""], "total": 1 << 70,
+                 "metrics": {"requests": [1, 2.5, None]},
+                 "champ_inconnu": "valeur"}),
+]
+
+
+@pytest.mark.parametrize("codec", gloutils.CODECS)
+@pytest.mark.parametrize("message", MESSAGES)
+def test_codec_round_trip(codec, message):
+    data = gloutils.encode_message(message, codec)
+    assert gloutils.decode_message(data, codec) == message
+    assert gloutils.decode_message(bytearray(data), codec) == message
+
+
+def test_binary_message_without_payload_is_one_byte():
+    message = gloutils.GloMessage(header=gloutils.Headers.BYE)
+    assert len(gloutils.encode_message(message, gloutils.CODEC_BINARY)) == 1
+
+
+def test_binary_codec_is_smaller_than_json():
+    message = MESSAGES[2]
+    assert (len(gloutils.encode_message(message, gloutils.CODEC_BINARY))
+            < len(gloutils.encode_message(message, gloutils.CODEC_JSON)))
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    bytes((gloutils.Headers.OK, 1)),
+    bytes((gloutils.Headers.OK, 1, 0, 9)),
+    bytes((gloutils.Headers.OK, 0, 0)),
+    bytes((gloutils.Headers.OK, 1, 3, 0, 0, 0, 0, 9)),
+])
+def test_invalid_binary_message_raises_value_error(data):
+    with pytest.raises(ValueError):
+        gloutils.decode_message(data, gloutils.CODEC_BINARY)
+
+
+def test_message_ids_increase_when_the_clock_stands_still(monkeypatch):
+    monkeypatch.setattr(gloutils.time, "time_ns", lambda: 1)
+    ids = [gloutils.new_message_id() for _ in range(3)]
+    assert len(set(ids)) == 3
+    assert ids == sorted(ids)
+    assert all(len(message_id) == len(ids[0]) for message_id in ids)
@@ -0,0 +1,467 @@
+"""Tests des traitements du serveur."""
+import asyncio
+import concurrent.futures
+import json
+import os
+import select
+import selectors
+import shutil
+import signal
+import socket
+import time
+
+import pytest
+
+import glosocket
+import glostorage
+import gloutils
+import TP4_server
+
+
+def _request(header, payload=None) -> bytes:
+    message = gloutils.GloMessage(header=header)
+    if payload is not None:
+        message["payload"] = payload
+    return b"".join(glosocket.frame_bytes(gloutils.encode_message(message)))
+
+
+def _connect(server):
+    """Retourne une connexion du moteur selectors et le socket du client."""
+    server_side, client_side = socket.socketpair()
+    connection = TP4_server._Connection(server_side)
+    server._connections[server_side] = connection
+    server._selector.register(server_side, selectors.EVENT_READ, connection)
+    return connection, client_side
+
+
+def test_session_headers_require_login(server):
+    client_soc = socket.socket()
+    try:
+        for header in TP4_server._SESSION_HEADERS:
+            response = server._dispatch(client_soc, gloutils.GloMessage(
+                header=header, payload={}))
+            assert response["header"] == gloutils.Headers.ERROR
+    finally:
+        client_soc.close()
+
+
+def test_failing_handler_only_disconnects_its_client(server, monkeypatch):
+    def _fail(client_soc, message):
+        raise RuntimeError("panne du traitement")
+
+    monkeypatch.setattr(server, "_handle", _fail)
+    connection, client_side = _connect(server)
+    other, other_client = _connect(server)
+    try:
+        connection.decoder.feed(_request(gloutils.Headers.STATS_REQUEST))
+        server._process_frames(connection)
+        assert connection.socket not in server._connections
+        assert other.socket in server._connections
+        assert client_side.recv(1) == b""
+    finally:
+        client_side.close()
+        other_client.close()
+
+
+def test_invalid_frame_closes_connection(server):
+    connection, client_side = _connect(server)
+    try:
+        connection.decoder.feed(
+            b"".join(glosocket.frame_bytes(b"{pas du json")))
+        server._process_frames(connection)
+        assert connection.closing
+    finally:
+        client_side.close()
+
+
+def test_stats_request_is_answered_once_logged_in(server):
+    connection, client_side = _connect(server)
+    server._storage.create_user("alice", "hachage")
+    server._logged_users[connection.socket] = "alice"
+    try:
+        connection.decoder.feed(_request(gloutils.Headers.STATS_REQUEST))
+        server._process_frames(connection)
+        response = json.loads(glosocket.recv_mesg(client_side))
+        assert response["header"] == gloutils.Headers.OK
+        assert response["payload"]["count"] == 0
+    finally:
+        client_side.close()
+
+
+def test_hello_negotiates_the_binary_codec(server):
+    connection, client_side = _connect(server)
+    try:
+        connection.decoder.feed(_request(gloutils.Headers.HELLO, {
+            "codecs": ["inconnu", gloutils.CODEC_BINARY],
+            "compression": []}))
+        server._process_frames(connection)
+        response = json.loads(glosocket.recv_mesg(client_side))
+        assert response["header"] == gloutils.Headers.OK
+        assert response["payload"]["codecs"] == [gloutils.CODEC_BINARY]
+        connection.decoder.feed(b"".join(glosocket.frame_bytes(
+            gloutils.encode_message(
+                gloutils.GloMessage(header=gloutils.Headers.STATS_REQUEST),
+                gloutils.CODEC_BINARY))))
+        server._process_frames(connection)
+        response = gloutils.decode_message(
+            glosocket.recv_mesg_bytes(client_side), gloutils.CODEC_BINARY)
+        assert response["header"] == gloutils.Headers.ERROR
+    finally:
+        client_side.close()
+
+
+def test_hello_without_common_codec_keeps_json(server):
+    response, codec, compress = server._hello(
+        {"codecs": ["inconnu"]}, gloutils.CODEC_JSON, False)
+    assert response["header"] == gloutils.Headers.ERROR
+    assert (codec, compress) == (gloutils.CODEC_JSON, False)
+
+
+def test_compressed_request_requires_hello(server):
+    connection, client_side = _connect(server)
+    data = gloutils.encode_message(gloutils.GloMessage(
+        header=gloutils.Headers.AUTH_LOGIN,
+        payload={"username": "a" * 2000, "password": "b"}))
+    try:
+        connection.decoder.feed(
+            b"".join(glosocket.frame_bytes(data, compress=True)))
+        server._process_frames(connection)
+        assert connection.closing
+    finally:
+        client_side.close()
+
+
+STRONG_PASSWORD = "MotDePasse1234"
+
+
+def test_asyncio_engine_serves_a_client_until_bye(server):
+    async def _session():
+        server_side, client_side = socket.socketpair()
+        reader, writer = await asyncio.open_connection(sock=server_side)
+        handler = asyncio.create_task(server._handle_stream(reader, writer))
+        client_reader, client_writer = await asyncio.open_connection(
+            sock=client_side)
+        responses = []
+        for header, payload in [
+                (gloutils.Headers.AUTH_REGISTER, gloutils.AuthPayload(
+                    username="alice", password=STRONG_PASSWORD)),
+                (gloutils.Headers.STATS_REQUEST, None)]:
+            client_writer.write(_request(header, payload))
+            responses.append(json.loads(
+                await glosocket.recv_mesg_bytes_async(client_reader)))
+        assert writer in server._logged_users
+        client_writer.write(_request(gloutils.Headers.BYE))
+        await handler
+        client_writer.close()
+        return responses
+
+    server._executor = concurrent.futures.ThreadPoolExecutor(1)
+    registered, stats = asyncio.run(_session())
+    assert registered["header"] == gloutils.Headers.OK
+    assert stats["header"] == gloutils.Headers.OK
+    assert stats["payload"]["count"] == 0
+    assert not server._logged_users
+
+
+def test_duplicate_registration_is_refused(server):
+    first, second = socket.socket(), socket.socket()
+    payload = gloutils.AuthPayload(username="alice",
+                                   password=STRONG_PASSWORD)
+    try:
+        response = server._create_account(first, payload)
+        assert response["header"] == gloutils.Headers.OK
+        response = server._create_account(second, payload)
+        assert response["header"] == gloutils.Headers.ERROR
+        assert second not in server._logged_users
+    finally:
+        first.close()
+        second.close()
+
+
+def test_registration_race_does_not_log_in(server, monkeypatch):
+    server._storage.create_user("alice", "hachage de l'autre client")
+    # L'autre client crée le compte entre user_exists et create_user.
+    monkeypatch.setattr(server._storage, "user_exists",
+                        lambda username: False)
+    client_soc = socket.socket()
+    try:
+        response = server._create_account(client_soc, gloutils.AuthPayload(
+            username="alice", password=STRONG_PASSWORD))
+        assert response["header"] == gloutils.Headers.ERROR
+        assert response["payload"]["error_message"] == (
+            "le nom d'utilisateur est deja utilise")
+        assert "token" not in response["payload"]
+        assert client_soc not in server._logged_users
+    finally:
+        client_soc.close()
+
+
+def test_inbox_pages_keep_full_list_numbers(server):
+    server._storage.create_user("alice", "hachage")
+    for index in range(5):
+        server._storage.append_message("alice", gloutils.EmailContentPayload(
+            sender="bob@glo2000.ca", destination="alice@glo2000.ca",
+            subject=f"sujet {index}", date="2026-01-01", content="contenu"))
+    client_soc = socket.socket()
+    server._logged_users[client_soc] = "alice"
+    try:
+        response = server._get_email_page(
+            client_soc, gloutils.EmailPageRequestPayload(offset=1, limit=2))
+        assert response["header"] == gloutils.Headers.OK
+        assert response["payload"]["total"] == 5
+        assert response["payload"]["email_list"] == [
+            "#2 bob@glo2000.ca - sujet 3 2026-01-01",
+            "#3 bob@glo2000.ca - sujet 2 2026-01-01"]
+        response = server._get_email_page(
+            client_soc, gloutils.EmailPageRequestPayload(offset=-1, limit=2))
+        assert response["header"] == gloutils.Headers.ERROR
+    finally:
+        client_soc.close()
+
+
+def _email(destination: str) -> gloutils.EmailContentPayload:
+    return gloutils.EmailContentPayload(
+        sender="alice@glo2000.ca", destination=destination,
+        subject="sujet", date="2026-01-01 00:00:00", content="contenu")
+
+
+def test_partial_delivery_is_reported_per_recipient(server):
+    server._storage.create_user("bob", "hachage")
+    response = server._send_email(_email(
+        "bob@glo2000.ca, carl@ailleurs.ca, fantome@glo2000.ca"))
+    assert response["header"] == gloutils.Headers.OK
+    results = response["payload"]["results"]
+    assert [result["destination"] for result in results] == [
+        "bob@glo2000.ca", "carl@ailleurs.ca", "fantome@glo2000.ca"]
+    assert "error_message" not in results[0]
+    assert all("error_message" in result for result in results[1:])
+    assert "carl@ailleurs.ca" in response["payload"]["error_message"]
+    assert server._storage.stats("bob")[0] == 1
+    response = server._send_email(_email(
+        "carl@ailleurs.ca, fantome@glo2000.ca"))
+    assert response["header"] == gloutils.Headers.ERROR
+    assert len(response["payload"]["results"]) == 2
+
+
+def _wait_for_jobs(server, *connections):
+    """
+    Transmet les réponses du bassin jusqu'à ce que les connexions n'aient
+    plus de traitement en cours.
+    """
+    while any(connection.busy for connection in connections):
+        assert select.select([server._wakeup_recv], [], [], 5)[0]
+        server._finish_jobs()
+
+
+def test_pooled_requests_are_answered_in_turn(pooled_server):
+    pooled_server._storage.create_user("alice", "hachage")
+    first, first_client = _connect(pooled_server)
+    second, second_client = _connect(pooled_server)
+    try:
+        for connection in (first, second):
+            pooled_server._logged_users[connection.socket] = "alice"
+            connection.decoder.feed(
+                _request(gloutils.Headers.STATS_REQUEST))
+            pooled_server._process_frames(connection)
+            assert connection.busy
+        # La limite d'un traitement à la fois met le second en file.
+        assert len(pooled_server._jobs_waiting[
+            gloutils.Headers.STATS_REQUEST]) == 1
+        _wait_for_jobs(pooled_server, first, second)
+        for client_side in (first_client, second_client):
+            response = json.loads(glosocket.recv_mesg(client_side))
+            assert response["header"] == gloutils.Headers.OK
+            assert response["payload"]["count"] == 0
+    finally:
+        first_client.close()
+        second_client.close()
+
+
+def _start_upload(server, connection):
+    """
+    Commence la réception d'un courriel pour alice et retourne son
+    MessageWriter.
+    """
+    server._storage.create_user("alice", "hachage")
+    server._start_upload(connection.socket, gloutils.EmailStreamStartPayload(
+        sender="bob@glo2000.ca", destination="alice@glo2000.ca",
+        subject="Sujet", date="2024-01-01"))
+    writer, _ = server._uploads[connection.socket]
+    writer.write("début du contenu")
+    return writer
+
+
+def test_streamed_email_round_trip(server, monkeypatch):
+    monkeypatch.setattr(gloutils, "STREAM_CHUNK_SIZE", 1000)
+    connection, client_side = _connect(server)
+    content = "é \"citation\"\n" * 500
+    try:
+        writer = _start_upload(server, connection)
+        for start in range(0, len(content), 700):
+            server._upload_chunk(connection.socket, gloutils.EmailChunkPayload(
+                data=content[start:start + 700]))
+        response = server._finish_upload(connection.socket)
+        assert response["header"] == gloutils.Headers.OK
+        server._logged_users[connection.socket] = "alice"
+        messages = list(server._stream_email(
+            connection.socket, gloutils.EmailChoicePayload(choice=1)))
+        assert messages[0]["header"] == gloutils.Headers.EMAIL_STREAM_START
+        assert messages[0]["payload"]["subject"] == "Sujet"
+        assert messages[-1]["header"] == gloutils.Headers.EMAIL_STREAM_END
+        chunks = [message["payload"]["data"] for message in messages[1:-1]]
+        assert all(len(chunk) <= 1000 for chunk in chunks)
+        assert "".join(chunks) == "début du contenu" + content
+        assert not os.path.exists(writer.path)
+    finally:
+        client_side.close()
+
+
+def test_upload_is_aborted_on_disconnect(server):
+    connection, client_side = _connect(server)
+    client_side.close()
+    writer = _start_upload(server, connection)
+    server._remove_client(connection.socket)
+    assert connection.socket not in server._uploads
+    assert not os.path.exists(writer.path)
+
+
+def test_busy_upload_is_aborted_once_its_job_is_done(server):
+    connection, client_side = _connect(server)
+    client_side.close()
+    writer = _start_upload(server, connection)
+    connection.busy = True
+    server._remove_client(connection.socket)
+    # Un fil du bassin pourrait encore écrire le courriel.
+    assert os.path.exists(writer.path)
+    header = gloutils.Headers.EMAIL_STREAM_CHUNK
+    server._jobs_running[header] += 1
+    done = concurrent.futures.Future()
+    done.set_result(None)
+    server._completed.put((connection, header, done))
+    server._finish_jobs()
+    assert connection.socket not in server._uploads
+    assert not os.path.exists(writer.path)
+
+
+def _resume(server, token):
+    """Présente le jeton sur un nouveau socket et retourne la réponse."""
+    client_soc = socket.socket()
+    try:
+        response = server._resume(client_soc,
+                                  gloutils.SessionPayload(token=token))
+        assert (client_soc in server._logged_users) == (
+            response["header"] == gloutils.Headers.OK)
+        return response
+    finally:
+        server._logged_users.pop(client_soc, None)
+        client_soc.close()
+
+
+def test_session_is_resumed_until_logout(server):
+    client_soc = socket.socket()
+    try:
+        response = server._create_account(client_soc, gloutils.AuthPayload(
+            username="alice", password=STRONG_PASSWORD))
+        token = response["payload"]["token"]
+        response = _resume(server, token)
+        assert response["header"] == gloutils.Headers.OK
+        renewed = response["payload"]["token"]
+        assert _resume(server, renewed)["header"] == gloutils.Headers.OK
+        server._dispatch(client_soc, gloutils.GloMessage(
+            header=gloutils.Headers.AUTH_LOGOUT))
+        assert client_soc not in server._logged_users
+        for revoked in (token, renewed):
+            assert _resume(server, revoked)["header"] == (
+                gloutils.Headers.ERROR)
+    finally:
+        client_soc.close()
+
+
+def test_forged_expired_or_orphan_sessions_are_refused(server, tmp_path):
+    server._storage.create_user("alice", "hachage")
+    token = server._issue_session("alice")["token"]
+    assert _resume(server, token)["header"] == gloutils.Headers.OK
+    _, expiry, signature = token.split(":")
+    for forged in (f"bob:{expiry}:{signature}",
+                   f"alice:{int(expiry) + 1}:{signature}",
+                   f"alice:{expiry}:{'0' * len(signature)}",
+                   "alice", ""):
+        assert _resume(server, forged)["header"] == gloutils.Headers.ERROR
+    expired = int(time.time()) - 1
+    signature = server._sign_session("alice", expired, 0)
+    assert _resume(server, f"alice:{expired}:{signature}")["header"] == (
+        gloutils.Headers.ERROR)
+    # Le compte n'existe plus: son jeton n'est plus accepté.
+    shutil.rmtree(tmp_path / "alice")
+    assert _resume(server, token)["header"] == gloutils.Headers.ERROR
+
+
+def test_metrics_and_profile_require_an_admin(server):
+    server._admins = frozenset({"root"})
+    client_soc = socket.socket()
+    try:
+        for username in (None, "alice"):
+            if username is not None:
+                server._logged_users[client_soc] = username
+            for header in (gloutils.Headers.METRICS_REQUEST,
+                           gloutils.Headers.PROFILE_REQUEST):
+                response = server._dispatch(
+                    client_soc, gloutils.GloMessage(header=header))
+                assert response["header"] == gloutils.Headers.ERROR
+                assert "administrateur" in response["payload"][
+                    "error_message"]
+        server._logged_users[client_soc] = "Root"
+        response = server._dispatch(client_soc, gloutils.GloMessage(
+            header=gloutils.Headers.METRICS_REQUEST))
+        assert response["header"] == gloutils.Headers.OK
+        assert "metrics" in response["payload"]
+    finally:
+        client_soc.close()
+
+
+@pytest.fixture
+def launcher_signals():
+    """Rétablit les gestionnaires de signaux modifiés par le lanceur."""
+    saved = {signum: signal.getsignal(signum)
+             for signum in (signal.SIGTERM, signal.SIGUSR1)}
+    yield
+    for signum, handler in saved.items():
+        signal.signal(signum, handler)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="fork indisponible")
+def test_failing_child_process_does_not_return(tmp_path, launcher_signals):
+    returned = tmp_path / "returned"
+    failures = [RuntimeError("panne du processus")]
+
+    def _serve() -> None:
+        if failures:
+            raise failures[0]
+
+    try:
+        assert not TP4_server._serve_processes(2, _serve)
+        failures.clear()
+        assert TP4_server._serve_processes(2, _serve)
+    finally:
+        # Un processus enfant revenu ici l'écrirait aussi.
+        with open(returned, "a") as file:
+            file.write(f"{os.getpid()}\n")
+    assert returned.read_text().split() == [str(os.getpid())]
+
+
+def test_cleanup_confirms_pending_deliveries_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(gloutils, "APP_PORT", 0)
+    storage = glostorage.FileSystemStorage(str(tmp_path))
+    closed = []
+    monkeypatch.setattr(storage, "close", lambda: closed.append(True))
+    server = TP4_server.Server(storage, workers=1,
+                               durability=glostorage.DURABILITY_BATCH)
+    storage.create_user("alice", "hachage")
+    response = server._send_email(gloutils.EmailContentPayload(
+        sender="bob@glo2000.ca", destination="alice@glo2000.ca",
+        subject="Sujet", date="2024-01-01", content="contenu"))
+    assert isinstance(response, concurrent.futures.Future)
+    server.cleanup()
+    assert response.result(0)["header"] == gloutils.Headers.OK
+    server.cleanup()
+    assert closed == [True]